@@ -5,47 +5,627 @@ uploads from PyCBC Live. At the moment this implement very minimal
 functionality to let PyCBC Live upload without errors.
 
 Start it on the same machine running PyCBC Live, and point PyCBC Live to
-upload events to http://localhost:8000/api/."""
+upload events to http://localhost:8000/api/.
 
+Uploaded events are decoded and kept, with their log entries and files, in
+an SQLite database, in memory unless a file is given with --database, from
+which they can be read back through the usual GraceDB API:
+/api/events/{graceid}, /api/events/{graceid}/log/ and
+/api/events/{graceid}/files/. Scripts using the GraceDB client can thus be
+tested against this server, including pycbclive_plot_event_latency.py in
+its --event-id mode, as event searches by graceid or GPS time range, e.g.
+"group: Test 1400000000 .. 1400000100", are served at /api/events/.
+
+The server also measures its own side of the upload path: for every request
+it records when it was received, the size of its body, the time spent
+decoding it and the time taken to respond, as well as, for event uploads,
+the latency of the upload with respect to the end time of the event in the
+coinc XML. Histograms of these over the recent requests, and percentiles
+estimated from them, are served by endpoint as JSON at /api/performance/.
+
+Requests are handled concurrently, one thread per connection, so a slow
+upload does not hold up the others, and connections are kept alive
+(HTTP/1.1)."""
+
+import argparse
+import collections
+import csv
+import datetime
+import gzip
 import logging
 import http.server
 import json
 import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+from xml.etree import ElementTree
+import numpy as np
 from requests_toolbelt import MultipartDecoder
 
+from pycbclive_gpstime import unix_to_gps
+
+
+# LIGO_LW column types converted to numbers, the others are kept as strings
+_LIGOLW_NUMBER_TYPES = {
+    'int_2s': int, 'int_2u': int, 'int_4s': int, 'int_4u': int,
+    'int_8s': int, 'int_8u': int, 'real_4': float, 'real_8': float
+}
+
+# percentiles and histogram bin edges of the request timings served at
+# /api/performance/: body sizes in bytes, times and latencies in seconds
+PERCENTILES = [50, 90, 95, 99]
+_TIME_BINS = np.logspace(-5, 2, 57)
+QUANTITY_BINS = {
+    'body_size': np.logspace(6, 24, 19, base=2),
+    'decode_time': _TIME_BINS,
+    'response_time': _TIME_BINS,
+    'upload_latency': np.arange(-60, 121, 2.5)
+}
+
+
+def read_ligolw_tables(xml_data, names):
+    """Read the rows of the tables with the given names from a LIGO_LW XML
+    document. Returns a dict mapping each table name to a list of rows, as
+    dicts mapping column names to values, None for null values.
+    """
+    root = ElementTree.fromstring(xml_data)
+    tables = {}
+    for table in root.iter('Table'):
+        # older documents name tables and columns like
+        # "coinc_inspiral:table" and "coinc_inspiral:snr"
+        name = table.get('Name', '').split(':table')[0].split(':')[-1]
+        if name not in names:
+            continue
+        columns = [
+            (column.get('Name').split(':')[-1],
+             _LIGOLW_NUMBER_TYPES.get(column.get('Type')))
+            for column in table.iter('Column')
+        ]
+        stream = table.find('Stream')
+        delimiter = stream.get('Delimiter', ',')
+        # every row but the last ends with a delimiter
+        lines = [line.strip() for line in (stream.text or '').splitlines()]
+        lines = [line[:-1] if line.endswith(delimiter) else line
+                 for line in lines if line]
+        values = [value for row in csv.reader(lines, delimiter=delimiter,
+                                              escapechar='\\')
+                  for value in row]
+        rows = []
+        for start in range(0, len(values) - len(columns) + 1, len(columns)):
+            row = {}
+            for (column, convert), value in zip(
+                    columns, values[start:start + len(columns)]):
+                if value == '':
+                    row[column] = None
+                elif convert is not None:
+                    row[column] = convert(value)
+                else:
+                    row[column] = value
+            rows.append(row)
+        tables[name] = rows
+    return tables
+
+
+def parse_form(post_data, content_type):
+    """Return the fields of form data as a list of (name, filename, content)
+    tuples, with a None filename for plain fields. The GraceDB client sends
+    multipart data when uploading a file, and URL-encoded data otherwise.
+    """
+    if not (content_type or '').startswith('multipart/'):
+        return [
+            (name, None, value.encode())
+            for name, values in urllib.parse.parse_qs(
+                post_data.decode(), keep_blank_values=True
+            ).items()
+            for value in values
+        ]
+    parts = []
+    for part in MultipartDecoder(post_data, content_type).parts:
+        disposition = part.headers.get(b'Content-Disposition', b'').decode()
+        name = re.search(r'\bname="([^"]*)"', disposition)
+        filename = re.search(r'\bfilename="([^"]*)"', disposition)
+        parts.append((
+            name.group(1) if name else None,
+            filename.group(1) if filename else None,
+            part.content
+        ))
+    return parts
+
+
+def parse_query(query):
+    """Parse the subset of the GraceDB event query language understood by
+    the server: terms separated by "|", each made of an optional
+    "group: <name>" followed by a graceid or a GPS time range
+    "[gpstime:] <start> .. <end>". Returns a list of (group, graceid,
+    gps_range) tuples, with None for what is not given.
+    """
+    terms = []
+    for text in query.split('|'):
+        text = text.strip()
+        group = graceid = gps_range = None
+        if match := re.match(r'group:\s*(\S+)\s*', text, re.IGNORECASE):
+            group = match.group(1)
+            text = text[match.end():]
+        if match := re.fullmatch(r'(?:gpstime:\s*)?(\S+)\s*\.\.\s*(\S+)',
+                                 text, re.IGNORECASE):
+            gps_range = (float(match.group(1)), float(match.group(2)))
+        elif re.fullmatch(r'G\d+', text):
+            graceid = text
+        elif text:
+            raise ValueError(f"unsupported query term {text!r}")
+        terms.append((group, graceid, gps_range))
+    return terms
+
+
+def utc_now_str():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')
+
+
+class EventStore:
+    """SQLite database of the uploaded events, their log entries and files,
+    shared by the threads of the server.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(
+            'CREATE TABLE IF NOT EXISTS events ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT,'
+            ' gpstime REAL);'
+            'CREATE INDEX IF NOT EXISTS events_gpstime ON events (gpstime);'
+            'CREATE TABLE IF NOT EXISTS logs ('
+            ' graceid TEXT, n INTEGER, data TEXT,'
+            ' PRIMARY KEY (graceid, n));'
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' graceid TEXT, filename TEXT, version INTEGER, content BLOB,'
+            ' PRIMARY KEY (graceid, filename, version));'
+        )
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def add_event(self, event):
+        """Store a new event, given as a dict without graceid. Returns the
+        graceid assigned to it.
+        """
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT INTO events (gpstime) VALUES (?)',
+                (event.get('gpstime'),)
+            )
+            gid = f"G{cursor.lastrowid}"
+            event = dict(event, graceid=gid)
+            self.db.execute(
+                'UPDATE events SET data = ? WHERE id = ?',
+                (json.dumps(event), cursor.lastrowid)
+            )
+            self.db.commit()
+        return gid
+
+    def event(self, gid):
+        row = self.db_fetchone(
+            'SELECT data FROM events WHERE id = ?', (int(gid[1:]),)
+        )
+        return None if row is None else json.loads(row[0])
+
+    def search(self, terms):
+        """Events matching any of the terms returned by parse_query(), in
+        order of GPS time. As on GraceDB, events of the Test and MDC groups
+        are only returned when their group or graceid is asked for.
+        """
+        found = {}
+        for group, graceid, gps_range in terms:
+            if graceid is not None:
+                events = [self.event(graceid)]
+            elif gps_range is not None:
+                with self.lock:
+                    rows = self.db.execute(
+                        'SELECT data FROM events '
+                        'WHERE gpstime BETWEEN ? AND ?', gps_range
+                    ).fetchall()
+                events = [json.loads(row[0]) for row in rows]
+            else:
+                with self.lock:
+                    rows = self.db.execute(
+                        'SELECT data FROM events'
+                    ).fetchall()
+                events = [json.loads(row[0]) for row in rows]
+            for event in events:
+                if event is None:
+                    continue
+                event_group = (event.get('group') or '').lower()
+                if group is None:
+                    if graceid is None and event_group in ['test', 'mdc']:
+                        continue
+                elif event_group != group.lower():
+                    continue
+                found[event['graceid']] = event
+        return sorted(found.values(), key=lambda e: e.get('gpstime') or 0)
+
+    def add_log(self, gid, entry, filename=None, content=None):
+        """Add a log entry, given as a dict, to an event, with an optional
+        file. Returns the complete entry, with its number N.
+        """
+        with self.lock:
+            n, = self.db.execute(
+                'SELECT COALESCE(MAX(n), 0) + 1 FROM logs WHERE graceid = ?',
+                (gid,)
+            ).fetchone()
+            entry = dict(entry, N=n, filename=filename or '',
+                         file_version=None)
+            if filename:
+                version, = self.db.execute(
+                    'SELECT COALESCE(MAX(version), -1) + 1 FROM files '
+                    'WHERE graceid = ? AND filename = ?',
+                    (gid, filename)
+                ).fetchone()
+                entry['file_version'] = version
+                self.db.execute(
+                    'INSERT INTO files VALUES (?, ?, ?, ?)',
+                    (gid, filename, version, content)
+                )
+            self.db.execute(
+                'INSERT INTO logs VALUES (?, ?, ?)',
+                (gid, n, json.dumps(entry))
+            )
+            self.db.commit()
+        return entry
+
+    def logs(self, gid):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT data FROM logs WHERE graceid = ? ORDER BY n', (gid,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def log(self, gid, n):
+        row = self.db_fetchone(
+            'SELECT data FROM logs WHERE graceid = ? AND n = ?', (gid, n)
+        )
+        return None if row is None else json.loads(row[0])
+
+    def file_versions(self, gid):
+        with self.lock:
+            return self.db.execute(
+                'SELECT filename, version FROM files WHERE graceid = ? '
+                'ORDER BY filename, version', (gid,)
+            ).fetchall()
+
+    def file(self, gid, filename):
+        """Content of a file, given as "name" for the latest version or
+        "name,version", or None.
+        """
+        name, _, version = filename.rpartition(',')
+        if name and version.isdigit():
+            row = self.db_fetchone(
+                'SELECT content FROM files '
+                'WHERE graceid = ? AND filename = ? AND version = ?',
+                (gid, name, int(version))
+            )
+        else:
+            row = self.db_fetchone(
+                'SELECT content FROM files WHERE graceid = ? AND filename = ? '
+                'ORDER BY version DESC LIMIT 1', (gid, filename)
+            )
+        return None if row is None else row[0]
+
+    def db_fetchone(self, query, params):
+        with self.lock:
+            return self.db.execute(query, params).fetchone()
+
 
-class FakeGraceDBServer(http.server.HTTPServer):
-    """This class inherits from HTTPServer and keeps an internal list of G
-    events that were uploaded to the server.
+def decode_event(fields, content, receive_time):
+    """Make the GraceDB representation of an uploaded event, given the
+    fields of the form, the uploaded coinc XML file, possibly gzipped, and
+    the Unix time at which the upload was received.
     """
-    def __init__(self, name_port, handler):
+    if content[:2] == b'\x1f\x8b':
+        content = gzip.decompress(content)
+    tables = read_ligolw_tables(content, {'coinc_inspiral', 'sngl_inspiral'})
+    coinc = tables['coinc_inspiral'][0]
+    gpstime = coinc['end_time'] + coinc['end_time_ns'] * 1e-9
+    return {
+        'group': fields.get('group'),
+        'pipeline': fields.get('pipeline'),
+        'search': fields.get('search'),
+        'offline': fields.get('offline') == 'True',
+        'labels': fields.get('labels', []),
+        'gpstime': gpstime,
+        'far': coinc.get('combined_far'),
+        'instruments': coinc.get('ifos'),
+        'created': utc_now_str(),
+        'reporting_latency': float(unix_to_gps(receive_time)) - gpstime,
+        'extra_attributes': {
+            'CoincInspiral': coinc,
+            'SingleInspiral': tables.get('sngl_inspiral', [])
+        }
+    }
+
+
+def endpoint_name(method, path):
+    """Name of the API endpoint of a request, with the graceids, log entry
+    numbers and file names replaced by placeholders.
+    """
+    path = re.sub(r"/G\d+(/|$)", r"/{graceid}\1", path)
+    path = re.sub(r"/(logs?)/\d+", r"/\1/{N}", path)
+    path = re.sub(r"/files/.+", "/files/{filename}", path)
+    return f"{method} {path}"
+
+
+class Histogram:
+    """Histogram of a quantity, with underflow and overflow buckets, plus
+    the number, sum and extremes of the values.
+    """
+
+    def __init__(self, bins):
+        self.bins = bins
+        self.counts = np.zeros(len(bins) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, value):
+        self.counts[np.searchsorted(self.bins, value, side='right')] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Estimate a percentile by interpolating linearly within its
+        bucket, bounded by the extremes of the values.
+        """
+        edges = np.concatenate([[self.min], self.bins, [self.max]])
+        cum = np.cumsum(self.counts)
+        target = q / 100 * self.count
+        i = min(np.searchsorted(cum, target), len(self.counts) - 1)
+        below = cum[i] - self.counts[i]
+        frac = (target - below) / self.counts[i] if self.counts[i] else 0
+        low = max(edges[i], self.min)
+        high = min(edges[i + 1], self.max)
+        return float(low + frac * (high - low))
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count,
+            'min': float(self.min),
+            'max': float(self.max),
+            'percentiles': {str(q): self.percentile(q) for q in PERCENTILES},
+            'histogram': {
+                'edges': [float(b) for b in self.bins],
+                'counts': self.counts[1:-1].tolist(),
+                'underflow': int(self.counts[0]),
+                'overflow': int(self.counts[-1])
+            }
+        }
+
+
+class RequestStats:
+    """Histograms of the timings of the requests received by the server in
+    the last `window` seconds, by endpoint. The histograms are kept for
+    `num_slots` consecutive time slots, the oldest being dropped as time
+    passes, so memory does not grow with the request rate.
+    """
+
+    def __init__(self, window, num_slots=60):
+        self.window = window
+        self.num_slots = num_slots
+        self.slot_length = window / num_slots
+        # (slot number, {endpoint: [count, {quantity: Histogram}]}), oldest
+        # first
+        self.slots = collections.deque()
+        self.lock = threading.Lock()
+
+    def expire(self, slot):
+        while self.slots and self.slots[0][0] <= slot - self.num_slots:
+            self.slots.popleft()
+
+    def add(self, endpoint, record):
+        slot = int(record['receive_time'] // self.slot_length)
+        with self.lock:
+            if not self.slots or self.slots[-1][0] < slot:
+                self.slots.append((slot, {}))
+                self.expire(slot)
+            stats = self.slots[-1][1].setdefault(endpoint, [0, {}])
+            stats[0] += 1
+            for quantity, bins in QUANTITY_BINS.items():
+                value = record.get(quantity)
+                if value is not None:
+                    if quantity not in stats[1]:
+                        stats[1][quantity] = Histogram(bins)
+                    stats[1][quantity].add(value)
+
+    def summary(self):
+        """Statistics of the request timings of each endpoint, with the
+        percentiles estimated from the histograms.
+        """
+        now = time.time()
+        merged = {}
+        with self.lock:
+            self.expire(int(now // self.slot_length))
+            for _, endpoints in self.slots:
+                for endpoint, (count, histograms) in endpoints.items():
+                    total = merged.setdefault(endpoint, [0, {}])
+                    total[0] += count
+                    for quantity, histogram in histograms.items():
+                        if quantity not in total[1]:
+                            total[1][quantity] = Histogram(histogram.bins)
+                        total[1][quantity].merge(histogram)
+        endpoints = {}
+        for endpoint, (count, histograms) in sorted(merged.items()):
+            stats = {'count': count, 'rate': count / self.window}
+            for quantity in QUANTITY_BINS:
+                if quantity in histograms:
+                    stats[quantity] = histograms[quantity].summary()
+            endpoints[endpoint] = stats
+        return {
+            'time': now,
+            'window': self.window,
+            'endpoints': endpoints
+        }
+
+
+class FakeGraceDBServer(http.server.ThreadingHTTPServer):
+    """This class inherits from ThreadingHTTPServer and keeps the G events
+    that were uploaded to the server in an EventStore, and the timings of
+    the requests in a RequestStats.
+    """
+    # do not wait for kept-alive connections when shutting down
+    daemon_threads = True
+
+    def __init__(self, name_port, handler, database=':memory:',
+                 performance_window=3600):
         super().__init__(name_port, handler)
-        self.events = []
+        self.store = EventStore(database)
+        self.stats = RequestStats(performance_window)
 
-    def new_event(self):
-        gid = f"G{len(self.events)+1}"
-        self.events.append(gid)
-        logging.info("Created new event %s", gid)
+    def new_event(self, event, filename, content):
+        """Store an uploaded event, given its GraceDB representation and
+        the uploaded file, and return its graceid.
+        """
+        gid = self.store.add_event(event)
+        self.store.add_log(
+            gid,
+            {'comment': 'Original Data', 'created': event['created'],
+             'tag_names': []},
+            filename,
+            content
+        )
+        logging.info(
+            "Created new event %s: %s %s, GPS %.3f, SNR %.2f, "
+            "upload latency %.3f s",
+            gid, event['pipeline'], event['search'], event['gpstime'],
+            event['extra_attributes']['CoincInspiral'].get('snr')
+            or float('nan'),
+            event['reporting_latency']
+        )
         return gid
 
 
 class MyHandler(http.server.BaseHTTPRequestHandler):
-    def send_success(self):
+    # keep connections alive, which requires a Content-Length in every
+    # response
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent separately, which would otherwise wait for
+    # delayed ACKs on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def send_success(self, output, content_type='application/json'):
+        body = output.encode('utf-8') if isinstance(output, str) else output
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
+
+    def parse_request(self):
+        # called as soon as the request line is read
+        self.receive_time = time.time()
+        self.receive_clock = time.perf_counter()
+        self.body_size = None
+        self.decode_time = None
+        self.upload_latency = None
+        return super().parse_request()
+
+    def record_request(self):
+        """Add the timings of the request, which has just been answered, to
+        the performance statistics.
+        """
+        path = urllib.parse.urlsplit(self.path).path
+        self.server.stats.add(endpoint_name(self.command, path), {
+            'receive_time': self.receive_time,
+            'body_size': self.body_size,
+            'decode_time': self.decode_time,
+            'response_time': time.perf_counter() - self.receive_clock,
+            'upload_latency': self.upload_latency
+        })
+
+    def api_url(self, path=''):
+        return (f"http://{self.server.server_name}:"
+                f"{self.server.server_port}/api/{path}")
+
+    def event_links(self, event):
+        gid = event['graceid']
+        event['links'] = {
+            'self': self.api_url(f"events/{gid}"),
+            'log': self.api_url(f"events/{gid}/log/"),
+            'files': self.api_url(f"events/{gid}/files/")
+        }
+        return event
 
     def do_GET(self):
-        """Handle HTTP GET requests. Only /api/ is required.
+        """Handle HTTP GET requests: /api/, event searches, and the events,
+        log entries and files stored by the server.
         """
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        store = self.server.store
         output = None
-        if self.path == "/api/":
+        content_type = 'application/json'
+        if path == "/api/":
             output = self.handle_api()
+        elif path == "/api/performance/":
+            output = json.dumps(self.server.stats.summary())
+        elif path in ["/api/events", "/api/events/"]:
+            query = urllib.parse.parse_qs(url.query).get('query', [''])[0]
+            try:
+                terms = parse_query(query)
+            except ValueError as err:
+                self.send_error(400, f"Invalid query: {err}")
+                self.record_request()
+                return
+            events = [self.event_links(e) for e in store.search(terms)]
+            output = json.dumps({
+                'events': events,
+                'numRows': len(events),
+                'links': {'self': self.api_url("events/")}
+            })
+        elif match := re.fullmatch(r"/api/events/(G\d+)/?", path):
+            event = store.event(match.group(1))
+            if event is not None:
+                output = json.dumps(self.event_links(event))
+        elif match := re.fullmatch(r"/api/events/(G\d+)/logs?/?", path):
+            gid = match.group(1)
+            if store.event(gid) is not None:
+                logs = store.logs(gid)
+                output = json.dumps({
+                    'log': logs,
+                    'numRows': len(logs),
+                    'links': {'self': self.api_url(f"events/{gid}/log/")}
+                })
+        elif match := re.fullmatch(r"/api/events/(G\d+)/logs?/(\d+)/?", path):
+            entry = store.log(match.group(1), int(match.group(2)))
+            if entry is not None:
+                output = json.dumps(entry)
+        elif match := re.fullmatch(r"/api/events/(G\d+)/files/?", path):
+            gid = match.group(1)
+            if store.event(gid) is not None:
+                files = {}
+                for name, version in store.file_versions(gid):
+                    for key in [name, f"{name},{version}"]:
+                        files[key] = self.api_url(f"events/{gid}/files/{key}")
+                output = json.dumps(files)
+        elif match := re.fullmatch(r"/api/events/(G\d+)/files/(.+)", path):
+            output = store.file(match.group(1),
+                                urllib.parse.unquote(match.group(2)))
+            content_type = 'application/octet-stream'
         if output is None:
             self.send_error(404)
         else:
-            self.send_success()
-            self.wfile.write(output.encode('utf-8'))
+            self.send_success(output, content_type)
+        self.record_request()
 
     def do_POST(self):
         """Handle HTTP POST requests. Only event uploads and log entries are
@@ -53,39 +633,74 @@ class MyHandler(http.server.BaseHTTPRequestHandler):
         """
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length)
+        self.body_size = content_length
+        path = urllib.parse.urlsplit(self.path).path
         output = None
-        if self.path == "/api/events/":
+        if path == "/api/events/":
             # Create new event. The POST data is encoded in the complicated
             # "multipart form data" format, which includes the gzipped XML data
-            # in the case of PyCBC Live uploads. This is just logged to stderr
-            # for now, but one could decode the event data for added fun if
-            # wanted.
-            multipart_data = MultipartDecoder(post_data, self.headers['Content-Type'])
-            for part in multipart_data.parts:
-                logging.info('//// Multipart POST data for event upload ////')
-                logging.info(part.headers)
-                logging.info(part.content[:100])
-            gid = self.server.new_event()
+            # in the case of PyCBC Live uploads.
+            decode_start = time.perf_counter()
+            fields = {}
+            filename = content = None
+            for name, part_filename, part_content in parse_form(
+                    post_data, self.headers['Content-Type']):
+                if part_filename is not None:
+                    filename, content = part_filename, part_content
+                elif name == 'labels':
+                    fields.setdefault('labels', []).append(
+                        part_content.decode()
+                    )
+                else:
+                    fields[name] = part_content.decode()
+            try:
+                if content is None:
+                    raise ValueError("no event file")
+                event = decode_event(fields, content, self.receive_time)
+            except (ValueError, KeyError, IndexError, TypeError, EOFError,
+                    OSError, ElementTree.ParseError) as err:
+                logging.warning("Could not decode uploaded event: %r", err)
+                self.send_error(400, f"Could not decode the event: {err!r}")
+                self.record_request()
+                return
+            self.decode_time = time.perf_counter() - decode_start
+            self.upload_latency = event['reporting_latency']
+            gid = self.server.new_event(event, filename, content)
             # We need to return a JSON string with the GraceID for the client
             # to be happy.
             out_data = {
                 "graceid": gid
             }
             output = json.dumps(out_data)
-        elif re.search("/api/events/G.+/log", self.path):
+        elif match := re.fullmatch(r"/api/events/(G\d+)/logs?/?", path):
             # Post a log entry (with an optional file upload).
-            # Nothing happens at the moment.
-            # One could save the content somewhere and actually check things.
-            # We need to return a JSON string for things to work at the client.
-            output = "{}"
+            gid = match.group(1)
+            if self.server.store.event(gid) is not None:
+                decode_start = time.perf_counter()
+                entry = {'comment': '', 'tag_names': [],
+                         'created': utc_now_str()}
+                filename = content = None
+                for name, part_filename, part_content in parse_form(
+                        post_data, self.headers['Content-Type']):
+                    if part_filename is not None:
+                        filename, content = part_filename, part_content
+                    elif name in ['tagname', 'tag_name']:
+                        entry['tag_names'].append(part_content.decode())
+                    elif name == 'comment':
+                        entry['comment'] = part_content.decode()
+                self.decode_time = time.perf_counter() - decode_start
+                entry = self.server.store.add_log(gid, entry, filename,
+                                                  content)
+                entry['self'] = self.api_url(f"events/{gid}/log/{entry['N']}")
+                output = json.dumps(entry)
         if output is None:
             self.send_error(404)
         else:
-            self.send_success()
-            self.wfile.write(output.encode('utf-8'))
+            self.send_success(output)
+        self.record_request()
 
     def handle_api(self):
-        server_url_base = f"http://{self.server.server_name}:{self.server.server_port}/api/"
+        server_url_base = self.api_url()
         api_versions = ["default", "v1", "v2"]
         data = {
             "links": {
@@ -99,6 +714,7 @@ class MyHandler(http.server.BaseHTTPRequestHandler):
                 "event-log-template": server_url_base + "events/{graceid}/log/",
                 "event-log-detail-template": server_url_base + "events/{graceid}/log/{N}",
                 "event-label-template": server_url_base + "events/{graceid}/labels/{label}",
+                "files-template": server_url_base + "events/{graceid}/files/{filename}",
             },
             "groups": [
                 "CBC",
@@ -121,11 +737,25 @@ class MyHandler(http.server.BaseHTTPRequestHandler):
         return json.dumps(data)
 
 
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--port', type=int, default=8000,
+                    help="Port to listen on. Default 8000")
+parser.add_argument('--database', default=':memory:',
+                    help="SQLite file storing the uploaded events, to keep "
+                         "them across runs; events stored by earlier runs "
+                         "are served and graceids continue from them. By "
+                         "default, events are only kept in memory")
+parser.add_argument('--performance-window', type=float, default=3600,
+                    help="Seconds of requests summarized by "
+                         "/api/performance/. Default 3600")
+args = parser.parse_args()
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s %(message)s",
     datefmt="%Y-%m-%dT%H:%M:%S%z"
 )
 
-with FakeGraceDBServer(("", 8000), MyHandler) as httpd:
+with FakeGraceDBServer(("", args.port), MyHandler, args.database,
+                       args.performance_window) as httpd:
     httpd.serve_forever()
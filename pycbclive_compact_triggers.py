@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+"""Merge the many short HDF5 files produced by PyCBC Live (typically one
+per 8 s analysis interval) into a single chunked and compressed HDF5 trigger
+store, typically one per day.
+
+The store can be given to `pycbclive_plot_singles.py`,
+`pycbclive_plot_coincs.py`, `pycbclive_plot_far.py` and
+`pycbclive_plot_psds.py` in place of the original files. Running the tool
+again on the same output appends only the files which are not in the store
+yet, so it can be run periodically during the day.
+
+Layout of the store:
+
+* `files/`: one row per merged input file, with the file `name`,
+  `start_time`, `duration`, `num_live_detectors` (-1 if missing),
+  `command_line_id` (index into `command_lines`, -1 if missing) and
+  `num_triggers/{ifo}`. `files/sorted_index` orders the rows by start time.
+* `command_lines`: the distinct `command_line` attributes, JSON-encoded.
+* `{ifo}/{column}`: the single-detector triggers, concatenated in the same
+  order as the rows of `files/`.
+* `{ifo}/gates`: the gates, one row of (center, width, taper) per gate.
+* `{ifo}/psd`, `{ifo}/psd_time`: one PSD per file, with the `delta_f`
+  attribute of the first merged PSD.
+* `foreground/{file stem}`: a copy of the foreground group of each file
+  containing a candidate, with `num_live_detectors` and `command_line` of
+  the original file as attributes.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import tqdm
+import numpy as np
+import h5py
+
+
+STORE_VERSION = 1
+
+TRIGGER_CHUNK_SIZE = 65536
+
+# number of input files whose content is buffered in memory before writing
+# it to the store, to avoid recompressing partial chunks for every file
+FLUSH_INTERVAL = 256
+
+NON_TRIGGER_DATASETS = {'psd', 'gates'}
+
+
+def create_appendable(group, name, dtype, row_shape=(), chunk_rows=None):
+    """Create an empty, resizable, chunked and compressed dataset."""
+    if chunk_rows is None:
+        chunk_rows = TRIGGER_CHUNK_SIZE
+    return group.create_dataset(
+        name,
+        shape=(0,) + row_shape,
+        maxshape=(None,) + row_shape,
+        dtype=dtype,
+        chunks=(chunk_rows,) + row_shape,
+        compression='gzip',
+        compression_opts=4,
+        shuffle=True
+    )
+
+
+def append_rows(dataset, values):
+    """Append the given rows to a resizable dataset."""
+    values = np.asarray(values, dtype=dataset.dtype)
+    if len(values) == 0:
+        return
+    start = dataset.shape[0]
+    dataset.resize(start + len(values), axis=0)
+    dataset[start:] = values
+
+
+def fill_value(dtype):
+    """Value used for trigger columns missing from an input file."""
+    if np.issubdtype(dtype, np.floating):
+        return np.nan
+    return -1
+
+
+def parse_file_name(fn):
+    """Get the start time and duration from a PyCBC Live file name."""
+    fn_fields = os.path.basename(fn).replace('.hdf', '').split('-')
+    return float(fn_fields[-2]), float(fn_fields[-1])
+
+
+def read_group(grp):
+    """Read all the datasets of an HDF5 group into memory, as a dict
+    {path: (data, attrs)}, plus the attributes of the group itself.
+    """
+    datasets = {}
+
+    def visitor(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            datasets[name] = (obj[()], dict(obj.attrs))
+
+    grp.visititems(visitor)
+    return datasets, dict(grp.attrs)
+
+
+def read_output_file(fn, detectors):
+    """Read everything needed by the store from a PyCBC Live output file.
+    The whole file is read before anything is written to the store, so that
+    a corrupted file cannot leave the store in an inconsistent state.
+    """
+    contents = {'detectors': {}, 'foreground': None}
+    with h5py.File(fn, 'r') as trigfile:
+        contents['num_live_detectors'] = \
+            trigfile.attrs.get('num_live_detectors', -1)
+        contents['command_line'] = trigfile.attrs.get('command_line')
+        for detector in detectors:
+            if detector not in trigfile:
+                continue
+            grp = trigfile[detector]
+            det_contents = {'triggers': {}, 'gates': None, 'psd': None}
+            num_trigs = len(grp['end_time']) if 'end_time' in grp else 0
+            if num_trigs > 0:
+                for name, dset in grp.items():
+                    if isinstance(dset, h5py.Dataset) \
+                            and name not in NON_TRIGGER_DATASETS \
+                            and dset.ndim == 1 \
+                            and len(dset) == num_trigs:
+                        det_contents['triggers'][name] = dset[:]
+            if 'gates' in grp and len(grp['gates']) > 0:
+                det_contents['gates'] = grp['gates'][:]
+            if 'psd' in grp:
+                det_contents['psd'] = (grp['psd'][:], dict(grp['psd'].attrs))
+            contents['detectors'][detector] = det_contents
+        if 'foreground' in trigfile:
+            contents['foreground'] = read_group(trigfile['foreground'])
+    return contents
+
+
+class TriggerStore:
+    """Appends PyCBC Live output files to an (initially empty) trigger store.
+    """
+    def __init__(self, h5file, detectors):
+        self.f = h5file
+        self.detectors = detectors
+        if 'pycbclive_trigger_store' not in self.f.attrs:
+            self._initialize()
+        self.known_files = set(
+            n.decode() if isinstance(n, bytes) else n
+            for n in self.f['files/name'][:]
+        )
+        self.command_lines = [
+            c.decode() if isinstance(c, bytes) else c
+            for c in self.f['command_lines'][:]
+        ]
+        self.warned = set()
+        self.pending = {}
+        self.num_pending_files = 0
+
+    def _initialize(self):
+        self.f.attrs['pycbclive_trigger_store'] = STORE_VERSION
+        str_dtype = h5py.string_dtype(encoding='utf-8')
+        files = self.f.create_group('files')
+        create_appendable(files, 'name', str_dtype, chunk_rows=1024)
+        create_appendable(files, 'start_time', np.float64, chunk_rows=1024)
+        create_appendable(files, 'duration', np.float64, chunk_rows=1024)
+        create_appendable(files, 'num_live_detectors', np.int32,
+                          chunk_rows=1024)
+        create_appendable(files, 'command_line_id', np.int32,
+                          chunk_rows=1024)
+        files.create_dataset('sorted_index', data=np.zeros(0, dtype=np.int64),
+                             maxshape=(None,))
+        files.create_group('num_triggers')
+        create_appendable(self.f, 'command_lines', str_dtype, chunk_rows=16)
+        self.f.create_group('foreground')
+
+    def _warn_once(self, key, message, *args):
+        if key not in self.warned:
+            logging.warning(message, *args)
+            self.warned.add(key)
+
+    def _command_line_id(self, command_line):
+        encoded = json.dumps([
+            c.decode() if isinstance(c, bytes) else str(c)
+            for c in command_line
+        ])
+        if encoded not in self.command_lines:
+            self.command_lines.append(encoded)
+            self._append('command_lines', [encoded])
+        return self.command_lines.index(encoded)
+
+    def _append_triggers(self, detector, triggers):
+        """Append the triggers of one detector and return their number."""
+        if 'end_time' not in triggers:
+            return 0
+        num_trigs = len(triggers['end_time'])
+        store_grp = self.f.require_group(detector)
+        if 'end_time' not in store_grp:
+            # the first file with triggers defines the set of columns
+            for name, values in triggers.items():
+                create_appendable(store_grp, name, values.dtype)
+        for name, store_dset in store_grp.items():
+            if name in NON_TRIGGER_DATASETS or name == 'psd_time':
+                continue
+            if name in triggers:
+                self._append(store_dset.name, triggers[name])
+            else:
+                self._warn_once(
+                    (detector, name),
+                    'Column %s/%s missing from some files, filling it in',
+                    detector, name
+                )
+                self._append(
+                    store_dset.name,
+                    np.full(num_trigs, fill_value(store_dset.dtype))
+                )
+        for name in set(triggers) - set(store_grp.keys()):
+            self._warn_once(
+                (detector, name),
+                'Ignoring column %s/%s, not present in the store',
+                detector, name
+            )
+        return num_trigs
+
+    def _append_psd(self, detector, psd, psd_attrs, start_time):
+        store_grp = self.f.require_group(detector)
+        if 'psd' not in store_grp:
+            dset = create_appendable(store_grp, 'psd', psd.dtype,
+                                     row_shape=psd.shape, chunk_rows=16)
+            for key, value in psd_attrs.items():
+                dset.attrs[key] = value
+            create_appendable(store_grp, 'psd_time', np.float64,
+                              chunk_rows=1024)
+        if store_grp['psd'].shape[1:] != psd.shape:
+            self._warn_once(
+                (detector, 'psd'),
+                'PSD length for %s changed, ignoring non-matching PSDs',
+                detector
+            )
+            return
+        self._append(f'{detector}/psd', psd[np.newaxis])
+        self._append(f'{detector}/psd_time', [start_time])
+
+    def _append_foreground(self, stem, foreground, contents, start_time):
+        datasets, attrs = foreground
+        if stem in self.f['foreground']:
+            # left over by an interrupted earlier run
+            del self.f['foreground'][stem]
+        cand = self.f['foreground'].create_group(stem)
+        for key, value in attrs.items():
+            cand.attrs[key] = value
+        for path, (data, dset_attrs) in datasets.items():
+            dset = cand.create_dataset(path, data=data)
+            for key, value in dset_attrs.items():
+                dset.attrs[key] = value
+        cand.attrs['num_live_detectors'] = contents['num_live_detectors']
+        cand.attrs['start_time'] = start_time
+        if contents['command_line'] is not None:
+            cand.attrs['command_line'] = contents['command_line']
+
+    def append_file(self, fn):
+        """Append the content of a PyCBC Live output file to the store.
+        Returns False if the file is already in the store.
+        """
+        name = os.path.basename(fn)
+        if name in self.known_files:
+            return False
+        start_time, duration = parse_file_name(fn)
+        contents = read_output_file(fn, self.detectors)
+
+        if contents['command_line'] is not None:
+            command_line_id = self._command_line_id(contents['command_line'])
+        else:
+            command_line_id = -1
+
+        num_triggers = {}
+        for detector in self.detectors:
+            num_trigs = 0
+            det_contents = contents['detectors'].get(detector)
+            if det_contents is not None:
+                num_trigs = self._append_triggers(
+                    detector, det_contents['triggers']
+                )
+                if det_contents['gates'] is not None:
+                    store_grp = self.f.require_group(detector)
+                    if 'gates' not in store_grp:
+                        create_appendable(store_grp, 'gates', np.float64,
+                                          row_shape=(3,), chunk_rows=1024)
+                    self._append(f'{detector}/gates', det_contents['gates'])
+                if det_contents['psd'] is not None:
+                    self._append_psd(detector, *det_contents['psd'],
+                                     start_time)
+            num_triggers[detector] = num_trigs
+        # keep one row per file for every detector ever stored; detectors
+        # missing from earlier runs get zeros for the earlier files
+        counts_grp = self.f['files/num_triggers']
+        for detector in sorted(set(counts_grp) | set(num_triggers)):
+            if detector not in counts_grp:
+                create_appendable(counts_grp, detector, np.int64,
+                                  chunk_rows=1024)
+                self._append(f'files/num_triggers/{detector}',
+                             np.zeros(len(self.known_files), dtype=np.int64))
+            self._append(f'files/num_triggers/{detector}',
+                         [num_triggers.get(detector, 0)])
+
+        if contents['foreground'] is not None:
+            self._append_foreground(name.replace('.hdf', ''),
+                                    contents['foreground'], contents,
+                                    start_time)
+
+        self._append('files/name', [name])
+        self._append('files/start_time', [start_time])
+        self._append('files/duration', [duration])
+        self._append('files/num_live_detectors',
+                     [contents['num_live_detectors']])
+        self._append('files/command_line_id', [command_line_id])
+        self.known_files.add(name)
+        self.num_pending_files += 1
+        if self.num_pending_files >= FLUSH_INTERVAL:
+            self.flush()
+        return True
+
+    def _append(self, path, values):
+        """Queue rows to be appended to a dataset of the store."""
+        self.pending.setdefault(path, []).append(values)
+
+    def flush(self):
+        """Write all the queued rows to the store."""
+        for path, chunks in self.pending.items():
+            dataset = self.f[path]
+            append_rows(dataset, np.concatenate([
+                np.asarray(c, dtype=dataset.dtype) for c in chunks
+            ]))
+        self.pending = {}
+        self.num_pending_files = 0
+
+    def update_index(self):
+        """Write any queued rows and rewrite the index sorting the files by
+        start time.
+        """
+        self.flush()
+        sorter = np.argsort(self.f['files/start_time'][:], kind='stable')
+        index = self.f['files/sorted_index']
+        index.resize(len(sorter), axis=0)
+        index[:] = sorter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--trigger-files-glob',
+        type=str,
+        required=True,
+        metavar='PATH',
+        help='Glob command to find the PyCBC Live HDF5 files to merge, '
+             'typically those of a single day. Must have the wildcards '
+             'escaped, using a backslash, or surrounding the argument '
+             'in quotes'
+    )
+    parser.add_argument(
+        '--detectors',
+        type=str,
+        nargs='+',
+        default=['H1', 'L1', 'V1'],
+        help='Which detectors to store'
+    )
+    parser.add_argument(
+        '--output-file',
+        type=str,
+        required=True,
+        help='Path to the trigger store. If it exists, new files are '
+             'appended to it'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
+    )
+
+    trigger_files = sorted(glob.glob(args.trigger_files_glob))
+    output_file = os.path.abspath(args.output_file)
+    trigger_files = [
+        fn for fn in trigger_files if os.path.abspath(fn) != output_file
+    ]
+
+    out_dir = os.path.dirname(output_file)
+    os.makedirs(out_dir, exist_ok=True)
+    with h5py.File(output_file, 'a') as store_file:
+        if len(store_file.keys()) > 0 \
+                and 'pycbclive_trigger_store' not in store_file.attrs:
+            parser.error(f'{args.output_file} exists and is not a trigger '
+                         'store, refusing to modify it')
+        store = TriggerStore(store_file, args.detectors)
+        new_files = [
+            fn for fn in trigger_files
+            if os.path.basename(fn) not in store.known_files
+        ]
+        logging.info('%d files found, %d not in the store yet',
+                     len(trigger_files), len(new_files))
+        num_added = 0
+        try:
+            for fn in tqdm.tqdm(new_files):
+                try:
+                    num_added += store.append_file(fn)
+                except OSError:
+                    logging.error('Failed reading %s, ignoring', fn)
+        finally:
+            store.update_index()
+
+    logging.info('Added %d files', num_added)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,70 +1,279 @@
 #!/usr/bin/env python
 
-"""Read the duty factors from a PyCBC Live log and show some stats about them."""
+"""Read the duty factors from PyCBC Live logs and show some stats about them.
+
+Duty factors are accumulated, for each rank, into a histogram with
+logarithmic bins, which gives quantiles with a bounded relative error using
+a fixed amount of memory however many logs are read. These histograms can be
+saved and merged with the ones from later runs.
+"""
 
 import argparse
+import glob
+import logging
 import numpy as np
+import h5py
+import matplotlib
+matplotlib.use('agg')
 import matplotlib.pyplot as pp
 
+from pycbclive_logs import LogFollower, LogParser
+
 
-def plot_cdf_nicely(x, **kwa):
-    """A nicer version of pp.hist([...] cumulative=-1): it does not bin and
-    does not plot a spurious vertical line at the lowest sample.
+class DutyFactorSketch:
+    """Histograms of duty factors, one per rank, with logarithmic bins whose
+    width makes the quantiles accurate to the given relative error.
+    Duty factors below `min_value` or above `max_value` are counted in the
+    first or last bin respectively. Sketches with the same bins can be merged
+    by adding their histograms.
     """
-    sorter = np.argsort(x)
-    fraction = np.arange(len(x))[::-1] / len(x)
-    pp.step(np.array(x)[sorter], fraction, **kwa)
-
-
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('--input-log', required=True)
-parser.add_argument('--out-plot')
-args = parser.parse_args()
-
-duty_factors = {}
-
-with open(args.input_log, 'r') as lf:
-    for line in lf:
-        if 'Took' not in line:
-            continue
-        pieces = line.split()
-        rank = int(pieces[3])
-        duty_factor = float(pieces[9].replace(',', ''))
-        if rank not in duty_factors:
-            duty_factors[rank] = []
-        duty_factors[rank].append(duty_factor)
-
-print('Duty factors:')
-for rank in sorted(duty_factors):
-    print('{:04d}: {:d} samples, median {:.2f}, 90th percentile {:.2f}'.format(
-        rank,
-        len(duty_factors[rank]),
-        np.median(duty_factors[rank]),
-        np.percentile(duty_factors[rank], 90)
-    ))
 
-if args.out_plot is not None:
-    df_max = 0
-    df_min = np.inf
-    for rank in sorted(duty_factors):
-        color = pp.cm.viridis(rank / max(duty_factors))
-        lw = 2 if rank == 0 else 0.5
-        plot_cdf_nicely(duty_factors[rank], color=color, lw=lw)
-        df_max = max(df_max, max(duty_factors[rank]))
-        df_min = min(df_min, min(duty_factors[rank]))
-
-    pp.axvspan(
-        1, df_max, hatch='/', facecolor='none', edgecolor='gray'
+    def __init__(self, relative_accuracy=0.01, min_value=1e-3, max_value=1e3):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.num_bins = int(
+            np.ceil(np.log(max_value / min_value) / np.log(self.gamma))
+        ) + 1
+        # rank -> counts per bin
+        self.counts = {}
+        # rank -> [min, max]
+        self.extremes = {}
+
+    def add(self, ranks, values):
+        """Add the given duty factors, measured by the given ranks."""
+        values = np.asarray(values, dtype=float)
+        ranks = np.asarray(ranks)
+        bins = np.log(np.clip(values, self.min_value, self.max_value)
+                      / self.min_value) / np.log(self.gamma)
+        bins = np.clip(np.ceil(bins).astype(int), 0, self.num_bins - 1)
+        for rank in np.unique(ranks):
+            sel = ranks == rank
+            rank = int(rank)
+            counts = np.bincount(bins[sel], minlength=self.num_bins)
+            extremes = [values[sel].min(), values[sel].max()]
+            self._add_counts(rank, counts, extremes)
+
+    def _add_counts(self, rank, counts, extremes):
+        if rank in self.counts:
+            self.counts[rank] += counts
+            extremes = [
+                min(self.extremes[rank][0], extremes[0]),
+                max(self.extremes[rank][1], extremes[1])
+            ]
+        else:
+            self.counts[rank] = counts.astype(np.int64)
+        self.extremes[rank] = extremes
+
+    def bin_values(self):
+        """Representative duty factor of each bin."""
+        index = np.arange(self.num_bins)
+        return self.min_value * 2 * self.gamma ** index / (self.gamma + 1)
+
+    def num_samples(self, rank):
+        return int(self.counts[rank].sum())
+
+    def quantile(self, rank, q):
+        """Duty factor at the given quantile for the given rank, or over all
+        ranks if `rank` is None.
+        """
+        counts = self.total_counts() if rank is None else self.counts[rank]
+        cum = np.cumsum(counts)
+        index = np.searchsorted(cum, q * (cum[-1] - 1), side='right')
+        value = self.bin_values()[index]
+        if rank is not None:
+            # the extremes are known exactly
+            value = np.clip(value, *self.extremes[rank])
+        return value
+
+    def fraction_above(self, rank, value):
+        """Fraction of the duty factors of the given rank falling in bins
+        above the bin of `value`.
+        """
+        index = np.searchsorted(self.bin_values(), value, side='right')
+        counts = self.counts[rank]
+        return counts[index:].sum() / counts.sum()
+
+    def total_counts(self, ranks=None):
+        ranks = self.counts if ranks is None else ranks
+        return sum(self.counts[rank] for rank in ranks)
+
+    def merge(self, other):
+        """Add the histograms of another sketch with the same bins."""
+        if (other.relative_accuracy, other.min_value, other.max_value) != \
+                (self.relative_accuracy, self.min_value, self.max_value):
+            raise ValueError('Cannot merge sketches with different bins')
+        for rank in other.counts:
+            self._add_counts(rank, other.counts[rank], other.extremes[rank])
+
+    def save(self, path):
+        ranks = sorted(self.counts)
+        with h5py.File(path, 'w') as f:
+            f.attrs['relative_accuracy'] = self.relative_accuracy
+            f.attrs['min_value'] = self.min_value
+            f.attrs['max_value'] = self.max_value
+            f['ranks'] = np.array(ranks, dtype=np.int32)
+            f.create_dataset(
+                'counts',
+                data=np.array([self.counts[r] for r in ranks]).reshape(
+                    len(ranks), self.num_bins
+                ),
+                compression='gzip',
+                shuffle=True
+            )
+            f['extremes'] = np.array(
+                [self.extremes[r] for r in ranks]
+            ).reshape(len(ranks), 2)
+
+    @classmethod
+    def load(cls, path):
+        with h5py.File(path, 'r') as f:
+            sketch = cls(
+                f.attrs['relative_accuracy'],
+                f.attrs['min_value'],
+                f.attrs['max_value']
+            )
+            for rank, counts, extremes in zip(
+                    f['ranks'][:], f['counts'][:], f['extremes'][:]):
+                sketch._add_counts(int(rank), counts, list(extremes))
+        return sketch
+
+
+def plot_cdf_nicely(values, counts, **kwa):
+    """A nicer version of pp.hist([...] cumulative=-1) for histogrammed
+    samples: it does not plot a spurious vertical line at the lowest sample.
+    """
+    keep = counts > 0
+    fraction = 1 - np.cumsum(counts[keep]) / counts.sum()
+    pp.step(values[keep], fraction, where='post', **kwa)
+
+
+def read_logs(patterns, sketch):
+    """Stream the duty factors of the logs matching the given glob
+    expressions into the sketch.
+    """
+    log_parser = LogParser(classes=['took'])
+    for text in LogFollower(patterns).read_new_text():
+        columns = log_parser.parse_text(text)
+        sketch.add(columns['rank'], columns['duty_factor'])
+    log_parser.log_counts()
+
+
+def find_stragglers(sketch, threshold):
+    """Return the ranks other than 0 whose duty factors exceed the median
+    duty factor of all ranks other than 0 in more than the given fraction of
+    cases, together with that fraction.
+    """
+    workers = [rank for rank in sketch.counts if rank != 0]
+    if len(workers) < 2:
+        return {}
+    cum = np.cumsum(sketch.total_counts(workers))
+    median = sketch.bin_values()[
+        np.searchsorted(cum, 0.5 * (cum[-1] - 1), side='right')
+    ]
+    fractions = {rank: sketch.fraction_above(rank, median) for rank in workers}
+    return {
+        rank: fraction for rank, fraction in fractions.items()
+        if fraction > threshold
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input-logs', '--input-log', nargs='+', default=[],
+                        help='Paths or glob expressions of the PyCBC Live '
+                             'logs to read')
+    parser.add_argument('--input-sketches', nargs='+', default=[],
+                        help='Paths or glob expressions of files saved by '
+                             'earlier runs with --output-sketch, to be '
+                             'merged with the logs')
+    parser.add_argument('--output-sketch',
+                        help='Save the merged histograms to this file')
+    parser.add_argument('--relative-accuracy', type=float, default=0.01,
+                        help='Relative accuracy of the quantiles, default '
+                             '0.01. Ignored when merging saved sketches, '
+                             'which must all have the same accuracy')
+    parser.add_argument('--straggler-threshold', type=float, default=0.75,
+                        help='Flag the ranks whose duty factor is above the '
+                             'median of all ranks more than this fraction '
+                             'of the time, default 0.75')
+    parser.add_argument('--out-plot')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
     )
-    pp.xscale('log')
-    pp.xlim(max(df_min, 0.1), df_max)
-    pp.ylim(0, 1)
-    pp.xlabel('Duty factor')
-    pp.ylabel('Cumulative fraction')
-    pp.title('Median at rank 0: {:.2f} {}'.format(
-        np.median(duty_factors[0]),
-        '\N{CHECK MARK}' if np.median(duty_factors[0]) < 1 else '\N{WARNING SIGN}'
+
+    sketch_paths = sorted(set(
+        path for pattern in args.input_sketches for path in glob.glob(pattern)
     ))
+    if not sketch_paths and not args.input_logs:
+        parser.error('no logs or sketches to read')
+
+    sketch = None
+    for path in sketch_paths:
+        logging.info('Merging %s', path)
+        if sketch is None:
+            sketch = DutyFactorSketch.load(path)
+        else:
+            sketch.merge(DutyFactorSketch.load(path))
+    if sketch is None:
+        sketch = DutyFactorSketch(args.relative_accuracy)
+    read_logs(args.input_logs, sketch)
+
+    if args.output_sketch is not None:
+        logging.info('Saving sketch to %s', args.output_sketch)
+        sketch.save(args.output_sketch)
+
+    print('Duty factors:')
+    for rank in sorted(sketch.counts):
+        print('{:04d}: {:d} samples, median {:.2f}, 90th percentile {:.2f}'.format(
+            rank,
+            sketch.num_samples(rank),
+            sketch.quantile(rank, 0.5),
+            sketch.quantile(rank, 0.9)
+        ))
+
+    stragglers = find_stragglers(sketch, args.straggler_threshold)
+    if stragglers:
+        print('Straggler ranks:')
+        for rank in sorted(stragglers):
+            print('{:04d}: above the median of all ranks {:.0%} of the '
+                  'time'.format(rank, stragglers[rank]))
+
+    if args.out_plot is not None:
+        values = sketch.bin_values()
+        df_max = max(e[1] for e in sketch.extremes.values())
+        df_min = min(e[0] for e in sketch.extremes.values())
+        max_rank = max(max(sketch.counts), 1)
+        for rank in sorted(sketch.counts):
+            color = pp.cm.viridis(rank / max_rank)
+            lw = 2 if rank == 0 else 0.5
+            ls = '--' if rank in stragglers else '-'
+            plot_cdf_nicely(values, sketch.counts[rank], color=color, lw=lw,
+                            ls=ls)
+
+        pp.axvspan(
+            1, df_max, hatch='/', facecolor='none', edgecolor='gray'
+        )
+        pp.xscale('log')
+        pp.xlim(max(df_min, 0.1), df_max)
+        pp.ylim(0, 1)
+        pp.xlabel('Duty factor')
+        pp.ylabel('Cumulative fraction')
+        if 0 in sketch.counts:
+            median = sketch.quantile(0, 0.5)
+            pp.title('Median at rank 0: {:.2f} {}'.format(
+                median,
+                '\N{CHECK MARK}' if median < 1 else '\N{WARNING SIGN}'
+            ))
+
+        pp.tight_layout()
+        pp.savefig(args.out_plot, dpi=200)
+
 
-    pp.tight_layout()
-    pp.savefig(args.out_plot, dpi=200)
+if __name__ == '__main__':
+    main()
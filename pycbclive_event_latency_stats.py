@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+"""
+Latency statistics of the GraceDB events of many superevents, per pipeline
+and search: reporting latency, delays of the log comments and file uploads
+after the event time, and premerger time of early warning events.
+
+The superevents are given as a GPS time range or a list of IDs. Their events
+and logs are fetched concurrently and cached (see pycbclive_gracedb.py). The
+results are written to an HDF5 file with one dataset per column, and shown
+as CDF and percentile plots.
+"""
+
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import h5py
+import matplotlib
+matplotlib.use('agg')
+from matplotlib import pyplot as plt
+
+from pycbc.waveform.spa_tmplt import spa_length_in_time
+from pycbc import init_logging
+
+from pycbclive_gpstime import iso_to_gps
+from pycbclive_gracedb import DEFAULT_CACHE_PATH, GraceDBCache, ThreadClients
+
+
+# Same as pycbclive_plot_event_latency.py
+pipelinecolours = {
+    'cwb':     '#AA4499',
+    'gstlal':  '#F0E442',
+    'mbta':    '#D55E00',
+    'pycbc':   '#56B4E9',
+    'spiir':   '#009E73',
+}
+
+pipelinenames = {
+    'cwb':     'cWB',
+    'gstlal':  'GstLAL',
+    'mbta':    'MBTA',
+    'pycbc':   'PyCBC',
+    'spiir':   'SPIIR',
+}
+
+searchlinestyles = {
+    'AllSky': '-',
+    'LowMass': '-.',
+    'EarlyWarning': '--',
+}
+
+# quantity name, label
+QUANTITIES = [
+    ('reporting_latency', 'Reporting latency'),
+    ('first_comment_delay', 'First comment'),
+    ('first_file_delay', 'First file upload'),
+    ('last_log_delay', 'Last log entry'),
+]
+
+PERCENTILES = [10, 50, 90, 99]
+
+parser = argparse.ArgumentParser(description=__doc__)
+playground_server = 'https://gracedb-playground.ligo.org/api/'
+parser.add_argument('--gracedb-server', default=playground_server,
+                    help="Server of the gracedb instance to use. "
+                         "Default = playground server")
+parser.add_argument('--gps-start', type=float,
+                    help="Use the superevents from this GPS time")
+parser.add_argument('--gps-end', type=float,
+                    help="Use the superevents up to this GPS time")
+parser.add_argument('--superevent-ids', nargs='+',
+                    help="IDs of the superevents to use, instead of a time "
+                         "range. An argument starting with @ is the path "
+                         "of a file listing IDs, one per line")
+parser.add_argument('--output-file', required=True,
+                    help="HDF5 file to write the table of events into")
+parser.add_argument('--output-dir', default=os.getcwd(),
+                    help="Directory to output the plots into. "
+                         "Default = current directory")
+parser.add_argument('--latency-limit', type=float, default=300,
+                    help="Upper limit of the latency axes (seconds). "
+                         "Default=300")
+parser.add_argument("--max-workers", type=int, default=8,
+                    help="Maximum number of concurrent requests to GraceDB. "
+                         "Default 8")
+parser.add_argument("--retries", type=int, default=5,
+                    help="Number of times a failed request to GraceDB is "
+                         "retried. Default 5")
+parser.add_argument("--retry-backoff", type=float, default=0.5,
+                    help="Backoff factor (seconds) of the retries. "
+                         "Default 0.5")
+parser.add_argument("--cache-file", default=DEFAULT_CACHE_PATH,
+                    help="SQLite file caching the responses of GraceDB. "
+                         f"Default {DEFAULT_CACHE_PATH}")
+parser.add_argument("--cache-ttl", type=float, default=3600,
+                    help="Superevents, searches and logs cached less than "
+                         "this many seconds ago are not fetched again. "
+                         "Default 3600")
+parser.add_argument("--offline", action='store_true',
+                    help="Do not contact GraceDB, take everything from the "
+                         "cache")
+parser.add_argument("--verbose", action='store_true',
+                    help="Print logging statements")
+args = parser.parse_args()
+
+init_logging(args.verbose)
+
+if (args.superevent_ids is None) == (args.gps_start is None):
+    parser.error("Either --superevent-ids or --gps-start/--gps-end must be "
+                 "given, but not both")
+if (args.gps_start is None) != (args.gps_end is None):
+    parser.error("--gps-start and --gps-end must be given together")
+
+
+def read_ids(ids):
+    """Expand the arguments starting with @ into the IDs listed in the
+    corresponding file.
+    """
+    result = []
+    for arg in ids:
+        if arg.startswith('@'):
+            with open(arg[1:]) as id_file:
+                result += [line.strip() for line in id_file if line.strip()]
+        else:
+            result.append(arg)
+    return result
+
+
+def premerger_times(events):
+    """Time between the end of the template and the merger, for a list of
+    events. Zero for events which are not early warning candidates.
+    """
+    sngls = []
+    for event in events:
+        for sngl in event['extra_attributes'].get('SingleInspiral', []):
+            if 'f_final' in sngl:
+                sngls.append(sngl)
+                break
+        else:
+            sngls.append(None)
+    early = np.array([s is not None for s in sngls], dtype=bool)
+    result = np.zeros(len(events))
+    # spa_length_in_time only takes scalar masses
+    result[early] = [
+        spa_length_in_time(mass1=s['mass1'], mass2=s['mass2'],
+                           f_lower=s['f_final'], phase_order=-1)
+        for s in sngls if s is not None
+    ]
+    return result
+
+
+def log_delays(logs, event_time):
+    """Delays of the comments and file uploads in the given log entries
+    after the event time, ignoring the original upload and creation.
+    """
+    logs = [log for log in logs
+            if not any(substr in log['comment']
+                       for substr in ["Original", "Created"])]
+    if not logs:
+        return np.array([]), np.array([])
+    # created is like "2023-05-24 12:00:07 UTC"
+    times = iso_to_gps([log['created'][:19] for log in logs]) - event_time
+    is_file = np.array([log['filename'] != '' for log in logs])
+    return times[~is_file], times[is_file]
+
+
+def event_rows(events, all_logs, superevent_ids, preferred):
+    """Build the columns of the table, one row per event."""
+    num = len(events)
+    columns = {
+        'superevent_id': np.array(superevent_ids, dtype='S'),
+        'graceid': np.array([e['graceid'] for e in events], dtype='S'),
+        'pipeline': np.array([e['pipeline'].lower() for e in events],
+                             dtype='S'),
+        'search': np.array([e['search'] for e in events], dtype='S'),
+        'group': np.array([e['group'] for e in events], dtype='S'),
+        'preferred': np.array(preferred, dtype=bool),
+        'gpstime': np.array([e['gpstime'] for e in events], dtype=float),
+        'snr': np.array([
+            e['extra_attributes'].get('CoincInspiral', {}).get('snr', np.nan)
+            for e in events
+        ], dtype=float),
+        'reporting_latency': np.array(
+            [e['reporting_latency'] for e in events], dtype=float
+        ),
+        'premerger_time': premerger_times(events),
+    }
+    for name in ['num_comments', 'num_files']:
+        columns[name] = np.zeros(num, dtype=np.int32)
+    for name in ['first_comment_delay', 'first_file_delay', 'last_log_delay']:
+        columns[name] = np.full(num, np.nan)
+    for i, (event, logs) in enumerate(zip(events, all_logs)):
+        comments, files = log_delays(logs, event['gpstime'])
+        columns['num_comments'][i] = len(comments)
+        columns['num_files'][i] = len(files)
+        if len(comments):
+            columns['first_comment_delay'][i] = comments.min()
+        if len(files):
+            columns['first_file_delay'][i] = files.min()
+        if len(comments) or len(files):
+            columns['last_log_delay'][i] = np.concatenate([comments, files]) \
+                .max()
+    return columns
+
+
+def groups(columns):
+    """Yield the (pipeline, search) pairs present in the table, with the
+    mask selecting their rows.
+    """
+    pairs = sorted(set(zip(columns['pipeline'], columns['search'])))
+    for pipeline, search in pairs:
+        mask = (columns['pipeline'] == pipeline) \
+            & (columns['search'] == search)
+        yield pipeline.decode(), search.decode(), mask
+
+
+def plot_cdfs(columns, path):
+    fig, axes = plt.subplots(1, len(QUANTITIES), sharey=True,
+                             figsize=(4 * len(QUANTITIES), 4.5))
+    for ax, (quantity, label) in zip(axes, QUANTITIES):
+        for pipeline, search, mask in groups(columns):
+            values = np.sort(columns[quantity][mask])
+            values = values[np.isfinite(values)]
+            if len(values) == 0:
+                continue
+            fraction = np.arange(len(values) + 1) / len(values)
+            ax.step(np.append(values[0], values), fraction, where='post',
+                    color=pipelinecolours.get(pipeline, 'k'),
+                    linestyle=searchlinestyles.get(search, ':'),
+                    label=f"{pipelinenames.get(pipeline, pipeline)} "
+                          f"{search} ({len(values)})")
+        ax.set_xlim(0, args.latency_limit)
+        ax.set_xlabel(f"{label} [s]")
+        ax.grid(visible=True, which='major', linestyle='--')
+    axes[0].set_ylim(0, 1)
+    axes[0].set_ylabel("Cumulative fraction of events")
+    axes[-1].legend(loc='lower right', fontsize='small')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def plot_percentiles(columns, path):
+    group_list = list(groups(columns))
+    fig, axes = plt.subplots(len(QUANTITIES), 1, sharex=True,
+                             figsize=(max(6, 0.8 * len(group_list) + 2),
+                                      2.5 * len(QUANTITIES)))
+    positions = np.arange(len(group_list))
+    for ax, (quantity, label) in zip(axes, QUANTITIES):
+        for pos, (pipeline, search, mask) in zip(positions, group_list):
+            values = columns[quantity][mask]
+            values = values[np.isfinite(values)]
+            if len(values) == 0:
+                continue
+            pcts = dict(zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+            color = pipelinecolours.get(pipeline, 'k')
+            ax.plot([pos, pos], [pcts[10], pcts[90]], color=color, lw=6,
+                    solid_capstyle='butt')
+            ax.scatter([pos], [pcts[50]], color='k', marker='_', s=200,
+                       zorder=10)
+            ax.scatter([pos], [pcts[99]], color=color, marker='v', zorder=10)
+        ax.set_ylabel(f"{label} [s]")
+        ax.set_ylim(bottom=0)
+        ax.grid(visible=True, which='major', axis='y', linestyle='--')
+    axes[0].set_title("10th-90th percentile (bar), median (line), "
+                      "99th percentile (triangle)")
+    axes[-1].set_xticks(positions)
+    axes[-1].set_xticklabels(
+        [f"{pipelinenames.get(p, p)}\n{s}" for p, s, _ in group_list],
+        fontsize='small'
+    )
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+get_client = None
+if not args.offline:
+    get_client = ThreadClients(args.gracedb_server, args.retries,
+                               args.retry_backoff)
+cache = GraceDBCache(args.cache_file, args.gracedb_server, get_client,
+                     ttl=args.cache_ttl, offline=args.offline)
+
+fetch_start = time.perf_counter()
+with ThreadPoolExecutor(max_workers=args.max_workers) as pool:
+    if args.superevent_ids:
+        superevents = list(pool.map(cache.superevent,
+                                    read_ids(args.superevent_ids)))
+    else:
+        superevents = cache.superevents(f"{args.gps_start} .. {args.gps_end}")
+    logging.info(f"Found {len(superevents)} superevents")
+
+    superevent_ids = []
+    preferred = []
+    gevent_list = []
+    for superevent in superevents:
+        for g in superevent['gw_events']:
+            superevent_ids.append(superevent['superevent_id'])
+            preferred.append(g == superevent['preferred_event'])
+            gevent_list.append(g)
+    logging.info(f"Fetching {len(gevent_list)} events and their logs")
+    events = list(pool.map(cache.event, gevent_list))
+    all_logs = list(pool.map(cache.logs, gevent_list))
+cache.close()
+logging.info(f"Fetched all events and logs in "
+             f"{time.perf_counter() - fetch_start:.2f} s")
+
+columns = event_rows(events, all_logs, superevent_ids, preferred)
+
+logging.info(f"Writing {args.output_file}")
+with h5py.File(args.output_file, 'w') as out_f:
+    for name, values in columns.items():
+        out_f.create_dataset(name, data=values, compression='gzip',
+                             shuffle=True)
+    out_f.attrs['gracedb_server'] = args.gracedb_server
+
+for pipeline, search, mask in groups(columns):
+    values = columns['reporting_latency'][mask]
+    pcts = np.percentile(values, PERCENTILES)
+    logging.info(f"{pipeline} {search}: {mask.sum()} events, reporting "
+                 "latency percentiles " + ", ".join(
+                     f"{p}%: {v:.1f} s" for p, v in zip(PERCENTILES, pcts)
+                 ))
+
+logging.info("Plotting")
+plot_cdfs(columns, os.path.join(args.output_dir, "latency_cdfs.png"))
+plot_percentiles(columns,
+                 os.path.join(args.output_dir, "latency_percentiles.png"))
+
+logging.info('Done')
@@ -0,0 +1,236 @@
+"""Helpers for querying GraceDB from the PyCBC Live utilities: clients with
+retries and pooled connections, one per thread, and a local SQLite cache of
+the responses.
+
+The cache is keyed by server, endpoint and ID. Events do not change once
+uploaded, so they are always served from the cache. Superevents, searches
+and logs can change and are fetched again when older than the TTL. In
+offline mode, everything is served from the cache. Entries unused for a
+long time, or the least recently used ones when the cache is too large, are
+evicted when the cache is closed.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ligo.gracedb.rest import GraceDb
+
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'pycbclive',
+    'gracedb.sqlite'
+)
+
+
+def make_client(server, retries=5, backoff=0.5):
+    """Make a GraceDB client whose connections are kept alive and reused,
+    and which retries failed requests with exponential backoff.
+    """
+    client = GraceDb(service_url=server)
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1,
+                          max_retries=retry)
+    client.mount('https://', adapter)
+    client.mount('http://', adapter)
+    return client
+
+
+class ThreadClients:
+    """Give each thread its own GraceDB client, and thus its own connection
+    pool, as requests sessions are not thread-safe.
+    """
+
+    def __init__(self, server, retries=5, backoff=0.5):
+        self.server = server
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+
+    def __call__(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = make_client(
+                self.server, self.retries, self.backoff
+            )
+        return self.local.client
+
+
+class CacheMiss(Exception):
+    """Raised in offline mode when a response is not in the cache."""
+
+
+class GraceDBCache:
+    """Cache of GraceDB responses in an SQLite file, shared by threads.
+
+    `get_client` is called, in the thread making a request, to get the
+    client to use; it can be None in offline mode. Changeable responses are
+    reused without contacting GraceDB if younger than `ttl` seconds.
+    Entries unused for `max_age` seconds are evicted, as well as the least
+    recently used ones beyond a total of `max_size` bytes.
+    """
+
+    def __init__(self, path, server, get_client=None, ttl=300,
+                 max_age=30 * 86400, max_size=200 * 2 ** 20, offline=False):
+        if not offline and get_client is None:
+            raise ValueError('A client is needed unless offline')
+        self.server = server
+        self.get_client = get_client
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_size = max_size
+        self.offline = offline
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # avoid syncing to disk at every commit
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'server TEXT, endpoint TEXT, key TEXT, data TEXT, '
+            'fetched REAL, last_used REAL, size INTEGER, '
+            'PRIMARY KEY (server, endpoint, key))'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_last_used '
+            'ON responses (last_used)'
+        )
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def _get(self, endpoint, key):
+        """Return the cached data and its age in seconds, or (None, None)."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data, fetched FROM responses '
+                'WHERE server = ? AND endpoint = ? AND key = ?',
+                (self.server, endpoint, key)
+            ).fetchone()
+            if row is None:
+                return None, None
+            self.db.execute(
+                'UPDATE responses SET last_used = ? '
+                'WHERE server = ? AND endpoint = ? AND key = ?',
+                (now, self.server, endpoint, key)
+            )
+            self.db.commit()
+        return json.loads(row[0]), now - row[1]
+
+    def _put(self, endpoint, key, data):
+        text = json.dumps(data)
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.server, endpoint, key, text, now, now, len(text))
+            )
+            self.db.commit()
+
+    def _fetch(self, endpoint, key, fetch, mutable):
+        data, age = self._get(endpoint, key)
+        if data is not None and (self.offline or not mutable
+                                 or age < self.ttl):
+            return data
+        if self.offline:
+            raise CacheMiss(f'{endpoint} {key} is not cached')
+        data = fetch(self.get_client())
+        self._put(endpoint, key, data)
+        return data
+
+    def event(self, graceid):
+        return self._fetch(
+            'event', graceid, lambda c: c.event(graceid).json(), False
+        )
+
+    def superevent(self, superevent_id):
+        return self._fetch(
+            'superevent', superevent_id,
+            lambda c: c.superevent(superevent_id).json(), True
+        )
+
+    def events(self, query):
+        """Result of an event search, as a list of events, which are also
+        cached individually.
+        """
+        def fetch(client):
+            events = list(client.events(query=query))
+            for event in events:
+                self._put('event', event['graceid'], event)
+            return events
+
+        return self._fetch('events', query, fetch, True)
+
+    def superevents(self, query):
+        """Result of a superevent search, as a list of superevents, which
+        are also cached individually.
+        """
+        def fetch(client):
+            superevents = list(client.superevents(query=query))
+            for superevent in superevents:
+                self._put('superevent', superevent['superevent_id'],
+                          superevent)
+            return superevents
+
+        return self._fetch('superevents', query, fetch, True)
+
+    def logs(self, graceid):
+        """Log entries of an event. When the cached entries are older than
+        the TTL, the list is fetched again in a single request and the
+        entries after the last cached one are added.
+        """
+        entries, age = self._get('logs', graceid)
+        if entries is not None and (self.offline or age < self.ttl):
+            return entries
+        if self.offline:
+            raise CacheMiss(f'logs {graceid} are not cached')
+        fetched = self.get_client().logs(graceid).json()['log']
+        if entries is None:
+            entries = fetched
+        else:
+            last = max((entry['N'] for entry in entries), default=0)
+            entries += [entry for entry in fetched if entry['N'] > last]
+        self._put('logs', graceid, entries)
+        return entries
+
+    def evict(self):
+        """Drop the entries unused for longer than the maximum age, then the
+        least recently used ones until the cache fits in the maximum size.
+        """
+        with self.lock:
+            num = self.db.execute(
+                'DELETE FROM responses WHERE last_used < ?',
+                (time.time() - self.max_age,)
+            ).rowcount
+            total = self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()[0]
+            if total > self.max_size:
+                rows = self.db.execute(
+                    'SELECT rowid, size FROM responses '
+                    'ORDER BY last_used DESC'
+                ).fetchall()
+                kept = 0
+                drop = []
+                for rowid, size in rows:
+                    kept += size
+                    if kept > self.max_size:
+                        drop.append((rowid,))
+                self.db.executemany(
+                    'DELETE FROM responses WHERE rowid = ?', drop
+                )
+                num += len(drop)
+            self.db.commit()
+        if num:
+            logging.info('Evicted %d entries from the GraceDB cache', num)
+
+    def close(self):
+        self.evict()
+        self.db.close()
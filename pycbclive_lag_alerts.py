@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+"""Watch the logs of PyCBC Live and raise alerts when the lag of rank 0
+stays above a threshold, or its number of usable detectors stays below a
+minimum, for longer than a given duration.
+
+Alerts are written as JSON lines and/or passed to a hook command as soon as
+the log line triggering them is read. Restarts of PyCBC Live break the time
+series, as in the lag plots: a condition must hold again after a restart
+for its full duration before an alert is raised. Only the state of each
+rule is kept, so memory use does not grow with time.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import shlex
+import subprocess
+import sys
+import time
+import numpy as np
+
+from pycbclive_gpstime import gps_to_utc
+from pycbclive_logs import LINE_CLASSES, LogFollower, LogParser
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--log-glob',
+        required=True,
+        nargs='+',
+        help='Glob expression(s) for finding the PyCBC Live logs.'
+    )
+    parser.add_argument(
+        '--lag-threshold',
+        type=float,
+        default=30,
+        help='Alert when the lag of rank 0 is above this many seconds, '
+             'default 30.'
+    )
+    parser.add_argument(
+        '--lag-duration',
+        type=float,
+        default=120,
+        help='Seconds for which the lag must stay above --lag-threshold '
+             'before alerting, default 120.'
+    )
+    parser.add_argument(
+        '--min-detectors',
+        type=int,
+        default=2,
+        help='Alert when rank 0 has fewer usable detectors than this, '
+             'default 2.'
+    )
+    parser.add_argument(
+        '--detectors-duration',
+        type=float,
+        default=600,
+        help='Seconds for which the number of usable detectors must stay '
+             'below --min-detectors before alerting, default 600.'
+    )
+    parser.add_argument(
+        '--restart-grace',
+        type=float,
+        default=300,
+        help='Ignore the lag and detectors for this many seconds after a '
+             'restart of PyCBC Live, default 300.'
+    )
+    parser.add_argument(
+        '--output',
+        help='Append the alerts to this file as JSON lines. Defaults to '
+             'standard output if no --hook is given.'
+    )
+    parser.add_argument(
+        '--hook',
+        help='Command to run for each alert, with the alert given as JSON on '
+             'its standard input.'
+    )
+    parser.add_argument(
+        '--hook-timeout',
+        type=float,
+        default=30,
+        help='Seconds after which the hook command is killed, default 30.'
+    )
+    parser.add_argument(
+        '--start',
+        help='Read the logs from this UTC time on, given as the start of an '
+             'ISO timestamp. By default, only lines written after starting '
+             'are read.'
+    )
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help='Process the lines already in the logs and exit, e.g. to test '
+             'the thresholds on past data with --start.'
+    )
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=1,
+        help='Seconds between checks for new log lines, default 1.'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true'
+    )
+    return parser.parse_args()
+
+
+class ThresholdRule:
+    """Alert rule on a time series: fires when the series stays beyond a
+    threshold for at least a given duration, and resolves at the first
+    value back within the threshold.
+    """
+
+    def __init__(self, name, threshold, duration, above=True):
+        self.name = name
+        self.threshold = threshold
+        self.duration = duration
+        self.above = above
+        self.breach_start = None
+        self.peak = None
+        self.firing = False
+
+    def reset(self):
+        """Forget the current breach, e.g. because the series is broken by
+        a restart. A firing alert stays firing until resolved.
+        """
+        self.breach_start = None
+        self.peak = None
+
+    def update(self, gps_time, value):
+        """Add a value of the series. Returns an alert record if the rule
+        starts firing or resolves, None otherwise.
+        """
+        if np.isnan(value):
+            return None
+        breach = value > self.threshold if self.above \
+            else value < self.threshold
+        if not breach:
+            self.reset()
+            if self.firing:
+                self.firing = False
+                return self.record('resolved', gps_time, value)
+            return None
+        if self.breach_start is None:
+            self.breach_start = gps_time
+            self.peak = value
+        self.peak = max(self.peak, value) if self.above \
+            else min(self.peak, value)
+        if not self.firing and gps_time - self.breach_start >= self.duration:
+            self.firing = True
+            return self.record('firing', gps_time, value)
+        return None
+
+    def record(self, state, gps_time, value):
+        record = {
+            'rule': self.name,
+            'state': state,
+            'time': str(gps_to_utc(gps_time)) + 'Z',
+            'gps_time': float(gps_time),
+            'value': float(value),
+            'threshold': self.threshold,
+        }
+        if state == 'firing':
+            record['since_gps_time'] = float(self.breach_start)
+            record['peak'] = float(self.peak)
+        return record
+
+
+class LagAlerter:
+    """Check the rank 0 lines of the logs against the alert rules."""
+
+    def __init__(self, args, emit):
+        self.rules = {
+            'lag': ThresholdRule(
+                'lag', args.lag_threshold, args.lag_duration
+            ),
+            'n_det': ThresholdRule(
+                'detectors', args.min_detectors, args.detectors_duration,
+                above=False
+            )
+        }
+        self.restart_grace = args.restart_grace
+        self.emit = emit
+        self.last_restart = None
+
+    def process(self, columns):
+        """Process the columns returned by LogParser.parse_text()."""
+        starting = LINE_CLASSES.index('starting')
+        rows = np.flatnonzero(columns['rank'] == 0)
+        for i in rows:
+            gps_time = columns['gps_time'][i]
+            if columns['line_class'][i] == starting:
+                logging.info('Restart at GPS %.3f', gps_time)
+                self.last_restart = gps_time
+                for rule in self.rules.values():
+                    rule.reset()
+                self.emit({
+                    'rule': 'restart',
+                    'state': 'info',
+                    'time': str(gps_to_utc(gps_time)) + 'Z',
+                    'gps_time': float(gps_time)
+                })
+                continue
+            if self.last_restart is not None \
+                    and gps_time - self.last_restart < self.restart_grace:
+                continue
+            for column, rule in self.rules.items():
+                record = rule.update(gps_time, columns[column][i])
+                if record is not None:
+                    self.emit(record)
+
+
+def merge_by_time(blocks):
+    """Concatenate the columns returned by LogParser.parse_text() for several
+    blocks of lines, possibly from different log files, and sort the rows by
+    time, so that the rules see the values in order.
+    """
+    columns = {
+        name: np.concatenate([block[name] for block in blocks])
+        for name in blocks[0]
+    }
+    order = np.argsort(columns['gps_time'], kind='stable')
+    return {name: values[order] for name, values in columns.items()}
+
+
+class AlertSink:
+    """Write alert records as JSON lines and/or run a hook command."""
+
+    def __init__(self, output=None, hook=None, hook_timeout=30):
+        self.output = output
+        self.hook = None if hook is None else shlex.split(hook)
+        self.hook_timeout = hook_timeout
+
+    def __call__(self, record):
+        line = json.dumps(record)
+        logging.info('Alert: %s', line)
+        if self.output is not None:
+            self.output.write(line + '\n')
+            self.output.flush()
+        if self.hook is not None:
+            try:
+                subprocess.run(self.hook, input=line.encode(), check=True,
+                               timeout=self.hook_timeout)
+            except (OSError, subprocess.SubprocessError) as err:
+                logging.error('Hook failed for %s: %s', line, err)
+
+
+def main():
+    args = parse_cli()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
+    )
+
+    start_key = args.start
+    if start_key is None:
+        start_key = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+    follower = LogFollower(args.log_glob, start_key=start_key)
+    log_parser = LogParser(classes=['took', 'starting'])
+
+    output = None
+    if args.output is not None:
+        output = open(args.output, 'a')
+    elif args.hook is None:
+        output = sys.stdout
+    alerter = LagAlerter(
+        args, AlertSink(output, args.hook, args.hook_timeout)
+    )
+
+    try:
+        while True:
+            poll_start = time.monotonic()
+            blocks = [log_parser.parse_text(text)
+                      for text in follower.read_new_text()]
+            if blocks:
+                alerter.process(merge_by_time(blocks))
+            if args.once:
+                break
+            elapsed = time.monotonic() - poll_start
+            time.sleep(max(args.poll_interval - elapsed, 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_parser.log_counts()
+        if args.output is not None:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
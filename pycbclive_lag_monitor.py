@@ -2,54 +2,54 @@
 
 """Make a plot showing PyCBC Live's lag and number of usable detectors as a
 function of time and MPI rank, for a given UTC date.
-"""
 
-# Things that would be good to implement next:
-# * Save parsed data to a file next to the plot, as the old lag plotter did
-# * Show min/avg/max of lag for rank>0 instead of each curve (Ian's suggestion)
+With --follow, keep running and only parse the lines appended to the logs
+since the previous refresh, redrawing the plots periodically.
+
+The parsed data of each day is also saved to an HDF5 file next to the plots,
+which pycbclive_lag_trends.py can read to show the lag over longer periods.
+"""
 
 import argparse
 import logging
 import os
-import glob
 import datetime
+import time
+import hashlib
+import multiprocessing
 import numpy as np
-from astropy.time import Time
-from dateutil.parser import parse as dateutil_parse
+import h5py
 
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as pp
 
+from pycbclive_gpstime import utc_to_gps
+from pycbclive_logs import LINE_CLASSES, LogFollower, LogParser
 
-def iso_to_gps(iso_time):
-    """Convert a string (or list of strings) representing ISO time to the
-    corresponding GPS time.
 
-    Do not call this in a loop over many times, as it is somewhat slow.
-    Instead, give it the list of times to convert.
-    """
-    if type(iso_time) is str:
-        dt_time = dateutil_parse(iso_time)
-    else:
-        # assume an iterable
-        dt_time = list(map(dateutil_parse, iso_time))
-    return Time(dt_time).gps
+# columns of the files archiving the parsed data of each day
+ARCHIVE_COLUMNS = {
+    'gps_time': np.float64,
+    'rank': np.int32,
+    'lag': np.float32,
+    'n_det': np.float32,
+    'restart': bool
+}
+
 
-def set_up_x_axis(ax, day):
-    """Configure the horizontal plot axis with hourly ticks,
-    a range spanning the given day, and an appropriate label.
+def set_up_x_axis(ax, start, step, num_ticks, label):
+    """Configure the horizontal plot axis with `num_ticks` ticks, labeled
+    00, 01, etc, every `step` (a numpy timedelta64) from the UTC time
+    `start`, a range spanning all ticks, and the given label. Tick positions
+    account for leap seconds.
     """
-    tick_locs = []
-    tick_labels = []
-    for hour in range(24):
-        tick_locs.append(f'{day}T{hour:02d}:00:00Z')
-        tick_labels.append(f'{hour:02d}')
-    tick_locs = iso_to_gps(tick_locs)
-    ax.set_xticks(tick_locs)
-    ax.set_xticklabels(tick_labels)
-    ax.set_xlim(tick_locs[0], tick_locs[-1] + 3600)  # FIXME leap seconds
-    ax.set_xlabel('UTC hour of day')
+    ticks = np.datetime64(start) + step * np.arange(num_ticks + 1)
+    tick_locs = utc_to_gps(ticks)
+    ax.set_xticks(tick_locs[:-1])
+    ax.set_xticklabels([f'{i:02d}' for i in range(num_ticks)])
+    ax.set_xlim(tick_locs[0], tick_locs[-1])
+    ax.set_xlabel(label)
 
 def date_argument(date_str):
     if date_str == 'today':
@@ -63,7 +63,15 @@ def parse_cli():
         type=date_argument,
         default='today',
         metavar='{YYYY-MM-DD, today}',
-        help='Which (UTC) day we want to show, default today.'
+        help='Which (UTC) day we want to show, default today. With '
+             '--end-day, the first day to show.'
+    )
+    parser.add_argument(
+        '--end-day',
+        type=date_argument,
+        metavar='{YYYY-MM-DD, today}',
+        help='Show all days from --day to this one (included), parsing the '
+             'logs once. Plots which would not change are skipped.'
     )
     parser.add_argument(
         '--log-glob',
@@ -82,171 +90,616 @@ def parse_cli():
         help='Should match the setting used in the analysis. '
              'Determines the bottom of the lag axis.'
     )
+    parser.add_argument(
+        '--view',
+        choices=['ranks', 'envelope', 'heatmap'],
+        default='ranks',
+        help='How to show the ranks: "ranks" draws one curve per rank, '
+             '"envelope" draws rank 0 and the min/max, 10th-90th '
+             'percentile band and mean of the other ranks in time bins, '
+             '"heatmap" draws images of the max lag and min number of '
+             'usable detectors as a function of rank and time bin. The '
+             'last two are faster to draw with many ranks. Default ranks.'
+    )
+    parser.add_argument(
+        '--bin-width',
+        type=float,
+        default=20,
+        help='Width of the time bins of the envelope and heatmap views, '
+             'in seconds, default 20.'
+    )
+    parser.add_argument(
+        '--follow',
+        action='store_true',
+        help='Keep running, parsing only the lines appended to the logs '
+             'and redrawing the plots every --refresh-interval seconds. '
+             'When following today, move on to the next day at midnight UTC.'
+    )
+    parser.add_argument(
+        '--refresh-interval',
+        type=float,
+        default=60,
+        help='Seconds between refreshes of the plots with --follow, '
+             'default 60.'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=4,
+        help='Number of processes drawing the plots in parallel, default 4.'
+    )
     parser.add_argument(
         '--verbose',
         action='store_true'
     )
-    return parser.parse_args()
-
-
-args = parse_cli()
-
-logging.basicConfig(
-    format='%(asctime)s %(message)s',
-    level=(logging.INFO if args.verbose else logging.WARN)
-)
-
-gps_now = Time.now().gps
-
-# read data by parsing log files
-prev_day_str = str(args.day - datetime.timedelta(days=1))
-next_day_str = str(args.day + datetime.timedelta(days=1))
-times = {}
-data = {}
-files = sorted(glob.glob(args.log_glob))
-for f in files:
-    logging.info('Parsing %s', f)
-    with open(f, 'r') as log_f:
-        for line in log_f:
-            if 'Took' not in line and 'Starting' not in line:
-                continue
-            if line < prev_day_str or line > next_day_str:
-                # skip lines from the wrong days
-                continue
-            fields = line.split()
-            if len(fields) not in [4, 15]:
-                continue
-            log_timestamp = fields[0]
-            log_rank = int(fields[2])
-            if 'Starting' in line:
-                # adding the nan's will tell matplotlib
-                # to break the curves when PyCBC Live starts
-                log_lag = np.nan
-                log_n_det = np.nan
+    args = parser.parse_args()
+    if args.end_day is not None:
+        if args.end_day < args.day:
+            parser.error('--end-day must not be earlier than --day')
+        if args.follow:
+            parser.error('--end-day cannot be used with --follow')
+    return args
+
+
+class LagData:
+    """Lag and number of usable detectors as a function of GPS time, for
+    each MPI rank, restricted to a range of days plus the day before, whose
+    end is shown in the plots of the first day.
+    """
+
+    def __init__(self, first_day, last_day=None):
+        self.times = {}
+        self.data = {}
+        self.parser = LogParser(classes=['took', 'starting'])
+        self.set_days(first_day, last_day)
+
+    def set_days(self, first_day, last_day=None):
+        """Change the range of days of interest, dropping data outside the
+        new window.
+        """
+        if last_day is None:
+            last_day = first_day
+        self.first_day = first_day
+        self.last_day = last_day
+        self.prev_day_str = str(first_day - datetime.timedelta(days=1))
+        self.next_day_str = str(last_day + datetime.timedelta(days=1))
+        self.start = utc_to_gps(
+            np.datetime64(first_day) - np.timedelta64(1, 'D')
+        )
+        self.end = utc_to_gps(np.datetime64(last_day) + np.timedelta64(1, 'D'))
+        self.parser.window = (self.start, self.end)
+        for rank in self.times:
+            keep = (self.times[rank] >= self.start) \
+                & (self.times[rank] < self.end)
+            self.times[rank] = self.times[rank][keep]
+            self.data[rank] = self.data[rank][keep]
+
+    def for_day(self, day):
+        """Return a copy of the data restricted to the given day."""
+        day_data = LagData(day)
+        for rank in self.times:
+            keep = (self.times[rank] >= day_data.start) \
+                & (self.times[rank] < day_data.end)
+            if keep.any():
+                day_data.times[rank] = self.times[rank][keep]
+                day_data.data[rank] = self.data[rank][keep]
+        return day_data
+
+    def digest(self, start, end, gps_now, args):
+        """Return a hash of everything determining the look of a plot
+        spanning the given GPS times: the data in that range plus the
+        adjacent points, which are joined to it by lines, the ranks, the
+        current time and the relevant options.
+        """
+        digest = hashlib.sha1()
+        digest.update(repr((
+            sorted(self.data),
+            min(max(gps_now, start), end),
+            args.psd_inverse_length,
+            args.view,
+            args.bin_width
+        )).encode())
+        for rank in sorted(self.data):
+            i = max(np.searchsorted(self.times[rank], start) - 1, 0)
+            j = np.searchsorted(self.times[rank], end, side='right') + 1
+            digest.update(self.times[rank][i:j].tobytes())
+            digest.update(self.data[rank][i:j].tobytes())
+        return digest.hexdigest()
+
+    def add_text(self, blocks):
+        """Parse the given blocks of log lines and add them to the data."""
+        new_data = []
+        for text in blocks:
+            new_data.append(self.parser.parse_text(text))
+        if not new_data:
+            return
+        self.parser.log_counts()
+        columns = {
+            name: np.concatenate([d[name] for d in new_data])
+            for name in ['gps_time', 'rank', 'n_det', 'lag', 'line_class']
+        }
+        # lines saying that PyCBC Live starts have NaN lag and number of
+        # detectors, which will tell matplotlib to break the curves; Took
+        # lines without a lag are skipped
+        restart = columns['line_class'] == LINE_CLASSES.index('starting')
+        keep = restart | np.isfinite(columns['lag'])
+        columns = {name: values[keep] for name, values in columns.items()}
+        restart = restart[keep]
+        by_rank = np.argsort(columns['rank'], kind='stable')
+        ranks, starts = np.unique(columns['rank'][by_rank], return_index=True)
+        for rank, sel in zip(ranks, np.split(by_rank, starts[1:])):
+            rank = int(rank)
+            new_times = columns['gps_time'][sel]
+            # columns: number of detectors, lag, 1 for restarts
+            new_data = np.stack(
+                [columns['n_det'][sel], columns['lag'][sel], restart[sel]],
+                axis=1
+            )
+            if rank in self.times:
+                new_times = np.concatenate([self.times[rank], new_times])
+                new_data = np.concatenate([self.data[rank], new_data])
+            sorter = np.argsort(new_times, kind='stable')
+            self.times[rank] = new_times[sorter]
+            self.data[rank] = new_data[sorter]
+
+
+def plot_window(day, hour=None):
+    """Return the GPS start and end time of the plot for the given day, or
+    for one of its hours if `hour` is given.
+    """
+    start = np.datetime64(day, 'h')
+    length = np.timedelta64(1, 'D')
+    if hour is not None:
+        start += np.timedelta64(hour, 'h')
+        length = np.timedelta64(1, 'h')
+    return utc_to_gps(start), utc_to_gps(start + length)
+
+
+def plot_path(output_path, day, hour=None):
+    """Return the path of the plot for the given day, or for one of its hours
+    if `hour` is given.
+    """
+    name = f'{day}' if hour is None else f'{day}T{hour:02d}'
+    return os.path.join(
+        output_path,
+        f'{day.year:04d}',
+        f'{day.month:02d}',
+        f'{day.day:02d}',
+        f'{name}_lag_over_time.png'
+    )
+
+
+def archive_path(output_path, day):
+    """Return the path of the file archiving the parsed data of a day."""
+    return os.path.join(
+        output_path,
+        f'{day.year:04d}',
+        f'{day.month:02d}',
+        f'{day.day:02d}',
+        f'{day}_lag_data.hdf'
+    )
+
+
+def write_lag_archive(path, lag_data, day):
+    """Save the data of the given day to an HDF5 file with one column per
+    quantity, sorted by rank and then by time. Rows marking a restart of
+    PyCBC Live have `restart` set and NaN lag and number of detectors.
+    """
+    start, end = plot_window(day)
+    columns = {name: [] for name in ARCHIVE_COLUMNS}
+    for rank in sorted(lag_data.times):
+        times = lag_data.times[rank]
+        keep = (times >= start) & (times < end)
+        columns['gps_time'].append(times[keep])
+        columns['rank'].append(np.full(keep.sum(), rank))
+        columns['lag'].append(lag_data.data[rank][keep,1])
+        columns['n_det'].append(lag_data.data[rank][keep,0])
+        columns['restart'].append(lag_data.data[rank][keep,2] > 0)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['day'] = str(day)
+        f.attrs['start_time'] = start
+        f.attrs['end_time'] = end
+        for name, dtype in ARCHIVE_COLUMNS.items():
+            if columns[name]:
+                values = np.concatenate(columns[name]).astype(dtype)
             else:
-                log_lag = float(fields[10])
-                log_n_det = int(fields[12])
-            if log_rank not in times:
-                times[log_rank] = []
-            if log_rank not in data:
-                data[log_rank] = []
-            times[log_rank].append(log_timestamp)
-            data[log_rank].append((log_n_det, log_lag))
-
-logging.info('Converting timestamps to GPS')
-for rank in times:
-    times[rank] = iso_to_gps(times[rank])
-
-num_procs = len(data)
-logging.info('%d procs', num_procs)
-
-logging.info('Plotting')
-pp.figure(figsize=(15,7))
-ax_lag = pp.subplot(2, 1, 1)
-ax_n_det = pp.subplot(2, 1, 2)
-legend_flag = False
-
-for rank in sorted(data):
-    data[rank] = np.array(data[rank])
-    if rank == 0:
-        # rank-0 gives the total lag, so make it stand out
-        color = '#f00'
-    else:
-        color = pp.cm.viridis(rank / (num_procs - 1))
-    sorter = np.argsort(times[rank])
-    n_det = data[rank][sorter,0]
-    lag = data[rank][sorter,1]
-    if rank in [0, 1, num_procs // 2, num_procs - 1]:
-        label = f'Rank {rank}'
-        legend_flag = True
-    else:
-        label = None
-    # rank-0 gives the total lag, so put it on top
-    zorder = num_procs - rank
-    ax_lag.plot(
-        times[rank][sorter],
-        lag,
-        '.-',
-        lw=0.5,
-        markersize=3,
-        markeredgewidth=0,
-        color=color,
-        label=label,
-        zorder=zorder
-    )
-    ax_n_det.plot(
-        times[rank][sorter],
-        n_det,
-        '.-',
-        lw=0.5,
-        markersize=3,
-        markeredgewidth=0,
-        color=color,
-        zorder=zorder
-    )
-
-pp.suptitle(args.day)
-ax_lag.axvspan(
-    gps_now,
-    gps_now + 86400,
-    edgecolor='none',
-    facecolor='#d0d0d0'
-)
-set_up_x_axis(ax_lag, args.day)
-ax_lag.set_ylabel('Lag [s]')
-ax_lag.set_ylim(args.psd_inverse_length, 400)
-ax_lag.set_yscale('log')
-ax_lag.grid(which='both')
-if legend_flag:
-    ax_lag.legend(loc='upper left')
-ax_n_det.axvspan(
-    gps_now,
-    gps_now + 86400,
-    edgecolor='none',
-    facecolor='#d0d0d0'
-)
-set_up_x_axis(ax_n_det, args.day)
-ax_n_det.set_ylabel('Number of usable detectors')
-ax_n_det.set_yticks([0, 1, 2, 3])
-ax_n_det.grid()
-
-pp.tight_layout()
-
-out_path = os.path.join(
-    args.output_path,
-    f'{args.day.year:04d}',
-    f'{args.day.month:02d}',
-    f'{args.day.day:02d}',
-    f'{args.day}_lag_over_time.png'
-)
-logging.info('Saving plot to %s', out_path)
-os.makedirs(os.path.dirname(out_path), exist_ok=True)
-pp.savefig(out_path, dpi=200)
-
-for hour in range(0, 24):
-    pp.suptitle(f'{args.day}T{hour:02d}')
-    tick_locs = []
-    tick_labels = []
-    for minute in range(60):
-        tick_locs.append(f'{args.day}T{hour:02d}:{minute:02d}:00Z')
-        tick_labels.append(f'{minute:02d}')
-    tick_locs = iso_to_gps(tick_locs)
-    if tick_locs[0] > gps_now:
-        break
+                values = np.zeros(0, dtype=dtype)
+            f.create_dataset(
+                name,
+                data=values,
+                compression='gzip',
+                shuffle=True
+            )
+    os.replace(tmp_path, path)
+
+
+def read_lag_archive(path):
+    """Read a file written by `write_lag_archive`. Returns a dict of
+    columns, plus the start and end GPS time of the day.
+    """
+    with h5py.File(path, 'r') as f:
+        columns = {name: f[name][:] for name in ARCHIVE_COLUMNS}
+        return columns, f.attrs['start_time'], f.attrs['end_time']
+
+
+def digest_path(out_path):
+    """Return the path of the hidden file storing the hash of the data
+    shown in the given plot.
+    """
+    out_dir, name = os.path.split(out_path)
+    return os.path.join(out_dir, f'.{name}.sha1')
+
+
+def plots_to_update(lag_data, day, gps_now, args):
+    """Return the plots of the given day which need to be drawn, as a list
+    of (hour, digest) with hour None for the daily plot. Hours which have
+    not started yet, or whose plot already shows the same data, are skipped.
+    """
+    plots = []
+    for hour in [None] + list(range(24)):
+        start, end = plot_window(day, hour)
+        if start > gps_now:
+            break
+        digest = lag_data.digest(start, end, gps_now, args)
+        try:
+            with open(digest_path(plot_path(args.output_path, day, hour))) as f:
+                if f.read() == digest:
+                    continue
+        except FileNotFoundError:
+            pass
+        plots.append((hour, digest))
+    return plots
+
+
+def draw_ranks(ax_lag, ax_n_det, lag_data):
+    """Draw the lag and number of usable detectors of each rank as a
+    separate curve. Returns True if some curves have a label.
+    """
+    num_procs = len(lag_data.data)
+    legend_flag = False
+    for rank in sorted(lag_data.data):
+        if rank == 0:
+            # rank-0 gives the total lag, so make it stand out
+            color = '#f00'
+        else:
+            color = pp.cm.viridis(rank / (num_procs - 1))
+        times = lag_data.times[rank]
+        n_det = lag_data.data[rank][:,0]
+        lag = lag_data.data[rank][:,1]
+        if rank in [0, 1, num_procs // 2, num_procs - 1]:
+            label = f'Rank {rank}'
+            legend_flag = True
+        else:
+            label = None
+        # rank-0 gives the total lag, so put it on top
+        zorder = num_procs - rank
+        ax_lag.plot(
+            times,
+            lag,
+            '.-',
+            lw=0.5,
+            markersize=3,
+            markeredgewidth=0,
+            color=color,
+            label=label,
+            zorder=zorder
+        )
+        ax_n_det.plot(
+            times,
+            n_det,
+            '.-',
+            lw=0.5,
+            markersize=3,
+            markeredgewidth=0,
+            color=color,
+            zorder=zorder
+        )
+    return legend_flag
+
+
+def time_bin_stats(times, values, edges, percentiles=()):
+    """Compute the min, max, mean and the given percentiles of `values` in
+    bins of `times` defined by `edges`, in a vectorized way. Non-finite
+    values are ignored. Returns a dict of arrays with one element per bin,
+    NaN for empty bins, keyed by 'min', 'max', 'mean' and the percentiles.
+    """
+    num_bins = len(edges) - 1
+    valid = np.isfinite(values) & (times >= edges[0]) & (times < edges[-1])
+    bins = np.searchsorted(edges, times[valid], side='right') - 1
+    values = values[valid]
+    # sort by bin, then by value, so that order statistics can be read at
+    # fixed offsets from the start of each bin
+    order = np.lexsort((values, bins))
+    bins = bins[order]
+    values = values[order]
+    counts = np.bincount(bins, minlength=num_bins)
+    first = np.cumsum(counts) - counts
+    filled = counts > 0
+
+    def pick(pos):
+        result = np.full(num_bins, np.nan)
+        result[filled] = values[pos[filled]]
+        return result
+
+    stats = {'min': pick(first), 'max': pick(first + counts - 1)}
+    stats['mean'] = np.full(num_bins, np.nan)
+    stats['mean'][filled] = \
+        np.bincount(bins, values, minlength=num_bins)[filled] / counts[filled]
+    for pct in percentiles:
+        offset = np.round(pct / 100 * (counts - 1)).astype(int)
+        stats[pct] = pick(first + offset)
+    return stats
+
+
+def time_bin_edges(day, args):
+    """Edges of the time bins covering the given day."""
+    start, end = plot_window(day)
+    return np.arange(start, end + args.bin_width, args.bin_width)
+
+
+def draw_envelope(ax_lag, ax_n_det, lag_data, day, args):
+    """Draw the lag and number of usable detectors of rank 0 as a curve, and
+    the distribution over the other ranks, in time bins, as bands.
+    """
+    edges = time_bin_edges(day, args)
+    others = [rank for rank in lag_data.data if rank != 0]
+    if others:
+        times = np.concatenate([lag_data.times[r] for r in others])
+        data = np.concatenate([lag_data.data[r] for r in others])
+        lag_stats = time_bin_stats(times, data[:,1], edges, [10, 90])
+        n_det_stats = time_bin_stats(times, data[:,0], edges)
+        centers = (edges[:-1] + edges[1:]) / 2
+        ax_lag.fill_between(
+            centers,
+            lag_stats['min'],
+            lag_stats['max'],
+            step='mid',
+            lw=0,
+            color='#c6dbef',
+            label='Other ranks, min to max'
+        )
+        ax_lag.fill_between(
+            centers,
+            lag_stats[10],
+            lag_stats[90],
+            step='mid',
+            lw=0,
+            color='#6baed6',
+            label='Other ranks, 10th to 90th percentile'
+        )
+        ax_lag.plot(
+            centers,
+            lag_stats['mean'],
+            drawstyle='steps-mid',
+            lw=0.5,
+            color='#08306b',
+            label='Other ranks, mean'
+        )
+        ax_n_det.fill_between(
+            centers,
+            n_det_stats['min'],
+            n_det_stats['max'],
+            step='mid',
+            lw=0,
+            color='#c6dbef'
+        )
+    if 0 in lag_data.data:
+        for ax, column in [(ax_lag, 1), (ax_n_det, 0)]:
+            ax.plot(
+                lag_data.times[0],
+                lag_data.data[0][:,column],
+                '.-',
+                lw=0.5,
+                markersize=3,
+                markeredgewidth=0,
+                color='#f00',
+                label=('Rank 0' if ax is ax_lag else None)
+            )
+    return bool(lag_data.data)
+
+
+def draw_heatmap(fig, ax_lag, ax_n_det, lag_data, day, args):
+    """Draw images of the maximum lag and minimum number of usable detectors
+    as a function of rank and time bin.
+    """
+    edges = time_bin_edges(day, args)
+    num_ranks = max(lag_data.data, default=0) + 1
+    lag_image = np.full((num_ranks, len(edges) - 1), np.nan)
+    n_det_image = np.full((num_ranks, len(edges) - 1), np.nan)
+    for rank in lag_data.data:
+        times = lag_data.times[rank]
+        for image, column, func in [(lag_image, 1, 'max'),
+                                    (n_det_image, 0, 'min')]:
+            values = lag_data.data[rank][:,column]
+            image[rank] = time_bin_stats(times, values, edges)[func]
+    extent = (edges[0], edges[-1], -0.5, num_ranks - 0.5)
+    lag_im = ax_lag.imshow(
+        lag_image,
+        extent=extent,
+        origin='lower',
+        aspect='auto',
+        interpolation='nearest',
+        cmap='inferno',
+        norm=matplotlib.colors.LogNorm(args.psd_inverse_length, 400)
+    )
+    fig.colorbar(lag_im, ax=ax_lag, label='Max lag [s]', pad=0.01)
+    n_det_im = ax_n_det.imshow(
+        n_det_image,
+        extent=extent,
+        origin='lower',
+        aspect='auto',
+        interpolation='nearest',
+        cmap=pp.get_cmap('viridis', 4),
+        vmin=-0.5,
+        vmax=3.5
+    )
+    cb = fig.colorbar(
+        n_det_im, ax=ax_n_det, label='Min usable detectors', pad=0.01
+    )
+    cb.set_ticks([0, 1, 2, 3])
     for ax in [ax_lag, ax_n_det]:
-        ax.set_xticks(tick_locs)
-        ax.set_xticklabels(tick_labels)
-        ax.set_xlim(tick_locs[0], tick_locs[-1] + 60)  # FIXME leap seconds
-        ax.set_xlabel('Minute')
+        ax.set_ylabel('MPI rank')
+        ax.set_ylim(-0.5, num_ranks - 0.5)
+
+
+def make_plots(job):
+    """Draw the data for one day and save the given plots, as a list of
+    (hour, digest) with hour None for the plot of the whole day.
+    """
+    lag_data, day, gps_now, args, plots = job
+    logging.info('%d procs', len(lag_data.data))
+
+    logging.info('Plotting')
+    fig = pp.figure(figsize=(15,7))
+    ax_lag = pp.subplot(2, 1, 1)
+    ax_n_det = pp.subplot(2, 1, 2)
+    legend_flag = False
+
+    if args.view == 'ranks':
+        legend_flag = draw_ranks(ax_lag, ax_n_det, lag_data)
+    elif args.view == 'envelope':
+        legend_flag = draw_envelope(ax_lag, ax_n_det, lag_data, day, args)
+    else:
+        draw_heatmap(fig, ax_lag, ax_n_det, lag_data, day, args)
+
+    pp.suptitle(day)
+    ax_lag.axvspan(
+        gps_now,
+        gps_now + 86400,
+        edgecolor='none',
+        facecolor='#d0d0d0'
+    )
+    set_up_x_axis(ax_lag, day, np.timedelta64(1, 'h'), 24, 'UTC hour of day')
+    if args.view != 'heatmap':
+        ax_lag.set_ylabel('Lag [s]')
+        ax_lag.set_ylim(args.psd_inverse_length, 400)
+        ax_lag.set_yscale('log')
+    ax_lag.grid(which='both')
+    if legend_flag:
+        ax_lag.legend(loc='upper left')
+    ax_n_det.axvspan(
+        gps_now,
+        gps_now + 86400,
+        edgecolor='none',
+        facecolor='#d0d0d0'
+    )
+    set_up_x_axis(ax_n_det, day, np.timedelta64(1, 'h'), 24, 'UTC hour of day')
+    if args.view != 'heatmap':
+        ax_n_det.set_ylabel('Number of usable detectors')
+        ax_n_det.set_yticks([0, 1, 2, 3])
+    ax_n_det.grid()
+
     pp.tight_layout()
-    out_path = os.path.join(
-        args.output_path,
-        f'{args.day.year:04d}',
-        f'{args.day.month:02d}',
-        f'{args.day.day:02d}',
-        f'{args.day}T{hour:02d}_lag_over_time.png'
+
+    for hour, digest in plots:
+        if hour is not None:
+            pp.suptitle(f'{day}T{hour:02d}')
+            hour_start = np.datetime64(day) + np.timedelta64(hour, 'h')
+            for ax in [ax_lag, ax_n_det]:
+                set_up_x_axis(
+                    ax, hour_start, np.timedelta64(1, 'm'), 60, 'Minute'
+                )
+            pp.tight_layout()
+        out_path = plot_path(args.output_path, day, hour)
+        logging.info('Saving plot to %s', out_path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        save_plot(out_path)
+        with open(digest_path(out_path), 'w') as f:
+            f.write(digest)
+
+    pp.close(fig)
+
+
+def save_plot(out_path):
+    """Save the current figure, replacing any existing file atomically so
+    that web servers never see a partially written plot.
+    """
+    tmp_path = out_path + '.tmp.png'
+    pp.savefig(tmp_path, dpi=200)
+    os.replace(tmp_path, out_path)
+
+
+def main():
+    args = parse_cli()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
     )
-    logging.info('Saving plot to %s', out_path)
-    pp.savefig(out_path, dpi=200)
 
-logging.info('Done')
+    last_day = args.end_day or args.day
+    days = [
+        args.day + datetime.timedelta(days=i)
+        for i in range((last_day - args.day).days + 1)
+    ]
+    lag_data = LagData(args.day, last_day)
+    # in follow mode, new lines must be read whatever their timestamp
+    follower = LogFollower(
+        args.log_glob,
+        start_key=lag_data.prev_day_str,
+        end_key=(None if args.follow else lag_data.next_day_str)
+    )
+    follow_today = args.day == datetime.datetime.utcnow().date()
+    pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+
+    while True:
+        refresh_start = time.monotonic()
+        now = np.datetime64('now')
+        gps_now = utc_to_gps(now)
+        plot_days = days
+        if follow_today:
+            today = now.astype('datetime64[D]').astype(datetime.date)
+            if today != days[0]:
+                # draw the final plots of the previous day, then move on
+                plot_days = [days[0], today]
+                days = [today]
+                lag_data.set_days(plot_days[0], today)
+
+        # read data by parsing log files
+        lag_data.add_text(follower.read_new_text())
+
+        jobs = []
+        for day in plot_days:
+            day_data = lag_data.for_day(day)
+            plots = plots_to_update(day_data, day, gps_now, args)
+            if plots and plots[0][0] is None:
+                # the data of the day has changed
+                path = archive_path(args.output_path, day)
+                logging.info('Archiving data to %s', path)
+                write_lag_archive(path, day_data, day)
+            # split the plots of each day across processes, so that a
+            # single day is rendered in parallel too
+            num_jobs = min(len(plots), args.processes // len(plot_days))
+            num_jobs = max(num_jobs, 1)
+            for i in range(min(num_jobs, len(plots))):
+                jobs.append((day_data, day, gps_now, args, plots[i::num_jobs]))
+        lag_data.set_days(days[0], days[-1])
+        logging.info(
+            'Drawing %d plots in %d jobs',
+            sum(len(job[-1]) for job in jobs),
+            len(jobs)
+        )
+        if pool is None:
+            for job in jobs:
+                make_plots(job)
+        else:
+            for _ in pool.imap_unordered(make_plots, jobs):
+                pass
+
+        if not args.follow:
+            break
+
+        elapsed = time.monotonic() - refresh_start
+        logging.info('Refresh took %.1f s', elapsed)
+        time.sleep(max(args.refresh_interval - elapsed, 0))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    logging.info('Done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""Make a plot showing the trend of PyCBC Live's lag, number of usable
+detectors and restarts over many days, from the data archived by
+pycbclive_lag_monitor.py, without parsing the logs again.
+"""
+
+import argparse
+import logging
+import glob
+import numpy as np
+
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as pp
+
+from pycbclive_gpstime import gps_to_utc, utc_to_gps
+from pycbclive_lag_monitor import read_lag_archive, time_bin_stats
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--archive-glob',
+        required=True,
+        help='Glob expression for finding the *_lag_data.hdf files written '
+             'by pycbclive_lag_monitor.py.'
+    )
+    parser.add_argument(
+        '--output-plot',
+        required=True,
+        help='Path of the output plot.'
+    )
+    parser.add_argument(
+        '--bin-width',
+        type=float,
+        default=1,
+        help='Width of the time bins, in hours, default 1. Bins never span '
+             'two days, so the last bin of a day can be shorter if this '
+             'does not divide 24.'
+    )
+    parser.add_argument(
+        '--psd-inverse-length',
+        type=float,
+        default=3.5,
+        help='Should match the setting used in the analysis. '
+             'Determines the bottom of the lag axis.'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true'
+    )
+    return parser.parse_args()
+
+
+def day_stats(path, bin_width):
+    """Compute the statistics shown in the plot, in time bins, for the
+    archived data of one day.
+    """
+    columns, start, end = read_lag_archive(path)
+    edges = np.append(np.arange(start, end, bin_width), end)
+    times = columns['gps_time']
+    rank_0 = columns['rank'] == 0
+    lag_0 = time_bin_stats(times[rank_0], columns['lag'][rank_0], edges,
+                           [50, 90])
+    lag_others = time_bin_stats(times[~rank_0], columns['lag'][~rank_0],
+                                edges, [90])
+    n_det_0 = time_bin_stats(times[rank_0], columns['n_det'][rank_0], edges)
+    restarts, _ = np.histogram(
+        times[rank_0 & columns['restart']], bins=edges
+    )
+    return {
+        'edges': edges,
+        'lag_0_median': lag_0[50],
+        'lag_0_p90': lag_0[90],
+        'lag_0_max': lag_0['max'],
+        'lag_others_p90': lag_others[90],
+        'n_det_0_min': n_det_0['min'],
+        'n_det_0_mean': n_det_0['mean'],
+        'restarts': restarts
+    }
+
+
+def set_up_x_axis(ax, start, end):
+    """Configure the horizontal axis with ticks at the start of each UTC day,
+    or each week for long ranges.
+    """
+    first_day = gps_to_utc(start).astype('datetime64[D]')
+    last_day = gps_to_utc(end).astype('datetime64[D]') + 1
+    step = 1 if last_day - first_day <= np.timedelta64(14, 'D') else 7
+    days = np.arange(first_day, last_day + 1, step)
+    ax.set_xticks(utc_to_gps(days))
+    ax.set_xticklabels([d.astype(object).strftime('%m-%d') for d in days])
+    ax.set_xlim(start, end)
+    ax.set_xlabel(f'UTC date ({str(first_day)[:4]})')
+
+
+def main():
+    args = parse_cli()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
+    )
+
+    paths = sorted(glob.glob(args.archive_glob))
+    if not paths:
+        raise RuntimeError(f'No files match {args.archive_glob}')
+    stats = {}
+    for path in paths:
+        logging.info('Reading %s', path)
+        day = day_stats(path, args.bin_width * 3600)
+        edges = day.pop('edges')
+        stats.setdefault('left', []).append(edges[:-1])
+        stats.setdefault('widths', []).append(np.diff(edges))
+        stats.setdefault('restarts', []).append(day.pop('restarts'))
+        # the curves are drawn as steps starting at the left edge of each
+        # bin, so the last value is repeated at the end of the day, followed
+        # by a NaN to break the curves when days are missing
+        stats.setdefault('times', []).append(np.append(edges, edges[-1]))
+        for name, values in day.items():
+            stats.setdefault(name, []).append(
+                np.append(values, [values[-1], np.nan])
+            )
+    for name in stats:
+        stats[name] = np.concatenate(stats[name])
+    times = stats['times']
+    start = times[0]
+    end = times[-1]
+
+    logging.info('Plotting')
+    fig, (ax_lag, ax_n_det, ax_restarts) = pp.subplots(
+        3, 1, sharex=True, figsize=(15, 9),
+        gridspec_kw={'height_ratios': [3, 2, 1]}
+    )
+    ax_lag.fill_between(
+        times,
+        stats['lag_0_median'],
+        stats['lag_0_max'],
+        step='post',
+        lw=0,
+        color='#fcbba1',
+        label='Rank 0, median to max'
+    )
+    ax_lag.plot(
+        times,
+        stats['lag_0_p90'],
+        drawstyle='steps-post',
+        lw=1,
+        color='#f00',
+        label='Rank 0, 90th percentile'
+    )
+    ax_lag.plot(
+        times,
+        stats['lag_others_p90'],
+        drawstyle='steps-post',
+        lw=1,
+        color='#08519c',
+        label='Other ranks, 90th percentile'
+    )
+    ax_lag.set_ylabel('Lag [s]')
+    ax_lag.set_ylim(args.psd_inverse_length, 400)
+    ax_lag.set_yscale('log')
+    ax_lag.grid(which='both')
+    ax_lag.legend(loc='upper left')
+
+    ax_n_det.fill_between(
+        times,
+        0,
+        stats['n_det_0_min'],
+        step='post',
+        lw=0,
+        color='#9ecae1',
+        label='Min'
+    )
+    ax_n_det.plot(
+        times,
+        stats['n_det_0_mean'],
+        drawstyle='steps-post',
+        lw=1,
+        color='#08519c',
+        label='Mean'
+    )
+    ax_n_det.set_ylabel('Usable detectors')
+    ax_n_det.set_yticks([0, 1, 2, 3])
+    ax_n_det.set_ylim(0, 3.2)
+    ax_n_det.grid()
+    ax_n_det.legend(loc='lower left')
+
+    ax_restarts.bar(
+        stats['left'],
+        stats['restarts'],
+        width=stats['widths'],
+        align='edge',
+        color='k'
+    )
+    ax_restarts.set_ylabel('Restarts')
+    ax_restarts.grid()
+
+    set_up_x_axis(ax_restarts, start, end)
+    fig.suptitle(
+        f'PyCBC Live lag trend, {args.bin_width:g} h bins, '
+        f'{len(paths)} days'
+    )
+    fig.tight_layout()
+    logging.info('Saving plot to %s', args.output_plot)
+    fig.savefig(args.output_plot, dpi=150)
+    logging.info('Done')
+
+
+if __name__ == '__main__':
+    main()
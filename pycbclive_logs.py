@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+"""Parse the logs of PyCBC Live.
+
+The lines of interest are described by a schema, matching the line classes
+highlighted by `multitailrc`, and are parsed in a single pass into columns
+of timestamps, ranks and the quantities reported by each class of line.
+Lines which look like they belong to a class but cannot be parsed are
+counted as malformed instead of being silently ignored.
+
+This module also provides incremental reading of growing logs and a binary
+search of a given time in large logs. Run it directly to benchmark the
+parser on a log file.
+"""
+
+import argparse
+import collections
+import glob
+import logging
+import operator
+import os
+import re
+import time
+import warnings
+import numpy as np
+
+from pycbclive_gpstime import iso_to_gps
+
+
+# length of the timestamps at the start of PyCBC Live log lines, used when
+# searching for a given time in a log file
+TIMESTAMP_LENGTH = 28
+
+# byte range below which a bisection search scans lines instead
+BISECT_SCAN_SIZE = 2 ** 16
+
+# Every line written by PyCBC Live through `logging` starts with a timestamp
+# (whose date and time are separated by a space in older versions), the host
+# name and the MPI rank. Lines not starting like this are continuations of
+# the previous one, e.g. tracebacks.
+_PREFIX = r'(?P<timestamp>\d{4}-\d\d-\d\d[T ]\S+) (?P<host>\S+) (?P<rank>\d+) '
+
+# numbers are validated when converted, which is faster than doing it in the
+# regular expressions
+_NUMBER = r'[^ ,\n]+'
+
+# Classes of log lines, in order of precedence: name, a keyword which lines
+# of the class contain, and a regular expression matching the message after
+# the rank, whose named groups give the values of the numeric columns.
+# Lines containing the keyword of a class but not matching its expression
+# are counted as malformed; classes without a keyword are never malformed.
+LINE_SCHEMA = [
+    ('took', 'Took ',
+     rf'Took (?P<took>{_NUMBER})(?: s)?, '
+     rf'duty factor of (?P<duty_factor>{_NUMBER})'
+     rf'(?:, lag (?P<lag>{_NUMBER}) s, (?P<n_det>{_NUMBER}) live detectors)?'),
+    # only the bare "Starting" line marks a (re)start of PyCBC Live
+    ('starting', None, r'Starting(?=\n|$)'),
+    ('coinc', 'Coincident candidate', r'Coincident candidate'),
+    ('single', 'Single-detector candidate', r'Single-detector candidate'),
+    ('late', 'is late',
+     rf'[^\n]*?is late(?:[^\n]*? by (?P<lateness>{_NUMBER}) ?s)?'),
+    ('error', 'rror', r'[^\n]*?[Ee]rror'),
+]
+
+# all line classes, including the lines which are not described by the
+# schema and the continuation lines
+LINE_CLASSES = [name for name, _, _ in LINE_SCHEMA] \
+    + ['other', 'continuation']
+
+# numeric columns given by the schema
+VALUE_COLUMNS = ['took', 'duty_factor', 'lag', 'n_det', 'lateness']
+
+# A single expression matching any timestamped line, preceded by a newline,
+# with one group per line class. Running it over a whole block of text with
+# findall() avoids a Python loop over the lines.
+_LINE_RE = re.compile(
+    r'\n' + _PREFIX + '(?:'
+    + '|'.join(f'(?P<_{name}>{pattern})' for name, _, pattern in LINE_SCHEMA)
+    + r'|(?P<_other>[^\n]*))'
+)
+# numeric columns given by the lines of each class
+_CLASS_VALUES = {
+    name: [g for g in re.compile(pattern).groupindex if g in VALUE_COLUMNS]
+    for name, _, pattern in LINE_SCHEMA
+}
+# position of each group in the tuples returned by findall()
+_GROUP_POS = {name: i - 1 for name, i in _LINE_RE.groupindex.items()}
+
+
+def _to_numbers(strings):
+    """Convert a list of strings representing numbers to an array of floats,
+    much faster than converting them one by one. Empty strings give NaN.
+    Also returns a boolean array flagging the strings which are not numbers,
+    which give NaN too.
+    """
+    bad = np.zeros(len(strings), dtype=bool)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+            numbers = np.fromstring(' '.join(strings), sep=' ')
+        except (DeprecationWarning, ValueError):
+            numbers = None
+    if numbers is not None and len(numbers) == len(strings):
+        return numbers, bad
+    # some strings are empty or not numbers
+    numbers = np.full(len(strings), np.nan)
+    for i, x in enumerate(strings):
+        if x:
+            try:
+                numbers[i] = float(x)
+            except ValueError:
+                bad[i] = True
+    return numbers, bad
+
+
+class LogParser:
+    """Parse blocks of log text into columns, counting the lines of each
+    class and the malformed lines.
+
+    Only lines of the given `classes` are returned. If `window` is given as
+    a (start, end) pair of GPS times, lines outside [start, end) are dropped.
+    """
+
+    def __init__(self, classes=None, window=None):
+        self.classes = set(LINE_CLASSES if classes is None else classes)
+        self.window = window
+        self.counts = collections.Counter()
+        # line class -> number of lines containing the keyword of the class
+        # but not following its format
+        self.malformed = collections.Counter()
+
+    def parse_lines(self, lines):
+        """Parse a sequence of lines, with or without their newline."""
+        return self.parse_text('\n'.join(line.rstrip('\n') for line in lines))
+
+    def parse_text(self, text):
+        """Parse a block of complete lines. Returns a dict of numpy arrays:
+        `gps_time`, `rank` and `line_class` (an index into LINE_CLASSES),
+        plus the VALUE_COLUMNS, which are NaN where a line does not have
+        them. Rows are in the order of the lines. Continuation lines are
+        never returned.
+        """
+        text = '\n' + text
+        rows = _LINE_RE.findall(text)
+        num_rows = len(rows)
+
+        def column(name):
+            return list(map(operator.itemgetter(_GROUP_POS[name]), rows))
+
+        self.counts['continuation'] += text.count('\n') - num_rows \
+            - text.endswith('\n')
+
+        line_class = np.full(num_rows, -1, dtype=np.int8)
+        for i, (name, _, _) in enumerate(LINE_SCHEMA + [('other', '', '')]):
+            matched = np.fromiter(map(len, column('_' + name)), np.int64)
+            line_class[matched > 0] = i
+        # lines not matching their class end up in "other"
+        other_index = LINE_CLASSES.index('other')
+        for row in np.flatnonzero(line_class == other_index):
+            message = rows[row][_GROUP_POS['_other']]
+            for name, keyword, _ in LINE_SCHEMA:
+                if keyword is not None and keyword in message:
+                    self.malformed[name] += 1
+                    line_class[row] = -1
+                    break
+
+        result = {'line_class': line_class}
+        result['rank'], _ = _to_numbers(column('rank'))
+        for name in VALUE_COLUMNS:
+            result[name] = np.full(num_rows, np.nan)
+        # only convert the values of the lines of the classes having them
+        for i, (name, _, _) in enumerate(LINE_SCHEMA):
+            if not _CLASS_VALUES[name]:
+                continue
+            where = np.flatnonzero(line_class == i)
+            if len(where) == 0:
+                continue
+            subset = rows
+            if len(where) < num_rows:
+                subset = [rows[j] for j in where]
+            for value in _CLASS_VALUES[name]:
+                values, bad = _to_numbers(
+                    list(map(operator.itemgetter(_GROUP_POS[value]), subset))
+                )
+                result[value][where] = values
+                if bad.any():
+                    self.malformed[name] += int(bad.sum())
+                    line_class[where[bad]] = -1
+        result['gps_time'] = np.zeros(num_rows)
+        if num_rows:
+            result['gps_time'] = iso_to_gps(column('timestamp'))
+
+        for i, name in enumerate(LINE_CLASSES[:-1]):
+            self.counts[name] += int((line_class == i).sum())
+        keep = np.isin(
+            line_class, [LINE_CLASSES.index(name) for name in self.classes]
+        )
+        if self.window is not None:
+            keep &= (result['gps_time'] >= self.window[0]) \
+                & (result['gps_time'] < self.window[1])
+        result = {name: column[keep] for name, column in result.items()}
+        result['rank'] = result['rank'].astype(np.int64)
+        return result
+
+    def log_counts(self):
+        """Log the numbers of lines of each class and of malformed lines."""
+        logging.info(
+            'Parsed lines: %s',
+            ', '.join(f'{n} {c}' for c, n in sorted(self.counts.items()) if n)
+        )
+        if self.malformed:
+            logging.warning(
+                'Malformed lines: %s',
+                ', '.join(
+                    f'{n} {c}' for c, n in sorted(self.malformed.items())
+                )
+            )
+
+
+def parse_line(line):
+    """Parse a single log line. Returns the line class, or None if the line
+    is malformed, and a dict with the timestamp, host and rank as strings
+    and the values in the line as floats, or None for continuation lines.
+    """
+    match = _LINE_RE.match('\n' + line.rstrip('\n'))
+    if match is None:
+        return 'continuation', None
+    groups = match.groupdict()
+    fields = {name: groups[name] for name in ['timestamp', 'host', 'rank']}
+    for name, keyword, _ in LINE_SCHEMA:
+        if groups['_' + name] is not None:
+            line_class = name
+            break
+    else:
+        line_class = 'other'
+        if any(keyword is not None and keyword in groups['_other']
+               for _, keyword, _ in LINE_SCHEMA):
+            return None, fields
+    for name in VALUE_COLUMNS:
+        value = groups[name]
+        try:
+            fields[name] = float('nan' if value is None else value)
+        except ValueError:
+            return None, fields
+    return line_class, fields
+
+
+def _next_timestamp(log_f, offset):
+    """Return the byte offset and leading timestamp of the first line
+    starting with a timestamp at or after the given offset, skipping the
+    (possibly partial) line containing the offset itself. Lines not
+    starting with a timestamp, e.g. tracebacks, are skipped too. Returns
+    (None, None) at the end of the file.
+    """
+    log_f.seek(offset)
+    if offset > 0:
+        log_f.readline()
+    while True:
+        line_offset = log_f.tell()
+        line = log_f.readline()
+        if not line:
+            return None, None
+        if line[:4].isdigit():
+            return line_offset, line[:TIMESTAMP_LENGTH].decode()
+
+
+def find_log_offset(log_f, key):
+    """Binary search a log file, opened in binary mode, for the byte offset
+    of the first line whose timestamp is not earlier than `key`, an ISO
+    string such as '2023-05-24' which is compared to the start of the
+    timestamps. Relies on the timestamps at the start of the lines being
+    sorted. Returns the size of the file if all lines are earlier.
+    """
+    low = 0
+    high = log_f.seek(0, os.SEEK_END)
+    # bisect until the interval is small enough to be scanned
+    while high - low > BISECT_SCAN_SIZE:
+        mid = (low + high) // 2
+        line_offset, timestamp = _next_timestamp(log_f, mid)
+        if timestamp is None or timestamp >= key:
+            high = mid
+        else:
+            low = line_offset
+    offset = low
+    while True:
+        line_offset, timestamp = _next_timestamp(log_f, offset)
+        if timestamp is None:
+            return high
+        if timestamp >= key:
+            return line_offset
+        offset = line_offset + 1
+
+
+class LogFollower:
+    """Read the lines appended to a set of log files, matching a glob
+    expression or a list of them, since the last call. Files are identified
+    by device and inode, so renamed (rotated) files are not read twice, and
+    a file which shrinks is assumed to have been truncated and is read again
+    from the start.
+
+    If `start_key` is given, files seen for the first time are read starting
+    from the first line with a timestamp not earlier than `start_key`,
+    found by bisection. Similarly, if `end_key` is given, lines from
+    `end_key` on are never read.
+    """
+
+    read_size = 2 ** 24
+
+    def __init__(self, log_glob, start_key=None, end_key=None):
+        self.log_glob = log_glob
+        self.start_key = start_key
+        self.end_key = end_key
+        # (device, inode) -> [path, byte offset, incomplete last line]
+        self.state = {}
+
+    def read_new_lines(self):
+        """Yield the complete lines appended to the logs since the previous
+        call, without their newline.
+        """
+        for text in self.read_new_text():
+            yield from text.splitlines()
+
+    def read_new_text(self):
+        """Yield blocks of complete lines appended to the logs since the
+        previous call. An incomplete last line is kept until it is
+        terminated.
+        """
+        current = {}
+        patterns = self.log_glob
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        paths = sorted(set(
+            path for pattern in patterns for path in glob.glob(pattern)
+        ))
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            key = (stat.st_dev, stat.st_ino)
+            state = self.state.get(key, [path, None, b''])
+            state[0] = path
+            if state[1] is not None and stat.st_size < state[1]:
+                logging.info('%s was truncated, reading it again', path)
+                state[1:] = [None, b'']
+            current[key] = state
+            if stat.st_size == state[1]:
+                continue
+            with open(path, 'rb') as log_f:
+                if state[1] is None:
+                    state[1] = 0
+                    if self.start_key is not None:
+                        state[1] = find_log_offset(log_f, self.start_key)
+                end = stat.st_size
+                if self.end_key is not None:
+                    end = find_log_offset(log_f, self.end_key)
+                if end <= state[1]:
+                    continue
+                logging.info(
+                    'Parsing %s from byte %d to %d', path, state[1], end
+                )
+                log_f.seek(state[1])
+                while state[1] < end:
+                    chunk = log_f.read(min(self.read_size, end - state[1]))
+                    if not chunk:
+                        break
+                    state[1] += len(chunk)
+                    data = state[2] + chunk
+                    cut = data.rfind(b'\n') + 1
+                    state[2] = data[cut:]
+                    if cut:
+                        yield data[:cut].decode(errors='replace')
+        # forget files which have been deleted
+        self.state = current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--log-glob', required=True,
+                        help='Glob expression of the logs to parse')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    log_parser = LogParser()
+    start = time.perf_counter()
+    for text in LogFollower(args.log_glob).read_new_text():
+        log_parser.parse_text(text)
+    elapsed = time.perf_counter() - start
+    log_parser.log_counts()
+    num_lines = sum(log_parser.counts.values()) \
+        + sum(log_parser.malformed.values())
+    print(f'{num_lines} lines in {elapsed:.2f} s, '
+          f'{num_lines / elapsed / 1e6:.2f} million lines per second')
+
+
+if __name__ == '__main__':
+    main()
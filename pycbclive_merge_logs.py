@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+"""Merge the logs of the MPI ranks of PyCBC Live into a single time-ordered
+stream, optionally filtered by time, rank and class of line, and colored
+like multitail does with `multitailrc`.
+
+The logs are merged with a k-way merge on the timestamps at the start of the
+lines, so only one line per log is held in memory however large the logs
+are. Lines not starting with a timestamp, such as tracebacks, stay attached
+to the line they follow. With --follow, keep merging the lines appended to
+the logs as they grow.
+
+The timestamps of all logs are assumed to be in the same time zone, which
+is the case for PyCBC Live.
+"""
+
+import argparse
+import glob
+import heapq
+import logging
+import os
+import sys
+import time
+
+from pycbclive_logs import LINE_CLASSES, find_log_offset, parse_line
+
+
+# ANSI color codes of the line classes, following `multitailrc`: candidates
+# are only highlighted for rank 0, whose Took lines are also in bold
+CLASS_COLORS = {
+    ('coinc', 0): '32',
+    ('single', 0): '32',
+    ('took', 0): '1;36',
+    'took': '36',
+    'error': '1;33;41',
+    'continuation': '35',
+    'late': '31',
+}
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--log-glob',
+        required=True,
+        nargs='+',
+        help='Glob expression(s) for finding the PyCBC Live logs to merge.'
+    )
+    parser.add_argument(
+        '--start',
+        help='Only show lines from this UTC time on, given as the start of '
+             'an ISO timestamp, e.g. 2023-05-24T12:30.'
+    )
+    parser.add_argument(
+        '--end',
+        help='Only show lines before this UTC time, given as the start of '
+             'an ISO timestamp.'
+    )
+    parser.add_argument(
+        '--ranks',
+        type=int,
+        nargs='+',
+        help='Only show lines written by these MPI ranks.'
+    )
+    parser.add_argument(
+        '--classes',
+        nargs='+',
+        choices=LINE_CLASSES,
+        help='Only show lines of these classes. Continuation lines, e.g. '
+             'tracebacks, are shown after the line they follow if '
+             '"continuation" is one of the classes.'
+    )
+    parser.add_argument(
+        '--color',
+        choices=['auto', 'always', 'never'],
+        default='auto',
+        help='Color the lines like multitail does with multitailrc. By '
+             'default, only when writing to a terminal.'
+    )
+    parser.add_argument(
+        '--follow',
+        action='store_true',
+        help='Keep running, merging the lines appended to the logs.'
+    )
+    parser.add_argument(
+        '--refresh-interval',
+        type=float,
+        default=1,
+        help='Seconds between checks for new lines with --follow, '
+             'default 1.'
+    )
+    parser.add_argument(
+        '--max-delay',
+        type=float,
+        default=10,
+        help='With --follow, lines are held back until every log which is '
+             'still growing has caught up with them, so that they are '
+             'shown in order. Logs which have not grown for this many '
+             'seconds, default 10, are not waited for.'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true'
+    )
+    return parser.parse_args()
+
+
+def timestamp_key(line):
+    """Sort key of a line starting with a timestamp: the date and time to the
+    millisecond, in the same layout for the old and new formats of the logs.
+    """
+    return line[:10] + 'T' + line[11:19] + '.' + line[20:23]
+
+
+class LogStream:
+    """Read the records of a log file incrementally. A record is a
+    (sort key, lines) pair, made of a line starting with a timestamp and
+    the continuation lines following it. Lines before `start_key` are
+    skipped, and reading stops at the first line from `end_key` on.
+    """
+
+    def __init__(self, path, start_key=None, end_key=None):
+        self.path = path
+        self.start_key = start_key
+        self.end_key = end_key
+        stat = os.stat(path)
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.offset = None
+        # record still open to continuation lines
+        self.record = None
+        self.last_key = ''
+        self.last_growth = time.monotonic()
+        # whether the current line is before `start_key`
+        self.skipping = False
+        self.ended = False
+
+    def read(self, final=True):
+        """Yield the records appended to the log since the previous call.
+        Unless `final` is true, the last record is kept until a new line
+        starting with a timestamp shows that it is complete.
+        """
+        size = os.stat(self.path).st_size
+        if self.offset is not None and size < self.offset:
+            logging.info('%s was truncated, reading it again', self.path)
+            self.offset = None
+        if self.offset is None or size > self.offset:
+            self.last_growth = time.monotonic()
+            yield from self._read_lines()
+        if final and self.record is not None:
+            yield self.record
+            self.record = None
+
+    def _read_lines(self):
+        if self.ended:
+            return
+        with open(self.path, 'rb') as log_f:
+            if self.offset is None:
+                self.offset = 0
+                if self.start_key is not None:
+                    # timestamps of old logs are not in ISO format, so only
+                    # bisect on the date and filter the rest line by line
+                    self.offset = find_log_offset(log_f, self.start_key[:10])
+            log_f.seek(self.offset)
+            for raw in log_f:
+                if not raw.endswith(b'\n'):
+                    # incomplete line, read it again next time
+                    break
+                self.offset += len(raw)
+                line = raw.decode(errors='replace')
+                if not line[:4].isdigit():
+                    if self.skipping:
+                        continue
+                    if self.record is None:
+                        self.record = ('', [])
+                    self.record[1].append(line)
+                    continue
+                key = timestamp_key(line)
+                if self.end_key is not None and key >= self.end_key:
+                    self.ended = True
+                    break
+                self.last_key = key
+                if self.record is not None:
+                    yield self.record
+                    self.record = None
+                self.skipping = self.start_key is not None \
+                    and key < self.start_key
+                if not self.skipping:
+                    self.record = (key, [line])
+
+
+def record_key(record):
+    return record[0]
+
+
+class RecordFormatter:
+    """Filter records by rank and line class and color their lines."""
+
+    def __init__(self, ranks=None, classes=None, color=False):
+        self.ranks = None if ranks is None else set(ranks)
+        self.classes = None if classes is None else set(classes)
+        self.color = color
+
+    def format(self, record):
+        """Return the text of the record to be shown, possibly empty."""
+        head = record[1][0]
+        if not head[:4].isdigit():
+            line_class, rank = 'continuation', None
+        elif self.ranks is None and self.classes is None and not self.color:
+            return ''.join(record[1])
+        else:
+            line_class, fields = parse_line(head)
+            # malformed lines are shown like any other line
+            line_class = line_class or 'other'
+            rank = int(fields['rank'])
+        if self.ranks is not None and rank not in self.ranks:
+            return ''
+        lines = record[1]
+        if self.classes is not None:
+            if line_class == 'continuation':
+                return ''.join(lines) \
+                    if 'continuation' in self.classes else ''
+            if line_class not in self.classes:
+                return ''
+            if 'continuation' not in self.classes:
+                lines = lines[:1]
+        if not self.color:
+            return ''.join(lines)
+        code = CLASS_COLORS.get((line_class, rank),
+                                CLASS_COLORS.get(line_class))
+        text = [self.colored(lines[0], code)]
+        text += [
+            self.colored(line, CLASS_COLORS['continuation'])
+            for line in lines[1:]
+        ]
+        return ''.join(text)
+
+    @staticmethod
+    def colored(line, code):
+        if code is None:
+            return line
+        line = line.rstrip('\n')
+        return f'\033[{code}m{line}\033[0m\n'
+
+
+def find_logs(patterns):
+    return sorted(set(path for pattern in patterns
+                      for path in glob.glob(pattern)))
+
+
+def merge(streams, formatter, out):
+    """Merge all the records of the given streams."""
+    for record in heapq.merge(*[s.read() for s in streams], key=record_key):
+        out.write(formatter.format(record))
+
+
+def follow(streams, formatter, out, args):
+    """Keep merging the records appended to the logs, and to the logs
+    matching the glob expressions later on, until interrupted.
+    """
+    pending = []
+    while True:
+        refresh_start = time.monotonic()
+        # pick up new and rotated logs
+        by_id = {s.file_id: s for s in streams}
+        for path in find_logs(args.log_glob):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id in by_id:
+                by_id[file_id].path = path
+            else:
+                logging.info('Following %s', path)
+                by_id[file_id] = LogStream(path, args.start, args.end)
+        streams = []
+        for stream in by_id.values():
+            if os.path.exists(stream.path):
+                streams.append(stream)
+            else:
+                # deleted or rotated away: flush what is left
+                pending = list(heapq.merge(
+                    pending, [stream.record] if stream.record else [],
+                    key=record_key
+                ))
+
+        now = time.monotonic()
+        new = []
+        for stream in streams:
+            quiet = now - stream.last_growth > args.max_delay
+            new.append(list(stream.read(final=quiet)))
+        pending = list(heapq.merge(pending, *new, key=record_key))
+
+        # every log is sorted, so no line earlier than the latest line of
+        # each growing log can still appear
+        growing = [s.last_key for s in streams
+                   if now - s.last_growth <= args.max_delay]
+        watermark = min(growing) if growing else None
+        shown = 0
+        for record in pending:
+            if watermark is not None and record[0] > watermark:
+                break
+            out.write(formatter.format(record))
+            shown += 1
+        del pending[:shown]
+        out.flush()
+
+        elapsed = time.monotonic() - refresh_start
+        time.sleep(max(args.refresh_interval - elapsed, 0))
+
+
+def main():
+    args = parse_cli()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
+    )
+
+    paths = find_logs(args.log_glob)
+    if not paths and not args.follow:
+        raise RuntimeError(f'No files match {args.log_glob}')
+    streams = [LogStream(path, args.start, args.end) for path in paths]
+    formatter = RecordFormatter(
+        ranks=args.ranks,
+        classes=args.classes,
+        color=(args.color == 'always'
+               or (args.color == 'auto' and sys.stdout.isatty()))
+    )
+
+    try:
+        if args.follow:
+            # catch up with the existing lines in constant memory, keeping
+            # the last record of each log open
+            for record in heapq.merge(
+                    *[s.read(final=False) for s in streams], key=record_key):
+                sys.stdout.write(formatter.format(record))
+            follow(streams, formatter, sys.stdout, args)
+        else:
+            merge(streams, formatter, sys.stdout)
+    except BrokenPipeError:
+        # e.g. piped into head
+        sys.stderr.close()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
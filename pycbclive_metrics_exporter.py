@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""Serve metrics about a running PyCBC Live analysis to Prometheus.
+
+The logs are read incrementally: each scrape of the /metrics endpoint only
+parses the lines appended since the previous scrape, and updates gauges
+with the latest lag, number of usable detectors and duty factor of each
+MPI rank, histograms of the lag and duty factor, and counters of restarts,
+late data and parsed lines.
+"""
+
+import argparse
+import datetime
+import logging
+import http.server
+import threading
+import numpy as np
+
+from pycbclive_gpstime import gps_to_unix
+from pycbclive_logs import LINE_CLASSES, LogFollower, LogParser
+
+
+# default upper bounds of the histogram buckets
+LAG_BUCKETS = [5, 7.5, 10, 15, 20, 30, 60, 120, 300]
+DUTY_FACTOR_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1, 1.5, 2]
+
+# name, help and column of the gauges giving the latest value of each rank
+GAUGES = [
+    ('pycbclive_lag_seconds', 'Latest lag reported by each rank.', 'lag'),
+    ('pycbclive_live_detectors',
+     'Latest number of usable detectors reported by each rank.', 'n_det'),
+    ('pycbclive_duty_factor', 'Latest duty factor reported by each rank.',
+     'duty_factor'),
+    ('pycbclive_last_report_timestamp_seconds',
+     'Unix time of the latest Took line of each rank.', 'gps_time'),
+]
+
+# name, help and line class of the counters of lines of each rank
+COUNTERS = [
+    ('pycbclive_restarts_total', 'Number of (re)starts of each rank.',
+     'starting'),
+    ('pycbclive_late_data_total',
+     'Number of messages about late data from each rank.', 'late'),
+]
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--log-glob',
+        required=True,
+        nargs='+',
+        help='Glob expression(s) for finding the PyCBC Live logs.'
+    )
+    parser.add_argument(
+        '--host',
+        default='localhost',
+        help='Address to listen on, default localhost.'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=9800,
+        help='Port to listen on, default 9800.'
+    )
+    parser.add_argument(
+        '--start',
+        help='Read the logs from this UTC time on, given as the start of an '
+             'ISO timestamp. By default, only lines written after the '
+             'exporter starts are read.'
+    )
+    parser.add_argument(
+        '--lag-buckets',
+        type=float,
+        nargs='+',
+        default=LAG_BUCKETS,
+        help='Upper bounds of the buckets of the lag histograms, in seconds.'
+    )
+    parser.add_argument(
+        '--duty-factor-buckets',
+        type=float,
+        nargs='+',
+        default=DUTY_FACTOR_BUCKETS,
+        help='Upper bounds of the buckets of the duty factor histograms.'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true'
+    )
+    return parser.parse_args()
+
+
+class Histograms:
+    """Prometheus histograms of a quantity, one per rank."""
+
+    def __init__(self, name, help_text, bounds):
+        self.name = name
+        self.help_text = help_text
+        self.bounds = np.sort(np.asarray(bounds, dtype=float))
+        # rank -> counts per bucket, the last one being +Inf
+        self.counts = {}
+        # rank -> sum of the observed values
+        self.sums = {}
+
+    def observe(self, ranks, values):
+        keep = np.isfinite(values)
+        ranks = ranks[keep]
+        values = values[keep]
+        # Prometheus buckets count the values less than or equal to their
+        # upper bound
+        buckets = np.searchsorted(self.bounds, values, side='left')
+        for rank in np.unique(ranks):
+            sel = ranks == rank
+            rank = int(rank)
+            counts = np.bincount(buckets[sel], minlength=len(self.bounds) + 1)
+            if rank in self.counts:
+                self.counts[rank] += counts
+                self.sums[rank] += values[sel].sum()
+            else:
+                self.counts[rank] = counts
+                self.sums[rank] = values[sel].sum()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} histogram']
+        for rank in sorted(self.counts):
+            cum = np.cumsum(self.counts[rank])
+            for bound, count in zip(self.bounds, cum):
+                lines.append(
+                    f'{self.name}_bucket{{rank="{rank}",le="{bound:g}"}} '
+                    f'{count}'
+                )
+            lines.append(f'{self.name}_bucket{{rank="{rank}",le="+Inf"}} '
+                         f'{cum[-1]}')
+            lines.append(f'{self.name}_sum{{rank="{rank}"}} '
+                         f'{float(self.sums[rank])!r}')
+            lines.append(f'{self.name}_count{{rank="{rank}"}} {cum[-1]}')
+        return lines
+
+
+class LogMetrics:
+    """Metrics accumulated from the lines appended to the logs."""
+
+    def __init__(self, follower, lag_buckets, duty_factor_buckets):
+        self.follower = follower
+        self.parser = LogParser(classes=['took', 'starting', 'late'])
+        # column -> rank -> latest value
+        self.latest = {column: {} for _, _, column in GAUGES}
+        # line class -> rank -> number of lines
+        self.line_counts = {line_class: {} for _, _, line_class in COUNTERS}
+        self.histograms = {
+            'lag': Histograms(
+                'pycbclive_lag_distribution_seconds',
+                'Lag reported by each rank.', lag_buckets
+            ),
+            'duty_factor': Histograms(
+                'pycbclive_duty_factor_distribution',
+                'Duty factor reported by each rank.', duty_factor_buckets
+            )
+        }
+        # scrapes can come from several threads
+        self.lock = threading.Lock()
+
+    def update(self):
+        """Parse the lines appended to the logs since the previous update."""
+        for text in self.follower.read_new_text():
+            columns = self.parser.parse_text(text)
+            ranks = columns['rank']
+            for i, line_class in enumerate(LINE_CLASSES):
+                if line_class not in self.line_counts:
+                    continue
+                counts = self.line_counts[line_class]
+                sel_ranks, num = np.unique(
+                    ranks[columns['line_class'] == i], return_counts=True
+                )
+                for rank, n in zip(sel_ranks, num):
+                    counts[int(rank)] = counts.get(int(rank), 0) + int(n)
+
+            took = columns['line_class'] == LINE_CLASSES.index('took')
+            ranks = ranks[took]
+            for column, latest in self.latest.items():
+                values = columns[column][took]
+                # the last line of each rank has the latest values
+                unique, last = np.unique(ranks[::-1], return_index=True)
+                for rank, index in zip(unique, len(ranks) - 1 - last):
+                    latest[int(rank)] = values[index]
+            for column, histograms in self.histograms.items():
+                histograms.observe(ranks, columns[column][took])
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        for name, help_text, column in GAUGES:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+            latest = self.latest[column]
+            if column == 'gps_time':
+                latest = {r: gps_to_unix(t) for r, t in latest.items()}
+            lines += [f'{name}{{rank="{rank}"}} {float(latest[rank])!r}'
+                      for rank in sorted(latest)
+                      if np.isfinite(latest[rank])]
+        for name, help_text, line_class in COUNTERS:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            counts = self.line_counts[line_class]
+            lines += [f'{name}{{rank="{rank}"}} {counts[rank]}'
+                      for rank in sorted(counts)]
+        for histograms in self.histograms.values():
+            lines += histograms.render()
+        for name, help_text, counts in [
+                ('pycbclive_log_lines_total',
+                 'Number of log lines read, by class.', self.parser.counts),
+                ('pycbclive_malformed_log_lines_total',
+                 'Number of log lines which could not be parsed, by class.',
+                 self.parser.malformed)]:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [f'{name}{{class="{c}"}} {n}'
+                      for c, n in sorted(counts.items())]
+        return '\n'.join(lines) + '\n'
+
+    def scrape(self):
+        with self.lock:
+            self.update()
+            return self.render()
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """HTTP server keeping the metrics to be served."""
+
+    def __init__(self, name_port, handler, metrics):
+        super().__init__(name_port, handler)
+        self.metrics = metrics
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        output = self.server.metrics.scrape().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def main():
+    args = parse_cli()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
+    )
+
+    start_key = args.start
+    if start_key is None:
+        start_key = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+    metrics = LogMetrics(
+        LogFollower(args.log_glob, start_key=start_key),
+        args.lag_buckets,
+        args.duty_factor_buckets
+    )
+    # read what is already there, so that the first scrape is not slow
+    metrics.scrape()
+
+    logging.info('Serving metrics on http://%s:%d/metrics', args.host,
+                 args.port)
+    with MetricsServer((args.host, args.port), MetricsHandler,
+                       metrics) as httpd:
+        httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,17 @@ mpl.use('agg')
 import pylab as pl
 
 
+def iter_foreground(f):
+    """Yield the foreground groups of a PyCBC Live file, or of all the files
+    merged into a trigger store by `pycbclive_compact_triggers.py`.
+    """
+    if 'pycbclive_trigger_store' in f.attrs:
+        for name in f['foreground']:
+            yield f['foreground'][name]
+    elif 'foreground' in f:
+        yield f['foreground']
+
+
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('--trigger-glob', type=str, required=True)
 parser.add_argument('--output-file', type=str, required=True)
@@ -24,17 +35,16 @@ tdurs = []
 
 for fn in glob.glob(args.trigger_glob):
     with h5py.File(fn, 'r') as f:
-        if 'foreground' not in f:
-            continue
-        stat = f['foreground/stat'][0]
-        ifos = f['foreground/type'][()]
-        ifos = sorted(ifos.split('-'))
-        time = np.mean([f['foreground/' + ifo + '/end_time'][()] for ifo in ifos])
-        tdur = f['foreground/' + ifos[0] + '/template_duration'][()]
-        stats.append(stat)
-        ifos.append(ifos)
-        times.append(time)
-        tdurs.append(tdur)
+        for fg in iter_foreground(f):
+            stat = fg['stat'][0]
+            ifos = fg['type'][()]
+            ifos = sorted(ifos.split('-'))
+            time = np.mean([fg[ifo + '/end_time'][()] for ifo in ifos])
+            tdur = fg[ifos[0] + '/template_duration'][()]
+            stats.append(stat)
+            ifos.append(ifos)
+            times.append(time)
+            tdurs.append(tdur)
 
 stats = np.array(stats)
 times = np.array(times)
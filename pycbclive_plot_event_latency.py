@@ -8,19 +8,22 @@ events from all pipelines and their latency compared to the event time.
 import argparse
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib
 matplotlib.use('agg')
 from matplotlib import pyplot as plt
 from datetime import datetime as dtdt
 from lal.gpstime import gps_to_utc, utc_to_gps
-from ligo.gracedb.rest import GraceDb as gdb
 
 # This is the only pycbc import at the moment - it might be nice to get this into a
 # LAL (or similar) function, so the folks at gwcelery are more likely to adopt this
 from pycbc.waveform.spa_tmplt import spa_length_in_time
 from pycbc import init_logging
 
+from pycbclive_gracedb import DEFAULT_CACHE_PATH, GraceDBCache, ThreadClients
+
 
 # Set up dictionaries to use for the different pipelines and searches
 
@@ -92,6 +95,43 @@ parser.add_argument("--pipeline-only", choices=list(pipelinenames.keys()),
                     help="Only plot events form this pipeline")
 parser.add_argument("--search-only", choices=list(searchnames.keys()),
                     help="Only plot events form this search")
+parser.add_argument("--watch", action='store_true',
+                    help="Keep polling the superevent and the logs of its "
+                         "events, updating the plots with new uploads, "
+                         "until --watch-timeout")
+parser.add_argument("--watch-interval", type=float, default=10,
+                    help="Seconds between polls with --watch. Default 10")
+parser.add_argument("--watch-timeout", type=float, default=3600,
+                    help="Stop watching after this many seconds. "
+                         "Default 3600")
+parser.add_argument("--max-workers", type=int, default=8,
+                    help="Maximum number of concurrent requests to GraceDB. "
+                         "Default 8")
+parser.add_argument("--retries", type=int, default=5,
+                    help="Number of times a failed request to GraceDB is "
+                         "retried. Default 5")
+parser.add_argument("--retry-backoff", type=float, default=0.5,
+                    help="Backoff factor (seconds) of the retries, which "
+                         "wait for 0.5, 1, 2... times this. Default 0.5")
+parser.add_argument("--cache-file", default=DEFAULT_CACHE_PATH,
+                    help="SQLite file caching the responses of GraceDB. "
+                         f"Default {DEFAULT_CACHE_PATH}")
+parser.add_argument("--no-cache", action='store_true',
+                    help="Do not use or update the cache")
+parser.add_argument("--cache-ttl", type=float, default=300,
+                    help="Superevents, searches and logs cached less than "
+                         "this many seconds ago are not fetched again. "
+                         "Events are always taken from the cache. "
+                         "Default 300")
+parser.add_argument("--cache-max-age", type=float, default=30,
+                    help="Evict cache entries unused for this many days. "
+                         "Default 30")
+parser.add_argument("--cache-max-size", type=float, default=200,
+                    help="Evict the least recently used cache entries "
+                         "beyond this size in MB. Default 200")
+parser.add_argument("--offline", action='store_true',
+                    help="Do not contact GraceDB, take everything from the "
+                         "cache")
 parser.add_argument("--verbose", action='store_true',
                     help="Print logging statements")
 args = parser.parse_args()
@@ -103,9 +143,29 @@ if (not args.superevent_id) == (not args.event_id):
     parser.error("One of --superevent-id or --event-id must be given, "
                  "but not both.")
 
-client = gdb(service_url=args.gracedb_server)
-logging.info("Pinging GDB server")
-client.ping()
+if args.no_cache and args.offline:
+    parser.error("--offline needs the cache")
+if args.watch and (args.offline or not args.superevent_id):
+    parser.error("--watch needs --superevent-id and cannot be used offline")
+
+get_client = None
+if not args.offline:
+    get_client = ThreadClients(args.gracedb_server, args.retries,
+                               args.retry_backoff)
+    logging.info("Pinging GDB server")
+    get_client().ping()
+cache = GraceDBCache(
+    ':memory:' if args.no_cache else args.cache_file,
+    args.gracedb_server,
+    get_client,
+    ttl=args.cache_ttl,
+    max_age=args.cache_max_age * 86400,
+    max_size=args.cache_max_size * 2 ** 20,
+    offline=args.offline
+)
+
+fetch_start = time.perf_counter()
+pool = ThreadPoolExecutor(max_workers=args.max_workers)
 
 # Get the time difference between the final merger frequency and when this
 # template ended
@@ -125,10 +185,12 @@ def premerger_time(e_event, f_final=None):
                               phase_order=-1)
     return pm_t
 
-def get_event_info(event, central_time):
-    g = event['graceid']
+# Numbers of the log entries already plotted for each event
+plotted_logs = {}
+
+def get_log_times(logs, central_time):
     log_times = {k: [] for k in ['file', 'comment']}
-    for log in client.logs(event['graceid']).json()['log']:
+    for log in logs:
         dt_log = dtdt.strptime(log['created'], "%Y-%m-%d %H:%M:%S %Z")
         tlog = float(utc_to_gps(dt_log) - central_time)
         # Original upload / creation do not get plotted
@@ -139,6 +201,13 @@ def get_event_info(event, central_time):
             log_times['comment'].append(tlog)
         else:
             log_times['file'].append(tlog)
+    return log_times
+
+def get_event_info(event, central_time):
+    g = event['graceid']
+    logs = cache.logs(g)
+    plotted_logs[g] = {log['N'] for log in logs}
+    log_times = get_log_times(logs, central_time)
     latency = event['reporting_latency']
     snr = event['extra_attributes']['CoincInspiral']['snr']
     prem_time = -premerger_time(event)
@@ -146,43 +215,49 @@ def get_event_info(event, central_time):
 
 
 if args.superevent_id:
-    response = client.superevent(args.superevent_id).json()
+    response = cache.superevent(args.superevent_id)
     logging.info("Getting highlight event info")
     g_highlight = response['preferred_event']
-    highlight_e = client.event(g_highlight).json()
+    highlight_e = cache.event(g_highlight)
     pref_coinc_insp = highlight_e['extra_attributes']['CoincInspiral']
     central_time = pref_coinc_insp['end_time'] \
                        + pref_coinc_insp['end_time_ns'] * 1e-9
-    pref_event_info = get_event_info(highlight_e, central_time)
+    pref_event_info = pool.submit(get_event_info, highlight_e, central_time)
     highlight_pipeline = highlight_e['pipeline'].lower()
     highlight_search = highlight_e['search']
 
-    # Get the list of g-events associated with the superevent
+    # Get the g-events associated with the superevent
     gevent_list = response['gw_events']
     gevent_list.remove(g_highlight)
+    nearby_events = list(pool.map(cache.event, gevent_list))
 else:
     # Get the event time of the given event
     g_highlight = args.event_id
-    highlight_e = client.event(args.event_id).json()
+    highlight_e = cache.event(args.event_id)
     # Use the original event time as central
     central_time = highlight_e['gpstime']
-    pref_event_info = get_event_info(highlight_e, central_time)
+    pref_event_info = pool.submit(get_event_info, highlight_e, central_time)
     highlight_pipeline = highlight_e['pipeline'].lower()
     highlight_search = highlight_e['search']
     query = f"{central_time - args.event_search_window} .. " + \
                 f"{central_time + args.event_search_window}"
-    gevent_list = [r['graceid'] for r in client.events(query=query)]
+    # Search the default, test and MDC groups concurrently, and use the
+    # events returned directly
+    queries = [query]
     if args.include_test:
-        test_query = "group: test " + query
-        gevent_list += [r['graceid'] for r in client.events(query=test_query)]
+        queries.append("group: test " + query)
     if args.include_mdc:
-        mdc_query = "group: mdc " + query
-        gevent_list += [r['graceid'] for r in client.events(query=mdc_query)]
-
-    # filter out the event if interest
-    gevent_list.remove(g_highlight)
-
-logging.info(f"Found {len(gevent_list)} events")
+        queries.append("group: mdc " + query)
+    nearby_events = []
+    seen = {g_highlight}
+    for events in pool.map(cache.events, queries):
+        for e in events:
+            # filter out the event of interest
+            if e['graceid'] not in seen:
+                seen.add(e['graceid'])
+                nearby_events.append(e)
+
+logging.info(f"Found {len(nearby_events)} events")
 
 logging.info("Getting nearby event info")
 
@@ -190,19 +265,26 @@ logging.info("Getting nearby event info")
 all_events = {pip: {s: [] for s in searchnames.keys()}
               for pip in pipelinenames.keys()}
 
-counter = 0
-for g in gevent_list:
-    e = client.event(g).json()
+# Select the events to plot before fetching their logs, concurrently. The
+# results come back in the order of the list, so the plot is the same as
+# when fetching one event at a time.
+selected = []
+for e in nearby_events:
     pipeline, search = e['pipeline'].lower(), e['search']
     if args.pipeline_only and not pipeline == args.pipeline_only:
         continue
     if args.search_only and not search == args.search_only:
         continue
-    counter += 1
-    gevent_info = get_event_info(e, central_time)
-    all_events[pipeline][search].append(gevent_info)
+    selected.append(e)
 
-logging.info(f"{counter} events to plot")
+logging.info(f"{len(selected)} events to plot")
+
+gevent_infos = pool.map(lambda e: get_event_info(e, central_time), selected)
+for e, gevent_info in zip(selected, gevent_infos):
+    all_events[e['pipeline'].lower()][e['search']].append(gevent_info)
+pref_event_info = pref_event_info.result()
+logging.info(f"Fetched all events and logs in "
+             f"{time.perf_counter() - fetch_start:.2f} s")
 
 logging.info("Plotting events")
 # plot all events, with colours and edges to define the source
@@ -233,9 +315,13 @@ def add_to_plot(ax, event_info, pipeline, search, xlim, highlight=False):
         ax.scatter([arr_end],[snr_above],
                    color=pipelinecolours[pipeline],
                    marker='>', zorder=100)
+    return add_logs_to_plot(ax, log_times, pipeline, search, snr, xlim_new)
+
+def add_logs_to_plot(ax, log_times, pipeline, search, snr, xlim):
+    xlim_new = xlim
     for k in ['comment', 'file']:
         xlim_new = [xlim_new[0],
-                    max(xlim_new[1], max(log_times[k]))]
+                    max(xlim_new[1], max(log_times[k], default=xlim_new[1]))]
         ax.scatter(log_times[k], snr * np.ones_like(log_times[k]),
                    color=pipelinecolours[pipeline],
                    marker=_marker[k], s=10,
@@ -244,6 +330,10 @@ def add_to_plot(ax, event_info, pipeline, search, xlim, highlight=False):
 
 
 xlim = [0, 0]
+# Pipeline, search and SNR of the plotted events, for plotting their new
+# log entries in --watch mode
+plotted_events = {g_highlight: (highlight_pipeline, highlight_search,
+                                pref_event_info[2])}
 
 for pipeline in all_events.keys():
     for search in all_events[pipeline]:
@@ -251,12 +341,15 @@ for pipeline in all_events.keys():
         events_info = tuple(zip(*all_events[pipeline][search]))
         for event_info in zip(*events_info):
             xlim = add_to_plot(ax, event_info, pipeline, search, xlim)
+            plotted_events[event_info[0]] = (pipeline, search, event_info[2])
 
 # Plot highlight scatter point
 xlim = add_to_plot(ax, pref_event_info, highlight_pipeline,
                    highlight_search, xlim, highlight=True)
 
-xlim = [xlim[0] - 6, min(xlim[1], args.latency_limit) + 6]
+def padded_xlim(xlim):
+    return [xlim[0] - 6, min(xlim[1], args.latency_limit) + 6]
+
 ylim_orig = ax.get_ylim()
 
 # Want to make the legend general - plot some default colours off the
@@ -311,7 +404,7 @@ leg2_labels.append("Template end to upload")
 
 # Cut off the points used for adding to the legend
 ax.set_ylim(bottom=max(4, ylim_orig[0]), top=ylim_orig[1])
-ax.set_xlim(xlim)
+ax.set_xlim(padded_xlim(xlim))
 
 # Set up the legends - want to be outside the plot so it never overlaps
 # with the data
@@ -345,7 +438,68 @@ fig.subplots_adjust(left=0.1, right=0.75)
 
 id_str = args.superevent_id or args.event_id
 filetrunk = os.path.join(args.output_dir, f"{id_str}_timeline")
-fig.savefig(filetrunk + '.pdf')
-fig.savefig(filetrunk + '.png')
+
+def save_figure():
+    """Save the plots, replacing the existing files atomically so that
+    viewers never see a partially written plot.
+    """
+    for ext in ['pdf', 'png']:
+        fig.savefig(f"{filetrunk}.tmp.{ext}")
+        os.replace(f"{filetrunk}.tmp.{ext}", f"{filetrunk}.{ext}")
+
+save_figure()
+
+if args.watch:
+    # Only the superevent and the log entries after the last one seen are
+    # fetched at each poll, and only the new points are added to the figure
+    cache.ttl = 0
+    watch_end = time.monotonic() + args.watch_timeout
+    # events not plotted because of --pipeline-only or --search-only
+    skipped = set()
+    while time.monotonic() + args.watch_interval < watch_end:
+        time.sleep(args.watch_interval)
+        poll_start = time.perf_counter()
+        response = cache.superevent(args.superevent_id)
+        new_gs = [g for g in response['gw_events']
+                  if g not in plotted_events and g not in skipped]
+        new_events = []
+        for e in pool.map(cache.event, new_gs):
+            pipeline, search = e['pipeline'].lower(), e['search']
+            if (args.pipeline_only and not pipeline == args.pipeline_only) \
+                    or (args.search_only and not search == args.search_only):
+                skipped.add(e['graceid'])
+            else:
+                new_events.append(e)
+        old_gs = list(plotted_events)
+        num_new_logs = 0
+        for g, logs in zip(old_gs, pool.map(cache.logs, old_gs)):
+            new_logs = [log for log in logs
+                        if log['N'] not in plotted_logs[g]]
+            if not new_logs:
+                continue
+            plotted_logs[g].update(log['N'] for log in new_logs)
+            num_new_logs += len(new_logs)
+            pipeline, search, snr = plotted_events[g]
+            xlim = add_logs_to_plot(ax, get_log_times(new_logs, central_time),
+                                    pipeline, search, snr, xlim)
+        infos = pool.map(lambda e: get_event_info(e, central_time),
+                         new_events)
+        for e, event_info in zip(new_events, infos):
+            pipeline, search = e['pipeline'].lower(), e['search']
+            xlim = add_to_plot(ax, event_info, pipeline, search, xlim)
+            plotted_events[e['graceid']] = (pipeline, search, event_info[2])
+            ylim = ax.get_ylim()
+            margin = 0.05 * (ylim[1] - ylim[0])
+            ax.set_ylim(min(ylim[0], max(4, event_info[2] - margin)),
+                        max(ylim[1], event_info[2] + margin))
+        logging.info(f"Polled in {time.perf_counter() - poll_start:.2f} s: "
+                     f"{len(new_events)} new events, {num_new_logs} new "
+                     "log entries")
+        if new_events or num_new_logs:
+            ax.set_xlim(padded_xlim(xlim))
+            save_figure()
+
+pool.shutdown()
+cache.close()
 
 logging.info('Done')
@@ -16,7 +16,9 @@ from scipy.stats import poisson
 
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('--input-files', type=str, required=True,
-                    help='Glob pattern for getting trigger files')
+                    help='Glob pattern for getting trigger files, or '
+                         'trigger stores made by '
+                         'pycbclive_compact_triggers.py')
 parser.add_argument('--output-plot', type=str, required=True,
                     help='Output path for the plot')
 parser.add_argument('--detection-times', type=float, nargs='+',
@@ -37,8 +39,57 @@ detection_times = None
 if args.detection_times:
     detection_times = np.array(args.detection_times)
 
+
+def add_candidate(fgg, command_line):
+    """Collect the IFAR, ranking statistic and FAR-relevant settings of a
+    candidate, unless it is a known detection.
+    """
+    try:
+        ifar = fgg['ifar'][()]
+        stat = fgg['stat'][0]
+        end_time = None
+        for ifo in ifos & set(fgg.keys()):
+            if 'end_time' in fgg[ifo]:
+                end_time = fgg[ifo + '/end_time']
+    except KeyError:
+        return
+    #if 'foreground/NO_FOLLOWUP' in f:
+    #    return
+
+    # don't count actual detections
+    if end_time is not None and detection_times is not None \
+            and np.any(np.abs(detection_times - end_time) < 2):
+        return
+
+    ifars.append(ifar)
+    stats.append(stat)
+
+    # pick up FAR-relevant settings
+    cl = command_line
+    for i, arg in enumerate(cl):
+        if i == 0:
+            continue
+        if cl[i-1] == '--ifar-upload-threshold':
+            upload_thresholds.add(float(arg))
+        elif cl[i-1] == '--pvalue-combination-livetime':
+            pvalue_livetimes.add(float(arg))
+        elif cl[i-1] == '--ifar-double-followup-threshold':
+            dfuts.add(float(arg))
+
+
 for fn in tqdm.tqdm(glob.glob(args.input_files)):
     with h5py.File(fn, 'r') as f:
+        if 'pycbclive_trigger_store' in f.attrs:
+            # trigger store made by pycbclive_compact_triggers.py
+            num_live_dets = f['files/num_live_detectors'][:]
+            time += 8 * np.count_nonzero(num_live_dets > 1)
+            for name, fgg in f['foreground'].items():
+                if fgg.attrs['num_live_detectors'] < 0:
+                    # legacy result
+                    continue
+                add_candidate(fgg, fgg.attrs['command_line'])
+            continue
+
         # skip legacy results, don't crash
         if 'num_live_detectors' not in f.attrs:
             continue
@@ -48,38 +99,8 @@ for fn in tqdm.tqdm(glob.glob(args.input_files)):
             time += 8
 
         # see if there is a candidate
-        try:
-            fgg = f['foreground']
-            ifar = fgg['ifar'][()]
-            stat = fgg['stat'][0]
-            end_time = None
-            for ifo in ifos & set(fgg.keys()):
-                if 'end_time' in fgg[ifo]:
-                    end_time = fgg[ifo + '/end_time']
-        except KeyError:
-            continue
-        #if 'foreground/NO_FOLLOWUP' in f:
-        #    continue
-
-        # don't count actual detections
-        if end_time is not None and detection_times is not None \
-                and np.any(np.abs(detection_times - end_time) < 2):
-            continue
-
-        ifars.append(ifar)
-        stats.append(stat)
-
-        # pick up FAR-relevant settings
-        cl = f.attrs['command_line']
-        for i, arg in enumerate(cl):
-            if i == 0:
-                continue
-            if cl[i-1] == '--ifar-upload-threshold':
-                upload_thresholds.add(float(arg))
-            elif cl[i-1] == '--pvalue-combination-livetime':
-                pvalue_livetimes.add(float(arg))
-            elif cl[i-1] == '--ifar-double-followup-threshold':
-                dfuts.add(float(arg))
+        if 'foreground' in f:
+            add_candidate(f['foreground'], f.attrs['command_line'])
 
 ifars = np.sort(np.array(ifars))
 count = np.arange(len(ifars))[::-1] + 1
@@ -15,7 +15,14 @@ with h5py.File(sys.argv[1], 'r') as hf:
         if ifo + '/psd' not in hf:
             continue
         df = hf[ifo + '/psd'].attrs['delta_f']
-        asd = hf[ifo + '/psd'][:] ** 0.5 / pycbc.DYN_RANGE_FAC
+        if 'pycbclive_trigger_store' in hf.attrs:
+            # trigger store made by pycbclive_compact_triggers.py,
+            # show the most recent PSD
+            latest = np.argmax(hf[ifo + '/psd_time'][:])
+            psd = hf[ifo + '/psd'][latest]
+        else:
+            psd = hf[ifo + '/psd'][:]
+        asd = psd ** 0.5 / pycbc.DYN_RANGE_FAC
         f = np.arange(len(asd)) * df
         pl.loglog(f, asd, '-', label=ifo, color=ifo_color(ifo))
 
@@ -8,18 +8,60 @@
 #   (probably only useful when plotting a few segments only).
 
 import argparse
+import collections
 import logging
 import os
+import time
+import shutil
+import tempfile
+import functools
+import multiprocessing
 import tqdm
 import numpy as np
 import matplotlib
 matplotlib.use('agg')
 import pylab as pl
 import h5py
-import lal
 import glob
+import hashlib
 from ligo.segments import segment, segmentlist
 from pycbc.events.ranking import newsnr_sgveto
+from pycbclive_gpstime import gps_to_utc, utc_to_gps
+
+
+# number of rows read at once from the trigger columns of a trigger store
+STORE_BLOCK_SIZE = 2 ** 20
+
+# rough upper limit on the memory needed to process one trigger when
+# making the plot, used to turn --memory-budget into a chunk size
+BYTES_PER_TRIGGER = 128
+
+# returned by the file reader when the file is a trigger store
+STORE = 'store'
+
+# Triggers are handled as lists of arrays [end times, template durations,
+# ranking statistic], followed by the template ids when a bank is given.
+
+# template parameters which can be read from the bank or derived from it
+BANK_PARAMS = [
+    'mass1', 'mass2', 'spin1z', 'spin2z', 'mchirp', 'mtotal', 'eta', 'chi_eff'
+]
+
+PARAM_LABELS = {
+    'template_duration': 'Template duration [s]',
+    'rank': '$\\chi^2$-weighted SNR',
+    'mass1': 'Mass 1 [$M_\\odot$]',
+    'mass2': 'Mass 2 [$M_\\odot$]',
+    'spin1z': 'Spin 1 z',
+    'spin2z': 'Spin 2 z',
+    'mchirp': 'Chirp mass [$M_\\odot$]',
+    'mtotal': 'Total mass [$M_\\odot$]',
+    'eta': 'Symmetric mass ratio',
+    'chi_eff': 'Effective spin'
+}
+
+# parameters shown on a logarithmic scale
+LOG_PARAMS = {'template_duration', 'mass1', 'mass2', 'mchirp', 'mtotal'}
 
 
 class Autorange:
@@ -32,8 +74,8 @@ class Autorange:
         self.set = False
 
     def update(self, values):
-        minv = min(values)
-        maxv = max(values)
+        minv = np.min(values)
+        maxv = np.max(values)
         if minv < self.low:
             self.low = minv
         if maxv > self.high:
@@ -41,6 +83,199 @@ class Autorange:
         self.set = True
 
 
+class TemplateBank:
+    """Columnar copy of the parameters of a template bank, indexed by
+    template id. The columns are read once from the bank file and, if a
+    cache directory is given, saved there as .npy files which are then
+    memory-mapped by later runs. Looking up the parameters of many triggers
+    is then a single vectorized gather.
+    """
+    def __init__(self, bank_file, cache_dir=None):
+        self.columns = None
+        if cache_dir is not None:
+            stat = os.stat(bank_file)
+            key = hashlib.sha1(
+                f'{os.path.abspath(bank_file)}:{stat.st_size}:{stat.st_mtime}'
+                .encode()
+            ).hexdigest()[:16]
+            cache_path = os.path.join(cache_dir, f'bank_{key}')
+            if os.path.isdir(cache_path):
+                self.columns = {
+                    param: np.load(
+                        os.path.join(cache_path, f'{param}.npy'),
+                        mmap_mode='r'
+                    )
+                    for param in BANK_PARAMS
+                }
+        if self.columns is None:
+            self.columns = self._read(bank_file)
+            if cache_dir is not None:
+                self._save(cache_path)
+
+    @staticmethod
+    def _read(bank_file):
+        logging.info('Reading template bank %s', bank_file)
+        with h5py.File(bank_file, 'r') as bank:
+            m1 = bank['mass1'][:]
+            m2 = bank['mass2'][:]
+            s1z = bank['spin1z'][:]
+            s2z = bank['spin2z'][:]
+        mtotal = m1 + m2
+        return {
+            'mass1': m1,
+            'mass2': m2,
+            'spin1z': s1z,
+            'spin2z': s2z,
+            'mchirp': (m1 * m2) ** 0.6 / mtotal ** 0.2,
+            'mtotal': mtotal,
+            'eta': m1 * m2 / mtotal ** 2,
+            'chi_eff': (m1 * s1z + m2 * s2z) / mtotal
+        }
+
+    def _save(self, cache_path):
+        # write to a temporary directory first, so that concurrent or
+        # interrupted runs never see a partial cache
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path))
+        for param, values in self.columns.items():
+            np.save(os.path.join(tmp_path, f'{param}.npy'), values)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+
+    def __getitem__(self, param):
+        return self.columns[param]
+
+
+def trigger_param(param, chunk, bank):
+    """Return the values of a parameter for a chunk of triggers. The
+    template duration and ranking statistic come from the triggers, the
+    other parameters from the template bank.
+    """
+    if param == 'template_duration':
+        return chunk[1]
+    if param == 'rank':
+        return chunk[2]
+    return bank[param][chunk[3].astype(np.int64)]
+
+
+class ConcatenatedTriggers:
+    """Collects chunks of triggers and concatenates them once at the end."""
+    def __init__(self):
+        self.chunks = []
+
+    def add(self, chunk):
+        """Add a chunk [end times, template durations, ranking statistic]."""
+        self.chunks.append(chunk)
+
+    def result(self):
+        """Return all triggers as [end times, template durations, ranking
+        statistic], or None if no triggers were added.
+        """
+        if not self.chunks:
+            return None
+        return [np.concatenate(column) for column in zip(*self.chunks)]
+
+
+class LoudestTriggers:
+    """Keeps the N triggers with the largest ranking statistic out of a
+    stream of chunks of triggers. Incoming chunks are buffered and reduced
+    with a partial sort whenever the buffer exceeds twice the requested
+    size, so memory stays bounded however many triggers are streamed.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.chunks = []
+        self.num_buffered = 0
+
+    def add(self, chunk):
+        """Add a chunk [end times, template durations, ranking statistic]."""
+        self.chunks.append(chunk)
+        self.num_buffered += len(chunk[2])
+        if self.num_buffered > 2 * self.size:
+            self._reduce()
+
+    def _reduce(self):
+        columns = [np.concatenate(column) for column in zip(*self.chunks)]
+        if len(columns[2]) > self.size:
+            keep = np.argpartition(columns[2], -self.size)[-self.size:]
+            columns = [column[keep] for column in columns]
+        self.chunks = [columns]
+        self.num_buffered = len(columns[2])
+
+    def result(self):
+        """Return the loudest triggers as [end times, template durations,
+        ranking statistic], in no particular order, or None if no triggers
+        were added.
+        """
+        if not self.chunks:
+            return None
+        self._reduce()
+        return self.chunks[0]
+
+
+class SpilledTriggers:
+    """Collects chunks of triggers in memory-mapped scratch files, so that
+    the memory usage does not grow with the number of triggers. Chunks are
+    buffered in memory up to `buffer_bytes` and then appended to one file
+    per column.
+    """
+    def __init__(self, scratch_dir, name, buffer_bytes):
+        self.scratch_dir = scratch_dir
+        self.name = name
+        self.paths = None
+        self.buffer_bytes = buffer_bytes
+        self.chunks = []
+        self.num_buffered = 0
+        self.num_spilled = 0
+
+    def add(self, chunk):
+        """Add a chunk [end times, template durations, ranking statistic]."""
+        if self.paths is None:
+            self.paths = [
+                os.path.join(self.scratch_dir, f'{self.name}_{i}.f8')
+                for i in range(len(chunk))
+            ]
+        self.chunks.append(chunk)
+        self.num_buffered += len(chunk[2])
+        if self.num_buffered * 8 * len(self.paths) >= self.buffer_bytes:
+            self._spill()
+
+    def _spill(self):
+        for path, column in zip(self.paths, zip(*self.chunks)):
+            with open(path, 'ab') as column_file:
+                np.concatenate(column).astype(np.float64).tofile(column_file)
+        self.num_spilled += self.num_buffered
+        self.chunks = []
+        self.num_buffered = 0
+
+    def result(self):
+        """Return all triggers as read-only memory-mapped arrays [end times,
+        template durations, ranking statistic], or None if no triggers were
+        added.
+        """
+        if self.chunks:
+            self._spill()
+        if self.num_spilled == 0:
+            return None
+        return [
+            np.memmap(path, dtype=np.float64, mode='r',
+                      shape=(self.num_spilled,))
+            for path in self.paths
+        ]
+
+
+def iter_chunks(arrays, chunk_size):
+    """Iterate over aligned slices of the given arrays. Slices of in-memory
+    arrays are views, while slices of memory-mapped arrays are only read
+    from disk when used, so this bounds the memory used by processing the
+    triggers one chunk at a time.
+    """
+    for start in range(0, len(arrays[0]), chunk_size):
+        yield [a[start:start + chunk_size] for a in arrays]
+
+
 def plot_gate(ax, gate):
     g_time, g_width, g_taper = gate
     ax.axvspan(
@@ -52,74 +287,191 @@ def plot_gate(ax, gate):
     )
 
 
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument(
-    '--trigger-files-glob',
-    type=str,
-    required=True,
-    metavar='PATH',
-    help='Glob command to find HDF5 files containing triggers.'
-         'Must have the wildcards escaped, using a backslash, '
-         'or surrounding the argument in quotes'
-)
-parser.add_argument(
-    '--detectors',
-    type=str,
-    nargs='+',
-    default=['H1', 'L1', 'V1'],
-    help='Which detectors to plot'
-)
-parser.add_argument(
-    '--highlight-times',
-    type=float,
-    nargs='+',
-    metavar='GPS',
-    help='List of GPS times to mark with green dashed lines'
-)
-parser.add_argument(
-    '--gates',
-    type=str,
-    nargs='+',
-    metavar='IFO,CENTER,WIDTH,TAPER',
-    help='List of gating parameters to display'
-)
-parser.add_argument(
-    '--output-plot',
-    type=str,
-    required=True,
-    help='Path to output plot'
-)
-args = parser.parse_args()
-
-detectors = args.detectors
-
-fig = pl.figure(figsize=(20, 10))
-ax = {}
-n = 22
-for i, detector in enumerate(detectors):
-    ax[detector] = pl.subplot(len(detectors), n, (n*i + 1, n*i + n-1))
-    ax[detector].set_ylabel(f'{detector}\nTemplate duration [s]')
-    if i < len(detectors) - 1:
-        ax[detector].set_xticklabels([])
-ax['cb'] = pl.subplot(1, n, n)
-
-logging.info('Reading triggers')
-
-file_segs = segmentlist([])
-trig_segs = {d: segmentlist([]) for d in detectors}
-triggers = {d: None for d in detectors}
-gates = {d: [] for d in detectors}
-
-trigger_files = glob.glob(args.trigger_files_glob)
-
-for fn in tqdm.tqdm(sorted(trigger_files)):
+def raster_pixels(times, yvals, time_edges, y_edges, log_y):
+    """Return the flat pixel index of each trigger on a regular grid of time
+    and (possibly log10 of) a parameter, and a mask of the triggers falling
+    inside the grid.
+    """
+    num_x = len(time_edges) - 1
+    num_y = len(y_edges) - 1
+    if log_y:
+        yvals = np.log10(yvals)
+    ix = np.floor(
+        (times - time_edges[0]) / (time_edges[1] - time_edges[0])
+    ).astype(np.int64)
+    iy = np.floor(
+        (yvals - y_edges[0]) / (y_edges[1] - y_edges[0])
+    ).astype(np.int64)
+    keep = (ix >= 0) & (ix < num_x) & (iy >= 0) & (iy < num_y)
+    return iy * num_x + ix, keep
+
+
+def raster_max(times, yvals, ranks, time_edges, y_edges, log_y, image=None):
+    """Bin triggers on a regular grid of time and (possibly log10 of) a
+    parameter, and keep the maximum ranking statistic in each pixel, in a
+    single vectorized pass. The result has shape (parameter bins, time bins)
+    and is -inf for empty pixels. If `image` is given, it is updated in
+    place, so the triggers can be binned in several chunks.
+    """
+    if image is None:
+        image = np.full((len(y_edges) - 1, len(time_edges) - 1), -np.inf)
+    pixels, keep = raster_pixels(times, yvals, time_edges, y_edges, log_y)
+    np.maximum.at(image.reshape(-1), pixels[keep], ranks[keep])
+    return image
+
+
+def raster_color(times, yvals, ranks, colors, time_edges, y_edges, log_y,
+                 rank_image, image=None):
+    """Given the image of the maximum ranking statistic made by
+    `raster_max()`, make an image of the `colors` value of the loudest
+    trigger in each pixel. The result is NaN for empty pixels. If `image` is
+    given, it is updated in place, so the triggers can be processed in
+    several chunks.
+    """
+    if image is None:
+        image = np.full(rank_image.shape, np.nan)
+    pixels, keep = raster_pixels(times, yvals, time_edges, y_edges, log_y)
+    loudest = keep.copy()
+    loudest[keep] = ranks[keep] == rank_image.reshape(-1)[pixels[keep]]
+    image.reshape(-1)[pixels[loudest]] = colors[loudest]
+    return image
+
+
+def plot_raster(ax, image, time_edges, y_edges, log_y, vmin, vmax):
+    """Draw an image made by `raster_max()` or `raster_color()` with the same
+    color scale as the scatter plot of the triggers.
+    """
+    ax.pcolormesh(
+        time_edges,
+        10 ** y_edges if log_y else y_edges,
+        np.ma.masked_where(~np.isfinite(image), image),
+        vmin=vmin,
+        vmax=vmax,
+        cmap='magma_r',
+        shading='flat',
+        rasterized=True
+    )
+
+
+def raster_grid(ax, fig, dpi, time_range, y_range, log_y):
+    """Make the pixel grid for `raster_max()`, matching the resolution of the
+    given axes in the saved figure.
+    """
+    bbox = ax.get_window_extent()
+    num_x = max(1, int(round(bbox.width * dpi / fig.dpi)))
+    num_y = max(1, int(round(bbox.height * dpi / fig.dpi)))
+    time_edges = np.linspace(time_range[0], time_range[1], num_x + 1)
+    if log_y:
+        y_range = np.log10(y_range)
+    y_edges = np.linspace(y_range[0], y_range[1], num_y + 1)
+    return time_edges, y_edges
+
+
+def file_segment_from_times(start_time, duration):
+    return segment(int(start_time), int(start_time + duration) + 1)
+
+
+def read_trigger_columns(grp, min_rank=None, start=0, stop=None,
+                         template_ids=False):
+    """Read a range of triggers from an HDF5 group and calculate their
+    ranking statistic. If `min_rank` is given, only triggers with a ranking
+    statistic of at least `min_rank` are returned. As the re-weighted SNR
+    cannot exceed the SNR, triggers are first cut on SNR, so the ranking
+    statistic is only calculated for the survivors.
+
+    Returns a list of arrays [end times, template durations, ranking
+    statistic], followed by the template ids if `template_ids` is True.
+    """
+    snr = grp['snr'][start:stop]
+    if min_rank is None:
+        keep = slice(None)
+    else:
+        keep = np.flatnonzero(snr >= min_rank)
+        snr = snr[keep]
+    trig_ranks = newsnr_sgveto(
+        snr,
+        grp['chisq'][start:stop][keep],
+        grp['sg_chisq'][start:stop][keep]
+    )
+    trig_times = grp['end_time'][start:stop][keep]
+    trig_durs = grp['template_duration'][start:stop][keep]
+    columns = [trig_times, trig_durs, trig_ranks]
+    if template_ids:
+        columns.append(grp['template_id'][start:stop][keep])
+    if min_rank is not None:
+        louder = trig_ranks >= min_rank
+        columns = [column[louder] for column in columns]
+    return columns
+
+
+def iter_trigger_store(fn, detectors, min_rank=None, template_ids=False):
+    """Read the triggers and gates of the given detectors from a trigger
+    store made by `pycbclive_compact_triggers.py`, in blocks of at most
+    `STORE_BLOCK_SIZE` triggers, so that the memory usage stays bounded.
+    Yields tuples with the same content as those returned by
+    `read_trigger_file()`. Segments and gates are only in the first one.
+    """
+    with h5py.File(fn, 'r') as trigfile:
+        files = trigfile['files']
+        file_segments = [
+            file_segment_from_times(start, dur)
+            for start, dur in zip(files['start_time'][:], files['duration'][:])
+        ]
+        trig_segments = {}
+        gates = {}
+        for detector in detectors:
+            if detector not in trigfile:
+                continue
+            grp = trigfile[detector]
+            if 'gates' in grp:
+                gates[detector] = list(grp['gates'][:])
+            num_trigs = files[f'num_triggers/{detector}'][:]
+            trig_segments[detector] = [
+                fs for fs, nt in zip(file_segments, num_trigs) if nt > 0
+            ]
+        yield file_segments, trig_segments, gates, {}
+
+        for detector in detectors:
+            if detector not in trigfile or 'end_time' not in trigfile[detector]:
+                continue
+            grp = trigfile[detector]
+            for start in range(0, len(grp['end_time']), STORE_BLOCK_SIZE):
+                block = read_trigger_columns(
+                    grp, min_rank, start, start + STORE_BLOCK_SIZE,
+                    template_ids
+                )
+                yield [], {detector: []}, {}, {detector: block}
+
+
+def read_trigger_file(fn, detectors, min_rank=None, template_ids=False):
+    """Read the triggers and gates of the given detectors from a single
+    PyCBC Live HDF5 file, or from a trigger store, and calculate the ranking
+    statistic of the triggers. If `min_rank` is given, triggers with a
+    lower ranking statistic are discarded. If `template_ids` is True, the
+    template ids of the triggers are read too.
+
+    Returns a tuple (file segments, trigger segments, gates, triggers) where
+    the last three are dicts keyed by detector. Trigger segments are the
+    file segments where the detector has triggers. Triggers contain a list of
+    arrays [end times, template durations, ranking statistic] for the
+    detectors which have triggers. Returns None if the file cannot be read,
+    and STORE if the file is a trigger store, which must be read with
+    `iter_trigger_store()` instead.
+
+    This runs in worker processes, so it must not touch any global state.
+    """
+    trig_segments = {}
+    gates = {}
+    triggers = {}
     try:
         with h5py.File(fn, 'r') as trigfile:
+            if 'pycbclive_trigger_store' in trigfile.attrs:
+                return STORE
+
             fn_fields = os.path.basename(fn).replace('.hdf', '').split('-')
-            file_start_time = int(float(fn_fields[-2]))
-            file_end_time = int(float(fn_fields[-2]) + float(fn_fields[-1])) + 1
-            file_segment = segment(file_start_time, file_end_time)
-            file_segs.append(file_segment)
+            file_segment = file_segment_from_times(
+                float(fn_fields[-2]), float(fn_fields[-1])
+            )
 
             for detector in detectors:
                 if detector not in trigfile:
@@ -128,153 +480,490 @@ for fn in tqdm.tqdm(sorted(trigger_files)):
                 grp = trigfile[detector]
 
                 if 'gates' in grp:
-                    for gate in grp['gates'][:]:
-                        gates[detector].append(gate)
+                    gates[detector] = list(grp['gates'][:])
 
                 if 'end_time' not in grp or len(grp['end_time']) == 0:
                     continue
 
-                trig_segs[detector].append(file_segment)
-
-                trig_times = grp['end_time'][:]
-                trig_durs = grp['template_duration'][:]
-                trig_ranks = newsnr_sgveto(
-                    grp['snr'][:],
-                    grp['chisq'][:],
-                    grp['sg_chisq'][:]
+                trig_segments[detector] = [file_segment]
+                triggers[detector] = read_trigger_columns(
+                    grp, min_rank, template_ids=template_ids
                 )
-                if triggers[detector] is None:
-                    triggers[detector] = [trig_times, trig_durs, trig_ranks]
-                else:
-                    triggers[detector] = [
-                        np.concatenate((triggers[detector][0], trig_times)),
-                        np.concatenate((triggers[detector][1], trig_durs)),
-                        np.concatenate((triggers[detector][2], trig_ranks))
-                    ]
     except OSError:
-        logging.error(f'Failed reading {fn}, ignoring')
-
-logging.info('Plotting')
-
-ar_dur = Autorange()
-for detector in detectors:
-    if triggers[detector] is not None:
-        ar_dur.update(triggers[detector][1])
-
-file_segs.coalesce()
-for detector in detectors:
-    trig_segs[detector].coalesce()
-
-ax[detectors[-1]].set_xlabel('Time')
-
-for detector in detectors:
-    axd = ax[detector]
-    if triggers[detector] is None:
-        axd.text(
-            0.5,
-            0.5,
-            'No triggers',
-            horizontalalignment='center',
-            verticalalignment='center',
-            transform=axd.transAxes
+        return None
+    return [file_segment], trig_segments, gates, triggers
+
+
+def _map_chunk(func, items):
+    return [func(item) for item in items]
+
+
+def bounded_imap(pool, func, items, chunksize, max_chunks):
+    """Like `pool.imap`, but with at most `max_chunks` chunks of items being
+    processed or waiting to be consumed, so that results do not pile up in
+    memory when the workers are faster than the consumer.
+    """
+    pending = collections.deque()
+    for i in range(0, len(items), chunksize):
+        if len(pending) >= max_chunks:
+            yield from pending.popleft().get()
+        pending.append(
+            pool.apply_async(_map_chunk, (func, items[i:i + chunksize]))
         )
-        axd.set_yticks([])
-        continue
-    axd.grid()
-    axd.set_yscale('log')
-    axd.set_ylim(ar_dur.low * 0.8, ar_dur.high * 1.2)
-    # plot segments
-    axd.hlines(
-        [ar_dur.low * 0.8] * len(file_segs),
-        [s[0] for s in file_segs],
-        [s[1] for s in file_segs],
-        color='#ff0000',
-        lw=3
+    while pending:
+        yield from pending.popleft().get()
+
+
+def read_triggers(trigger_files, detectors, processes, min_rank=None,
+                  loudest_n=None, scratch_dir=None, memory_budget=None,
+                  template_ids=False):
+    """Read triggers and gates from a list of PyCBC Live HDF5 files or
+    trigger stores, using a pool of worker processes.
+
+    The per-file arrays are collected and concatenated only once at the end,
+    so the cost is linear in the number of files. Files are processed in
+    sorted order, so the result does not depend on the number of processes.
+    Triggers with ranking statistic below `min_rank` are discarded by the
+    workers. If `loudest_n` is given, only the loudest `loudest_n` triggers
+    of each detector are kept while reading. Otherwise, if `scratch_dir` is
+    given, the triggers are spilled to memory-mapped files in that
+    directory, buffering at most `memory_budget` bytes in memory. If
+    `template_ids` is True, the template ids of the triggers are read too.
+    """
+    trigger_files = sorted(trigger_files)
+    file_segs = segmentlist([])
+    trig_segs = {d: segmentlist([]) for d in detectors}
+    gates = {d: [] for d in detectors}
+    if loudest_n is not None:
+        sinks = {d: LoudestTriggers(loudest_n) for d in detectors}
+    elif scratch_dir is not None:
+        sinks = {
+            d: SpilledTriggers(scratch_dir, d, memory_budget / len(detectors))
+            for d in detectors
+        }
+    else:
+        sinks = {d: ConcatenatedTriggers() for d in detectors}
+
+    reader = functools.partial(
+        read_trigger_file,
+        detectors=detectors,
+        min_rank=min_rank,
+        template_ids=template_ids
+    )
+    start_time = time.monotonic()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = bounded_imap(pool, reader, trigger_files, chunksize=16,
+                               max_chunks=2 * processes)
+    else:
+        pool = None
+        results = map(reader, trigger_files)
+
+    progress = tqdm.tqdm(results, total=len(trigger_files))
+    for result, fn in zip(progress, trigger_files):
+        if result is None:
+            logging.error(f'Failed reading {fn}, ignoring')
+            continue
+        if result == STORE:
+            results_for_file = iter_trigger_store(
+                fn, detectors, min_rank, template_ids
+            )
+        else:
+            results_for_file = [result]
+        for file_segments, file_trig_segs, file_gates, file_triggers \
+                in results_for_file:
+            file_segs.extend(file_segments)
+            for detector in file_gates:
+                gates[detector] += file_gates[detector]
+            for detector in file_trig_segs:
+                trig_segs[detector].extend(file_trig_segs[detector])
+            for detector in file_triggers:
+                sinks[detector].add(file_triggers[detector])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.monotonic() - start_time
+    logging.info(
+        f'Read {len(trigger_files)} files in {elapsed:.1f} s '
+        f'({len(trigger_files) / max(elapsed, 1e-9):.1f} files/s)'
     )
-    axd.hlines(
-        [ar_dur.low * 0.8] * len(trig_segs[detector]),
-        [s[0] for s in trig_segs[detector]],
-        [s[1] for s in trig_segs[detector]],
-        color='#00ff00',
-        lw=3
+
+    triggers = {d: None for d in detectors}
+    for detector in detectors:
+        columns = sinks[detector].result()
+        if columns is not None and len(columns[2]) > 0:
+            triggers[detector] = columns
+    return file_segs, trig_segs, triggers, gates
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--trigger-files-glob',
+        type=str,
+        required=True,
+        metavar='PATH',
+        help='Glob command to find HDF5 files containing triggers, '
+             'or trigger stores made by pycbclive_compact_triggers.py. '
+             'Must have the wildcards escaped, using a backslash, '
+             'or surrounding the argument in quotes'
     )
-    # plot triggers
-    sorter = np.argsort(triggers[detector][2])
-    print('Max {} rw SNR {:.2f} at {:.3f}'.format(
-        detector,
-        triggers[detector][2][sorter[-1]],
-        triggers[detector][0][sorter[-1]]
-    ))
-    axd.scatter(
-        triggers[detector][0][sorter],
-        triggers[detector][1][sorter],
-        c=triggers[detector][2][sorter],
-        vmin=6,
-        vmax=12,
-        cmap='magma_r',
-        s=4,
-        lw=0
+    parser.add_argument(
+        '--detectors',
+        type=str,
+        nargs='+',
+        default=['H1', 'L1', 'V1'],
+        help='Which detectors to plot'
+    )
+    parser.add_argument(
+        '--highlight-times',
+        type=float,
+        nargs='+',
+        metavar='GPS',
+        help='List of GPS times to mark with green dashed lines'
+    )
+    parser.add_argument(
+        '--gates',
+        type=str,
+        nargs='+',
+        metavar='IFO,CENTER,WIDTH,TAPER',
+        help='List of gating parameters to display'
+    )
+    parser.add_argument(
+        '--output-plot',
+        type=str,
+        required=True,
+        help='Path to output plot'
+    )
+    parser.add_argument(
+        '--min-rank',
+        type=float,
+        help='Discard triggers with ranking statistic below this value '
+             'while reading. Reduces the memory usage considerably'
+    )
+    parser.add_argument(
+        '--loudest-n',
+        type=int,
+        metavar='N',
+        help='Only keep the N loudest triggers of each detector'
+    )
+    parser.add_argument(
+        '--bank-file',
+        type=str,
+        metavar='PATH',
+        help='Template bank used by the analysis. Required for plotting '
+             'template parameters via --y-param or --color-param'
+    )
+    parser.add_argument(
+        '--bank-cache-dir',
+        type=str,
+        metavar='PATH',
+        help='Directory where a columnar copy of the template bank is '
+             'cached, so that later runs can memory-map it'
+    )
+    parser.add_argument(
+        '--y-param',
+        choices=['template_duration'] + BANK_PARAMS,
+        default='template_duration',
+        help='Parameter shown on the vertical axis, default '
+             'template_duration'
+    )
+    parser.add_argument(
+        '--color-param',
+        choices=['rank'] + BANK_PARAMS,
+        default='rank',
+        help='Parameter shown by the color of the triggers, default rank '
+             '(the chi^2-weighted SNR)'
+    )
+    parser.add_argument(
+        '--raster',
+        action='store_true',
+        help='Instead of drawing each trigger, show the maximum ranking '
+             'statistic in each pixel of the plot. Much faster and lighter '
+             'for large numbers of triggers'
+    )
+    parser.add_argument(
+        '--scratch-dir',
+        type=str,
+        metavar='PATH',
+        help='Out-of-core mode for very long spans: spill the triggers to '
+             'memory-mapped files in a temporary subdirectory of this path, '
+             'and process them in chunks. Implies --raster'
+    )
+    parser.add_argument(
+        '--memory-budget',
+        type=float,
+        default=1024,
+        metavar='MB',
+        help='Approximate memory used for buffering and processing '
+             'triggers in out-of-core mode, in MB, default 1024'
     )
-    for ht in (args.highlight_times or []):
-        axd.axvline(ht, ls='--', color='green')
-    # plot gates
-    for g in (args.gates or []):
-        gate = g.split(',')
-        if gate[0] != detector:
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=4,
+        help='Number of processes used for reading the trigger files, '
+             'default 4'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true'
+    )
+    args = parser.parse_args()
+    if args.bank_file is None and \
+            (args.y_param in BANK_PARAMS or args.color_param in BANK_PARAMS):
+        parser.error('--bank-file is required for plotting '
+                     'template parameters')
+    if args.loudest_n is not None and args.loudest_n < 1:
+        parser.error('--loudest-n must be at least 1')
+    return args
+
+
+def make_plot(args, scratch_dir):
+    detectors = args.detectors
+    dpi = 150
+    y_param = args.y_param
+    color_param = args.color_param
+    log_y = y_param in LOG_PARAMS
+
+    bank = None
+    if args.bank_file is not None:
+        bank = TemplateBank(args.bank_file, args.bank_cache_dir)
+
+    fig = pl.figure(figsize=(20, 10))
+    ax = {}
+    n = 22
+    for i, detector in enumerate(detectors):
+        ax[detector] = pl.subplot(len(detectors), n, (n*i + 1, n*i + n-1))
+        ax[detector].set_ylabel(f'{detector}\n{PARAM_LABELS[y_param]}')
+        if i < len(detectors) - 1:
+            ax[detector].set_xticklabels([])
+    ax['cb'] = pl.subplot(1, n, n)
+
+    memory_budget = args.memory_budget * 2 ** 20
+    chunk_size = max(1, int(memory_budget // BYTES_PER_TRIGGER))
+
+    logging.info('Reading triggers')
+
+    trigger_files = glob.glob(args.trigger_files_glob)
+    file_segs, trig_segs, triggers, gates = read_triggers(
+        trigger_files,
+        detectors,
+        args.processes,
+        min_rank=args.min_rank,
+        loudest_n=args.loudest_n,
+        scratch_dir=scratch_dir,
+        memory_budget=memory_budget,
+        template_ids=(bank is not None)
+    )
+
+    logging.info('Plotting')
+
+    ar_y = Autorange()
+    ar_color = Autorange()
+    for detector in detectors:
+        if triggers[detector] is None:
             continue
-        plot_gate(axd, map(float, gate[1:]))
-
-# make nice time ticks
-file_segs_extent = file_segs.extent()
-min_gps = int(file_segs_extent[0])
-max_gps = int(file_segs_extent[1])
-min_utc = list(lal.GPSToUTC(min_gps))
-if max_gps - min_gps > 3600:
-    # ticks every hour
-    min_utc[4] = 0
-    time_tick_delta = 3600
-    time_tick_fmt = '{0:04d}\n{1:02d}-{2:02d}\n{3:02d} UTC'
-else:
-    # ticks every minute
-    time_tick_delta = 60
-    time_tick_fmt = '{0:04d}-{1:02d}-{2:02d}\n{3:02d}:{4:02d} UTC'
-min_utc[5] = 0
-min_gps = lal.UTCToGPS(tuple(min_utc))
-time_ticks = []
-time_tick_labels = []
-while True:
-    if min_gps in file_segs_extent:
-        time_ticks.append(min_gps)
-        time_tick_labels.append(
-            time_tick_fmt.format(*lal.GPSToUTC(min_gps))
+        for chunk in iter_chunks(triggers[detector], chunk_size):
+            ar_y.update(trigger_param(y_param, chunk, bank))
+            if color_param != 'rank':
+                ar_color.update(trigger_param(color_param, chunk, bank))
+    if log_y:
+        y_range = (ar_y.low * 0.8, ar_y.high * 1.2)
+    else:
+        y_pad = max(0.05 * (ar_y.high - ar_y.low), 1e-3)
+        y_range = (ar_y.low - y_pad, ar_y.high + y_pad)
+    if color_param == 'rank' or not ar_color.set:
+        color_range = (6, 12)
+    else:
+        color_range = (ar_color.low, ar_color.high)
+
+    file_segs.coalesce()
+    for detector in detectors:
+        trig_segs[detector].coalesce()
+    file_segs_extent = file_segs.extent()
+
+    ax[detectors[-1]].set_xlabel('Time')
+
+    for detector in detectors:
+        axd = ax[detector]
+        if triggers[detector] is None:
+            axd.text(
+                0.5,
+                0.5,
+                'No triggers',
+                horizontalalignment='center',
+                verticalalignment='center',
+                transform=axd.transAxes
+            )
+            axd.set_yticks([])
+            continue
+        axd.grid()
+        if log_y:
+            axd.set_yscale('log')
+        axd.set_ylim(*y_range)
+        # plot segments
+        axd.hlines(
+            [y_range[0]] * len(file_segs),
+            [s[0] for s in file_segs],
+            [s[1] for s in file_segs],
+            color='#ff0000',
+            lw=3
+        )
+        axd.hlines(
+            [y_range[0]] * len(trig_segs[detector]),
+            [s[0] for s in trig_segs[detector]],
+            [s[1] for s in trig_segs[detector]],
+            color='#00ff00',
+            lw=3
+        )
+        # plot triggers
+        trig_times = triggers[detector][0]
+        trig_ranks = triggers[detector][2]
+        loudest_rank = -np.inf
+        for chunk_times, chunk_ranks in iter_chunks(
+                [trig_times, trig_ranks], chunk_size):
+            loudest = np.argmax(chunk_ranks)
+            if chunk_ranks[loudest] > loudest_rank:
+                loudest_rank = chunk_ranks[loudest]
+                loudest_time = chunk_times[loudest]
+        print('Max {} rw SNR {:.2f} at {:.3f}'.format(
+            detector,
+            loudest_rank,
+            loudest_time
+        ))
+        if args.raster:
+            time_edges, y_edges = raster_grid(
+                axd, fig, dpi, file_segs_extent, y_range, log_y
+            )
+            image = None
+            for chunk in iter_chunks(triggers[detector], chunk_size):
+                image = raster_max(
+                    chunk[0],
+                    trigger_param(y_param, chunk, bank),
+                    chunk[2],
+                    time_edges,
+                    y_edges,
+                    log_y,
+                    image=image
+                )
+            if color_param != 'rank':
+                # second pass: color of the loudest trigger in each pixel
+                rank_image = image
+                image = None
+                for chunk in iter_chunks(triggers[detector], chunk_size):
+                    image = raster_color(
+                        chunk[0],
+                        trigger_param(y_param, chunk, bank),
+                        chunk[2],
+                        trigger_param(color_param, chunk, bank),
+                        time_edges,
+                        y_edges,
+                        log_y,
+                        rank_image,
+                        image=image
+                    )
+            plot_raster(axd, image, time_edges, y_edges, log_y, *color_range)
+        else:
+            # loudest triggers on top
+            sorter = np.argsort(trig_ranks)
+            axd.scatter(
+                trig_times[sorter],
+                trigger_param(y_param, triggers[detector], bank)[sorter],
+                c=trigger_param(color_param, triggers[detector], bank)[sorter],
+                vmin=color_range[0],
+                vmax=color_range[1],
+                cmap='magma_r',
+                s=4,
+                lw=0
+            )
+        for ht in (args.highlight_times or []):
+            axd.axvline(ht, ls='--', color='green')
+        # plot gates
+        for g in (args.gates or []):
+            gate = g.split(',')
+            if gate[0] != detector:
+                continue
+            plot_gate(axd, map(float, gate[1:]))
+
+    # make nice time ticks
+    min_gps = int(file_segs_extent[0])
+    max_gps = int(file_segs_extent[1])
+    if max_gps - min_gps > 3600:
+        # ticks every hour
+        time_tick_unit = 'h'
+        time_tick_fmt = '%Y\n%m-%d\n%H UTC'
+    else:
+        # ticks every minute
+        time_tick_unit = 'm'
+        time_tick_fmt = '%Y-%m-%d\n%H:%M UTC'
+    utc_ticks = np.arange(
+        gps_to_utc(min_gps).astype(f'datetime64[{time_tick_unit}]'),
+        gps_to_utc(max_gps),
+        np.timedelta64(1, time_tick_unit)
+    )
+    time_ticks = utc_to_gps(utc_ticks)
+    keep = (time_ticks >= file_segs_extent[0]) \
+        & (time_ticks <= file_segs_extent[1])
+    time_ticks = time_ticks[keep]
+    time_tick_labels = [
+        t.astype(object).strftime(time_tick_fmt) for t in utc_ticks[keep]
+    ]
+    for detector in detectors:
+        ax[detector].set_xlim(
+            file_segs_extent[0],
+            file_segs_extent[1]
         )
-    min_gps += time_tick_delta
-    if min_gps >= max_gps:
-        break
-for detector in detectors:
-    ax[detector].set_xlim(
-        file_segs_extent[0],
-        file_segs_extent[1]
+        ax[detector].set_xticks(time_ticks)
+    ax[detectors[-1]].set_xticklabels(time_tick_labels)
+
+    # add colorbar
+    cb = fig.colorbar(
+        matplotlib.cm.ScalarMappable(
+            matplotlib.colors.Normalize(*color_range),
+            cmap='magma_r'
+        ),
+        cax=ax['cb'],
+        extend=('both' if color_param == 'rank' else 'neither')
     )
-    ax[detector].set_xticks(time_ticks)
-ax[detectors[-1]].set_xticklabels(time_tick_labels)
+    cb.set_label(PARAM_LABELS[color_param])
 
-# add colorbar
-cb = fig.colorbar(
-    matplotlib.cm.ScalarMappable(
-        matplotlib.colors.Normalize(vmin=6, vmax=12),
-        cmap='magma_r'
-    ),
-    cax=ax['cb'],
-    extend='both'
-)
-cb.set_label('$\\chi^2$-weighted SNR')
+    fig.tight_layout()
 
-fig.tight_layout()
+    logging.info('Saving plot')
 
-logging.info('Saving plot')
+    os.makedirs(os.path.dirname(args.output_plot), exist_ok=True)
+    fig.savefig(args.output_plot, dpi=dpi)
+
+    logging.info('Done')
+
+
+def main():
+    args = parse_cli()
+
+    logging.basicConfig(
+        format='%(asctime)s %(message)s',
+        level=(logging.INFO if args.verbose else logging.WARN)
+    )
+
+    if args.scratch_dir is None:
+        make_plot(args, None)
+        return
+
+    if not args.raster:
+        logging.info('Out-of-core mode, plotting with --raster')
+        args.raster = True
+    os.makedirs(args.scratch_dir, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(
+        prefix='pycbclive_plot_singles_', dir=args.scratch_dir
+    )
+    try:
+        make_plot(args, scratch_dir)
+    finally:
+        shutil.rmtree(scratch_dir)
 
-os.makedirs(os.path.dirname(args.output_plot), exist_ok=True)
-fig.savefig(args.output_plot, dpi=150)
 
-logging.info('Done')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""Tests of the classification of PyCBC Live log lines."""
+
+from pycbclive_logs import LINE_CLASSES, LogParser, parse_line
+
+
+LINES = [
+    '2023-05-24T12:00:00.000+0000 host 0 Starting',
+    '2023-05-24T12:00:01.000+0000 host 0 Starting strain reader for H1',
+    '2023-05-24T12:00:02.000+0000 host 0 Took 1.5, duty factor of 0.40, '
+    'lag 5.20 s, 3 live detectors',
+]
+
+
+def test_only_bare_starting_line_is_a_restart():
+    parser = LogParser(classes=LINE_CLASSES)
+    columns = parser.parse_lines(LINES)
+    classes = [LINE_CLASSES[i] for i in columns['line_class']]
+    assert classes == ['starting', 'other', 'took']
+    assert not parser.malformed
+
+
+def test_parse_line_starting():
+    assert parse_line(LINES[0])[0] == 'starting'
+    assert parse_line(LINES[1])[0] == 'other'